@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+"""
+生成パイプラインのオフラインベンチマーク（偽claude + ローカルメディアサーバー、外部サービス不要）
+
+偽のclaude（benchmarks/fake_claude.py）をPATHに置き、ローカルHTTPサーバーの合成メディアを返させて、
+KamuiMCPClient と generate.py --batch を同時実行数・一括生成サイズを変えながら計測する。
+結果（assets/sec・レイテンシのp50/p95/p99・ピークRSS）は benchmarks/baseline.json と比較し、
+許容幅を超えて劣化したシナリオがあれば終了コード1で失敗する。
+
+使い方:
+  python benchmarks/bench_generation.py                     # 計測してベースラインと比較
+  python benchmarks/bench_generation.py --update-baseline   # ベースラインを更新
+  python benchmarks/bench_generation.py --quick --no-baseline
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+from pathlib import Path
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+BENCH_DIR = Path(__file__).resolve().parent
+PROJECT_ROOT = BENCH_DIR.parent
+SRC_DIR = PROJECT_ROOT / "src"
+BASELINE_PATH = BENCH_DIR / "baseline.json"
+
+sys.path.insert(0, str(SRC_DIR))
+
+from tracing import percentile
+
+# 計測シナリオ（mode: client=KamuiMCPClientを直接 / cli=generate.py --batch をサブプロセスで）
+SCENARIOS = [
+    {"name": "client-image-c1", "mode": "client", "type": "image", "items": 12, "concurrency": 1},
+    {"name": "client-image-c4", "mode": "client", "type": "image", "items": 24, "concurrency": 4},
+    {"name": "client-image-c8", "mode": "client", "type": "image", "items": 32, "concurrency": 8},
+    {"name": "client-image-c4-session4", "mode": "client", "type": "image", "items": 24, "concurrency": 4,
+     "session_batch": 4},
+    {"name": "client-music-c4-session8", "mode": "client", "type": "music", "items": 32, "concurrency": 4,
+     "session_batch": 8},
+    {"name": "cli-image-c4", "mode": "cli", "type": "image", "items": 24, "concurrency": 4},
+    {"name": "cli-image-c8-session4", "mode": "cli", "type": "image", "items": 32, "concurrency": 8,
+     "session_batch": 4},
+]
+
+# ベースラインと比較する指標（higher: 大きいほど良い）
+CHECKED_METRICS = {
+    "assets_per_sec": "higher",
+    "p95_seconds": "lower",
+    "peak_rss_mb": "lower",
+}
+
+class MediaHandler(BaseHTTPRequestHandler):
+    """合成メディアを返すRange対応サーバー（?bytes=N でサイズ指定）"""
+    
+    protocol_version = "HTTP/1.1"
+    
+    def log_message(self, format, *args):
+        pass
+    
+    def _payload_size(self):
+        query = parse_qs(urlparse(self.path).query)
+        return int(query.get("bytes", ["262144"])[0])
+    
+    def do_GET(self):
+        total = self._payload_size()
+        start, end = 0, total - 1
+        status = 200
+        range_header = self.headers.get("Range")
+        if range_header:
+            first, _, last = range_header.split("=")[1].partition("-")
+            start, end = int(first), min(int(last) if last else total - 1, total - 1)
+            status = 206
+        length = end - start + 1
+        
+        self.send_response(status)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(length))
+        self.send_header("Accept-Ranges", "bytes")
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{total}")
+        self.end_headers()
+        
+        block = bytes(range(256)) * 256
+        offset = start
+        while offset <= end:
+            chunk = block[offset % len(block):][:end - offset + 1]
+            self.wfile.write(chunk)
+            offset += len(chunk)
+
+class MediaServer(ThreadingHTTPServer):
+    daemon_threads = True
+    
+    def handle_error(self, request, client_address):
+        # ダウンロード側の打ち切り（Range再開・中断）は計測対象外なので黙って捨てる
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+def start_media_server():
+    server = MediaServer(("127.0.0.1", 0), MediaHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def prepare_environment(work_dir, media_url, args):
+    """偽claudeをPATHに置き、ベンチマーク用の設定ファイルと環境変数を用意"""
+    bin_dir = work_dir / "bin"
+    bin_dir.mkdir()
+    fake_claude = bin_dir / "claude"
+    fake_claude.write_text(f"#!{sys.executable}\n" + (BENCH_DIR / "fake_claude.py").read_text())
+    fake_claude.chmod(0o755)
+    
+    config_path = work_dir / "mcp-kamuicode.json"
+    shutil.copy(PROJECT_ROOT / "workflows" / "mcp-kamuicode.json", config_path)
+    
+    # プランの制限ではなくクライアント自体を計測するため、レート制限は十分大きくする
+    rate_limits_path = work_dir / "rate-limits.json"
+    unlimited = {"requests_per_minute": 1_000_000, "burst": 1000, "max_concurrency": 64,
+                 "initial_concurrency": 64, "cost": 1}
+    rate_limits_path.write_text(json.dumps({
+        "capabilities": {name: unlimited for name in ("t2i", "t2v", "t2m", "i2v", "i2i", "i2i3d", "v2v")},
+        "budget": {"monthly_units": None},
+    }))
+    
+    env = dict(os.environ)
+    env.update({
+        "PATH": f"{bin_dir}{os.pathsep}{env.get('PATH', '')}",
+        "KAMUI_CLAUDE_BIN": str(fake_claude),
+        "KAMUI_MCP_CONFIG": str(config_path),
+        "KAMUI_RATE_LIMITS": str(rate_limits_path),
+        "KAMUI_LOG_LEVEL": "warning",
+        "KAMUI_RETRY_BASE_DELAY": "0.1",
+        "FAKE_CLAUDE_MEDIA_URL": media_url,
+        "FAKE_CLAUDE_DELAY": str(args.delay),
+        "FAKE_CLAUDE_JITTER": str(args.jitter),
+        "FAKE_CLAUDE_BYTES": str(args.media_bytes),
+    })
+    return env
+
+def batch_items(scenario):
+    return [{"id": str(i), "type": scenario["type"], "prompt": f"benchmark asset {i}", "style": "minimal"}
+            for i in range(scenario["items"])]
+
+def run_client_scenario(scenario, outputs_dir):
+    """KamuiMCPClient + run_batch を同一プロセスで実行し、結果レコードと経過時間を返す"""
+    import io
+    from kamui_client import KamuiMCPClient
+    from batch import run_batch
+    from tracing import configure_logging
+    
+    configure_logging("warning", stream=sys.stderr)
+    client = KamuiMCPClient(outputs_dir=outputs_dir, cache_mode="off", transport="claude")
+    client.session_batch_size = scenario.get("session_batch", 1)
+    items = [dict(item, index=i) for i, item in enumerate(batch_items(scenario))]
+    
+    output = io.StringIO()
+    start = time.perf_counter()
+    try:
+        run_batch(client, items, max_workers=scenario["concurrency"], output=output)
+    finally:
+        client.close()
+    elapsed = time.perf_counter() - start
+    records = [json.loads(line) for line in output.getvalue().splitlines()]
+    return records, elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def run_cli_scenario(scenario, outputs_dir, env):
+    """generate.py --batch をサブプロセスで実行し、結果レコードと経過時間を返す"""
+    batch_path = outputs_dir / "bench.jsonl"
+    outputs_dir.mkdir(parents=True, exist_ok=True)
+    batch_path.write_text("".join(json.dumps(item) + "\n" for item in batch_items(scenario)))
+    results_path = outputs_dir / "results.jsonl"
+    
+    cmd = [sys.executable, str(SRC_DIR / "generate.py"), "--batch", str(batch_path),
+           "--batch-output", str(results_path), "--transport", "claude", "--no-cache",
+           "--max-parallel", str(scenario["concurrency"]), "--log-level", "warning"]
+    if scenario.get("session_batch"):
+        cmd += ["--session-batch", str(scenario["session_batch"])]
+    
+    start = time.perf_counter()
+    completed = subprocess.run(cmd, env=dict(env, KAMUI_OUTPUTS_DIR=str(outputs_dir)),
+                               capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+    if completed.returncode not in (0, 2):
+        raise Exception(f"generate.py failed (exit {completed.returncode}): {completed.stderr[-2000:]}")
+    records = [json.loads(line) for line in results_path.read_text().splitlines() if line.strip()]
+    return records, elapsed, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+def run_scenario_worker(scenario_json):
+    """--run-scenario: 1シナリオを計測してJSONを標準出力へ（ピークRSSをシナリオごとに分けるため別プロセス）"""
+    scenario = json.loads(scenario_json)
+    outputs_dir = Path(tempfile.mkdtemp(prefix="bench-outputs-"))
+    try:
+        if scenario["mode"] == "client":
+            records, elapsed, max_rss_kb = run_client_scenario(scenario, outputs_dir)
+        else:
+            records, elapsed, max_rss_kb = run_cli_scenario(scenario, outputs_dir, dict(os.environ))
+    finally:
+        shutil.rmtree(outputs_dir, ignore_errors=True)
+    
+    latencies = [record["elapsed_seconds"] for record in records if record["status"] == "ok"]
+    ok = len(latencies)
+    print(json.dumps({
+        "assets": len(records),
+        "failed": len(records) - ok,
+        "elapsed_seconds": round(elapsed, 3),
+        "assets_per_sec": round(ok / elapsed, 3) if elapsed else 0.0,
+        "p50_seconds": percentile(latencies, 0.5),
+        "p95_seconds": percentile(latencies, 0.95),
+        "p99_seconds": percentile(latencies, 0.99),
+        "peak_rss_mb": round(max_rss_kb / 1024, 1),
+    }))
+
+def measure(scenario, env):
+    completed = subprocess.run([sys.executable, __file__, "--run-scenario", json.dumps(scenario)],
+                               env=env, capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise Exception(f"{scenario['name']}: {completed.stderr[-2000:]}")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+def compare_with_baseline(results, baseline, tolerance):
+    """ベースラインより tolerance 以上悪化した指標を返す"""
+    regressions = []
+    for name, metrics in results.items():
+        reference = baseline.get(name)
+        if not reference:
+            continue
+        for metric, direction in CHECKED_METRICS.items():
+            expected, actual = reference.get(metric), metrics.get(metric)
+            if not expected or actual is None:
+                continue
+            if direction == "higher" and actual < expected * (1 - tolerance):
+                regressions.append(f"{name}: {metric} {actual} < {expected} (-{tolerance:.0%})")
+            elif direction == "lower" and actual > expected * (1 + tolerance):
+                regressions.append(f"{name}: {metric} {actual} > {expected} (+{tolerance:.0%})")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline generation benchmark (fake claude + local media server)")
+    parser.add_argument("--delay", type=float, default=0.2, help="Simulated claude latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Extra random latency (0..N seconds)")
+    parser.add_argument("--media-bytes", type=int, default=256 * 1024, help="Size of each synthetic asset")
+    parser.add_argument("--scenario", action="append", help="Run only the named scenario (repeatable)")
+    parser.add_argument("--quick", action="store_true", help="Quarter-size runs (not compared with the baseline)")
+    parser.add_argument("--tolerance", type=float, default=0.3, help="Allowed regression vs baseline (0.3 = 30%%)")
+    parser.add_argument("--baseline", default=str(BASELINE_PATH), help="Baseline JSON path")
+    parser.add_argument("--update-baseline", action="store_true", help="Store this run as the new baseline")
+    parser.add_argument("--no-baseline", action="store_true", help="Do not compare with the baseline")
+    parser.add_argument("--run-scenario", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    
+    if args.run_scenario:
+        run_scenario_worker(args.run_scenario)
+        return
+    
+    scenarios = [s for s in SCENARIOS if not args.scenario or s["name"] in args.scenario]
+    if args.quick:
+        scenarios = [dict(s, items=max(s["concurrency"], s["items"] // 4)) for s in scenarios]
+    
+    server = start_media_server()
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        env = prepare_environment(Path(tmp), f"http://127.0.0.1:{server.server_port}", args)
+        print(f"🏁 {len(scenarios)} scenarios, fake claude delay {args.delay}s, "
+              f"{args.media_bytes // 1024} KB per asset")
+        print(f"{'scenario':<28} {'assets':>6} {'fail':>4} {'assets/s':>9} {'p50 s':>7} {'p95 s':>7} "
+              f"{'p99 s':>7} {'RSS MB':>7}")
+        for scenario in scenarios:
+            metrics = measure(scenario, env)
+            results[scenario["name"]] = metrics
+            print(f"{scenario['name']:<28} {metrics['assets']:>6} {metrics['failed']:>4} "
+                  f"{metrics['assets_per_sec']:>9.2f} {metrics['p50_seconds'] or 0:>7.3f} "
+                  f"{metrics['p95_seconds'] or 0:>7.3f} {metrics['p99_seconds'] or 0:>7.3f} "
+                  f"{metrics['peak_rss_mb']:>7.1f}")
+    server.shutdown()
+    
+    failed = [name for name, metrics in results.items() if metrics["failed"]]
+    settings = {"delay": args.delay, "jitter": args.jitter, "media_bytes": args.media_bytes}
+    baseline_path = Path(args.baseline)
+    
+    if args.update_baseline:
+        if args.quick:
+            print("❌ --quick runs cannot be stored as the baseline")
+            sys.exit(1)
+        stored = json.loads(baseline_path.read_text()) if baseline_path.exists() else {}
+        stored.setdefault("scenarios", {}).update(results)
+        stored["settings"] = settings
+        baseline_path.write_text(json.dumps(stored, indent=2, sort_keys=True) + "\n")
+        print(f"📌 Baseline updated: {baseline_path}")
+    elif not args.no_baseline and not args.quick and baseline_path.exists():
+        baseline = json.loads(baseline_path.read_text())
+        if baseline.get("settings") != settings:
+            print(f"⚠️ Baseline was recorded with {baseline.get('settings')}; skipping comparison")
+        else:
+            regressions = compare_with_baseline(results, baseline.get("scenarios", {}), args.tolerance)
+            if regressions:
+                print("❌ Performance regressions:")
+                for regression in regressions:
+                    print(f"  - {regression}")
+                sys.exit(1)
+            print(f"✅ No regressions beyond {args.tolerance:.0%} of {baseline_path.name}")
+    
+    if failed:
+        print(f"❌ Failed generations in: {', '.join(failed)}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
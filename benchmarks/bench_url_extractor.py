@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+URL抽出のマイクロベンチマーク（旧実装: 4正規表現 + set / 新実装: 1パス抽出）
+
+使い方: python benchmarks/bench_url_extractor.py [--size-mb 5] [--repeat 5]
+"""
+
+import re
+import sys
+import time
+import argparse
+import statistics
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from url_extractor import extract_urls
+
+def legacy_extract(response_text):
+    """旧extract_urls_from_responseの実装（比較用）"""
+    url_patterns = [
+        r'https?://[^\s<>"\']+\.(?:jpg|jpeg|png|gif|mp4|mov|mp3|wav|obj|fbx|gltf)',
+        r'https://storage\.googleapis\.com/[^\s<>"\']+',
+        r'https://[a-zA-Z0-9.-]+\.googleusercontent\.com/[^\s<>"\']+',
+        r'https://fal\.media/[^\s<>"\']+',
+    ]
+    urls = []
+    for pattern in url_patterns:
+        urls.extend(re.findall(pattern, response_text))
+    return list(set(urls))
+
+def build_response(size_mb, url_every=1, distinct_urls=None):
+    """ログ・URL・JSONが混在する大きなレスポンスを作成"""
+    filler = "生成中です... progress: 42% " * 8 + "\n"
+    urls = [
+        "https://storage.googleapis.com/kamui-outputs/{i}/image.png?X-Goog-Expires=3600",
+        "https://fal.media/files/lion/{i}_video.mp4",
+        "https://docs.example.com/guide/{i}",
+        "https://v3.fal.media/files/tiger/{i}.mp3",
+    ]
+    chunks = []
+    size = 0
+    i = 0
+    while size < size_mb * 1024 * 1024:
+        line = filler
+        if i % url_every == 0:
+            n = i if distinct_urls is None else i % distinct_urls
+            line += urls[n % len(urls)].format(i=n) + "\n"
+        chunks.append(line)
+        size += len(line.encode("utf-8"))
+        i += 1
+    chunks.append('```json\n{"result": {"url": "https://fal.media/files/final/output.mp4"}}\n```\n')
+    return "".join(chunks)
+
+def bench(func, text, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(text)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+def main():
+    parser = argparse.ArgumentParser(description="URL extractor micro-benchmark")
+    parser.add_argument("--size-mb", type=float, default=5.0, help="Response size in MB")
+    parser.add_argument("--repeat", type=int, default=5, help="Repetitions per implementation")
+    args = parser.parse_args()
+    
+    scenarios = [
+        ("URL on every line (all distinct)", build_response(args.size_mb)),
+        ("log-heavy (URL every 20 lines, 50 distinct)", build_response(args.size_mb, url_every=20, distinct_urls=50)),
+    ]
+    
+    for name, text in scenarios:
+        print(f"\n📏 {name}: {len(text.encode('utf-8')) / 1024 / 1024:.1f} MB")
+        legacy = bench(legacy_extract, text, args.repeat)
+        current = bench(lambda t: extract_urls(t, "generate_video"), text, args.repeat)
+        
+        print(f"⏱️ legacy (4 regex + set): {legacy * 1000:.1f} ms")
+        print(f"⏱️ single-pass extractor:  {current * 1000:.1f} ms")
+        print(f"📊 ratio (legacy / single-pass): {legacy / current:.2f}x")
+        print(f"🎯 top URL: {extract_urls(text, 'generate_video')[0]}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+偽のclaude実行ファイル（ベンチマーク用）
+
+標準入力のプロンプトから生成タイプを判定し、FAKE_CLAUDE_DELAY 秒後にローカルメディアサーバーのURLを出力する。
+一括生成プロンプト（「- [ID] プロンプト」形式）には {"results": [...]} のJSONコードブロックで応答する。
+
+環境変数:
+  FAKE_CLAUDE_MEDIA_URL  メディアサーバーのベースURL（必須、例: http://127.0.0.1:8000）
+  FAKE_CLAUDE_DELAY      応答までの秒数（デフォルト 0.2、一括生成では項目ごとに加算しない）
+  FAKE_CLAUDE_JITTER     遅延に加える一様乱数の最大秒数（デフォルト 0）
+  FAKE_CLAUDE_BYTES      生成物のサイズ（デフォルト 262144）
+  FAKE_CLAUDE_FAIL_RATE  非ゼロ終了する確率（デフォルト 0）
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import random
+
+# プロンプト中の語 → 拡張子（先に一致したものを採用）
+MEDIA_KINDS = (
+    ("3Dモデル", "glb"),
+    ("動画", "mp4"),
+    ("音楽", "mp3"),
+    ("画像", "png"),
+)
+
+ITEM_PATTERN = re.compile(r"^- \[([^\]]+)\] ", re.MULTILINE)
+
+def media_url(base_url, extension, size):
+    return f"{base_url}/media/{uuid.uuid4().hex}.{extension}?bytes={size}"
+
+def main():
+    prompt = sys.stdin.read()
+    base_url = os.environ["FAKE_CLAUDE_MEDIA_URL"].rstrip("/")
+    delay = float(os.getenv("FAKE_CLAUDE_DELAY", "0.2")) + random.uniform(0, float(os.getenv("FAKE_CLAUDE_JITTER", "0")))
+    size = int(os.getenv("FAKE_CLAUDE_BYTES", str(256 * 1024)))
+    extension = next((ext for word, ext in MEDIA_KINDS if word in prompt), "png")
+
+    print("Generating...", flush=True)
+    time.sleep(delay)
+    if random.random() < float(os.getenv("FAKE_CLAUDE_FAIL_RATE", "0")):
+        print("simulated failure: service temporarily unavailable", file=sys.stderr)
+        sys.exit(1)
+
+    item_ids = ITEM_PATTERN.findall(prompt)
+    if item_ids:
+        results = [{"id": item_id, "url": media_url(base_url, extension, size)} for item_id in item_ids]
+        print("```json\n" + json.dumps({"results": results}) + "\n```", flush=True)
+    else:
+        print(f"ダウンロードURL: {media_url(base_url, extension, size)}", flush=True)
+    print("Done.", flush=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+"""
+Asset Manifest - 生成物の索引（SQLite）。プロンプト・パラメータ・サーバー・URL・サイズ・ダイジェスト・所要時間を記録して検索
+"""
+
+import os
+import json
+import time
+import sqlite3
+import threading
+from pathlib import Path
+from datetime import datetime, timezone
+from urllib.parse import urlparse, parse_qsl
+from generation_cache import file_digest
+from job_store import _Transaction
+
+# 生成操作 → 生成タイプ（検索の --type に対応）
+OPERATION_TYPES = {
+    "generate_image": "image",
+    "generate_video": "video",
+    "image_to_video": "video",
+    "generate_music": "music",
+    "generate_3d_model": "3d",
+    "image_to_3d": "3d",
+}
+
+# プロンプトとして索引する params のキー（先に見つかったもの）
+PROMPT_PARAMS = ("prompt", "motion_prompt")
+
+# 全文検索（trigram）が使えるのは3文字以上の語のみ。それより短い語は LIKE で検索
+FTS_MIN_TERM_LENGTH = 3
+
+# 有効期限を読み取れないURL（署名なしの公開URL等）は取得からこの秒数だけ有効とみなす
+ORIGIN_URL_TTL_SECONDS = float(os.getenv("KAMUI_ORIGIN_URL_TTL_SECONDS", "3600"))
+
+# 入力として再利用するURLに必要な残り有効期間（生成呼び出し中に失効しないように）
+ORIGIN_URL_MIN_REMAINING_SECONDS = 300
+
+# 署名付きURLの日時・有効秒数のクエリパラメータ（GCS V4 / S3互換）
+SIGNED_URL_PREFIXES = ("x-goog-", "x-amz-")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS assets (
+    path TEXT PRIMARY KEY,
+    type TEXT NOT NULL,
+    operation TEXT NOT NULL,
+    prompt TEXT,
+    params TEXT NOT NULL,
+    server TEXT,
+    url TEXT,
+    url_expires_at REAL,
+    bytes INTEGER,
+    digest TEXT,
+    cache_key TEXT,
+    cached INTEGER NOT NULL DEFAULT 0,
+    call_seconds REAL,
+    download_seconds REAL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS assets_type_created ON assets (type, created_at);
+CREATE INDEX IF NOT EXISTS assets_created ON assets (created_at);
+CREATE INDEX IF NOT EXISTS assets_digest ON assets (digest);
+"""
+
+# 既存の索引に後から追加した列
+ADDED_COLUMNS = {"url_expires_at": "REAL"}
+
+# プロンプトの部分一致検索用（SQLiteがFTS5 trigramに対応していなければ LIKE のみ）
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS assets_fts USING fts5(prompt, content='assets', content_rowid='rowid',
+                                                         tokenize='trigram');
+CREATE TRIGGER IF NOT EXISTS assets_fts_insert AFTER INSERT ON assets BEGIN
+    INSERT INTO assets_fts (rowid, prompt) VALUES (new.rowid, new.prompt);
+END;
+CREATE TRIGGER IF NOT EXISTS assets_fts_delete AFTER DELETE ON assets BEGIN
+    INSERT INTO assets_fts (assets_fts, rowid, prompt) VALUES ('delete', old.rowid, old.prompt);
+END;
+CREATE TRIGGER IF NOT EXISTS assets_fts_update AFTER UPDATE ON assets BEGIN
+    INSERT INTO assets_fts (assets_fts, rowid, prompt) VALUES ('delete', old.rowid, old.prompt);
+    INSERT INTO assets_fts (rowid, prompt) VALUES (new.rowid, new.prompt);
+END;
+"""
+
+def parse_date(value):
+    """YYYY-MM-DD / ISO 8601 をUNIX時刻に変換（タイムゾーンなしはローカル時刻）"""
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise Exception(f"日付の形式が無効です（YYYY-MM-DD または ISO 8601）: {value}")
+
+def url_expires_at(url, fetched_at):
+    """URLの失効時刻（UNIX時刻）。署名付きURLは署名の有効期限、それ以外は取得時刻 + ORIGIN_URL_TTL_SECONDS"""
+    query = {key.lower(): value for key, value in parse_qsl(urlparse(url).query)}
+    try:
+        for prefix in SIGNED_URL_PREFIXES:
+            if prefix + "date" in query and prefix + "expires" in query:
+                signed_at = datetime.strptime(query[prefix + "date"], "%Y%m%dT%H%M%SZ")
+                return signed_at.replace(tzinfo=timezone.utc).timestamp() + int(query[prefix + "expires"])
+        # GCS V2署名（Expires=<UNIX時刻>）
+        if "expires" in query:
+            return float(query["expires"])
+    except ValueError:
+        pass
+    return fetched_at + ORIGIN_URL_TTL_SECONDS
+
+class AssetManifest:
+    """生成結果の索引（1ファイル1行、同じパスへの再生成は上書き）"""
+    
+    def __init__(self, db_path):
+        self.db_path = Path(db_path)
+        self._local = threading.local()
+        self._init_lock = threading.Lock()
+        self._initialized = False
+        self.full_text = False
+    
+    def _initialize(self):
+        """索引ファイルとスキーマを作成（初回の接続時。クライアントを作っただけではファイルを作らない）"""
+        with self._init_lock:
+            if self._initialized:
+                return
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            with self._open() as conn:
+                conn.executescript(SCHEMA)
+                try:
+                    conn.executescript(FTS_SCHEMA)
+                    self.full_text = True
+                except sqlite3.OperationalError:
+                    self.full_text = False
+                columns = {row["name"] for row in conn.execute("PRAGMA table_info(assets)")}
+                for column, column_type in ADDED_COLUMNS.items():
+                    if column not in columns:
+                        conn.execute(f"ALTER TABLE assets ADD COLUMN {column} {column_type}")
+            self._initialized = True
+    
+    def _readable(self):
+        """読み取れる索引があるか（まだ何も記録していなければ、ファイルを作らずに空として扱う）"""
+        return self._initialized or self.db_path.exists()
+    
+    def _connect(self):
+        if not self._initialized:
+            self._initialize()
+        return self._open()
+    
+    def _open(self):
+        """スレッドごとの接続（sqlite3接続はスレッド間で共有しない）"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(str(self.db_path), timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return _Transaction(conn)
+    
+    def record(self, request, result):
+        """生成結果（リクエストと結果dict）を記録し、記録した行を返す"""
+        path = Path(result["path"])
+        params = request["params"]
+        url = result.get("url")
+        row = {
+            "path": str(path.resolve()),
+            "type": OPERATION_TYPES.get(request["operation"], request["operation"]),
+            "operation": request["operation"],
+            "prompt": next((params[key] for key in PROMPT_PARAMS if params.get(key)), None),
+            "params": json.dumps(params, ensure_ascii=False, sort_keys=True, default=str),
+            "server": result.get("server"),
+            "url": url,
+            "url_expires_at": url_expires_at(url, result.get("url_fetched_at") or time.time()) if url else None,
+            "bytes": path.stat().st_size,
+            "digest": file_digest(path),
+            "cache_key": request.get("cache_key"),
+            "cached": int(bool(result.get("cached"))),
+            "call_seconds": result.get("call_seconds"),
+            "download_seconds": result.get("download_seconds"),
+            "created_at": time.time(),
+        }
+        columns = ", ".join(row)
+        placeholders = ", ".join("?" for _ in row)
+        updates = ", ".join(f"{column} = excluded.{column}" for column in row if column != "path")
+        with self._connect() as conn:
+            conn.execute(f"INSERT INTO assets ({columns}) VALUES ({placeholders}) "
+                         f"ON CONFLICT (path) DO UPDATE SET {updates}", tuple(row.values()))
+        return row
+    
+    def query(self, text=None, asset_type=None, operation=None, since=None, until=None, limit=50):
+        """条件に一致する生成物を新しい順に返す（text はプロンプトに全語を含むもの）"""
+        if not self._readable():
+            return []
+        # full_text はスキーマ作成時に決まるため、開いたばかりの索引でも先に初期化する
+        if not self._initialized:
+            self._initialize()
+        conditions = []
+        args = []
+        
+        terms = (text or "").split()
+        long_terms = [term for term in terms if len(term) >= FTS_MIN_TERM_LENGTH] if self.full_text else []
+        if long_terms:
+            match = " ".join('"' + term.replace('"', '""') + '"' for term in long_terms)
+            conditions.append("assets.rowid IN (SELECT rowid FROM assets_fts WHERE assets_fts MATCH ?)")
+            args.append(match)
+        for term in terms:
+            if term not in long_terms:
+                conditions.append("assets.prompt LIKE ? ESCAPE '\\'")
+                args.append("%" + term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%")
+        
+        if asset_type:
+            conditions.append("type = ?")
+            args.append(asset_type)
+        if operation:
+            conditions.append("operation = ?")
+            args.append(operation)
+        if since is not None:
+            conditions.append("created_at >= ?")
+            args.append(since)
+        if until is not None:
+            conditions.append("created_at < ?")
+            args.append(until)
+        
+        query = "SELECT * FROM assets"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY created_at DESC LIMIT ?"
+        args.append(limit)
+        with self._connect() as conn:
+            return [self._decode(row) for row in conn.execute(query, args)]
+    
+    def _decode(self, row):
+        row = dict(row)
+        row["params"] = json.loads(row["params"])
+        row["cached"] = bool(row["cached"])
+        return row
+    
+    def get(self, path):
+        """パスの生成物の記録（なければNone）"""
+        if not self._readable():
+            return None
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM assets WHERE path = ?", (str(Path(path).resolve()),)).fetchone()
+        return self._decode(row) if row else None
+    
+    def path_for_digest(self, digest):
+        """この内容の生成物のうち、現存する最新のパス（なければNone）"""
+        if not self._readable():
+            return None
+        with self._connect() as conn:
+            rows = conn.execute("SELECT path FROM assets WHERE digest = ? ORDER BY created_at DESC", (digest,)).fetchall()
+        return next((row["path"] for row in rows if Path(row["path"]).exists()), None)
+    
+    def origin_url(self, digest, min_remaining=ORIGIN_URL_MIN_REMAINING_SECONDS):
+        """この内容の生成物をダウンロードした元URLのうち、まだ有効なもの（なければNone）"""
+        if not self._readable():
+            return None
+        with self._connect() as conn:
+            row = conn.execute("SELECT url FROM assets WHERE digest = ? AND url IS NOT NULL AND url_expires_at > ? "
+                               "ORDER BY url_expires_at DESC LIMIT 1", (digest, time.time() + min_remaining)).fetchone()
+        return row["url"] if row else None
+    
+    def forget_origin_url(self, url):
+        """受け付けられなかった元URLを失効扱いにし、以降は入力として再利用しない"""
+        if not self._readable():
+            return
+        with self._connect() as conn:
+            conn.execute("UPDATE assets SET url_expires_at = ? WHERE url = ?", (time.time(), url))
+    
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
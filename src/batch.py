@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""
+Batch Runner - 複数プロンプトをワーカープールで一括生成
+"""
+
+import csv
+import json
+import sys
+import time
+import threading
+import contextvars
+from datetime import datetime, timezone
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from deadline import current_deadline
+
+# バッチ項目で指定可能なパラメータ
+BATCH_ITEM_FIELDS = ["type", "prompt", "style", "duration", "aspect_ratio", "output_name", "tier", "seed"]
+
+# 数値として扱うパラメータ
+NUMERIC_FIELDS = {"duration", "seed"}
+
+def _normalize_item(raw, index, default_type):
+    """バッチ項目を正規化（空文字は未指定扱い）"""
+    item = {}
+    for key, value in raw.items():
+        if key is None:
+            continue
+        key = key.strip()
+        if isinstance(value, str):
+            value = value.strip()
+            if value == "":
+                continue
+        if key in NUMERIC_FIELDS and isinstance(value, str):
+            value = float(value) if "." in value else int(value)
+        item[key] = value
+    
+    item.setdefault("type", default_type)
+    item.setdefault("id", str(index))
+    item["index"] = index
+    
+    if not item.get("prompt"):
+        raise Exception(f"バッチ項目 {index}: promptがありません")
+    if not item.get("type"):
+        raise Exception(f"バッチ項目 {index}: typeがありません")
+    return item
+
+def load_batch_items(batch_path, default_type="image"):
+    """JSONLまたはCSVからバッチ項目を読み込み"""
+    batch_path = Path(batch_path)
+    if not batch_path.exists():
+        raise Exception(f"バッチファイルが見つかりません: {batch_path}")
+    
+    items = []
+    with open(batch_path, "r", encoding="utf-8", newline="") as f:
+        if batch_path.suffix.lower() == ".csv":
+            for raw in csv.DictReader(f):
+                items.append(_normalize_item(raw, len(items), default_type))
+        else:
+            for line_number, line in enumerate(f, 1):
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                try:
+                    raw = json.loads(line)
+                except json.JSONDecodeError as e:
+                    raise Exception(f"バッチファイルの読み込みエラー ({batch_path}:{line_number}): {e}")
+                items.append(_normalize_item(raw, len(items), default_type))
+    
+    return items
+
+def _new_record(item):
+    return {
+        "id": item["id"],
+        "index": item["index"],
+        "type": item["type"],
+        "prompt": item["prompt"],
+        "status": "failed",
+        "path": None,
+        "url": None,
+        "error": None,
+        "timings": None,
+        "started_at": datetime.now(timezone.utc).isoformat(),
+    }
+
+def _fill_record(record, result, start):
+    """生成結果（dict）または例外をレコードに反映"""
+    if isinstance(result, Exception):
+        record["error"] = str(result)
+    else:
+        record["path"] = result["path"]
+        record["url"] = result["url"]
+        record["timings"] = {
+            "call_seconds": result["call_seconds"],
+            "download_seconds": result["download_seconds"],
+        }
+        if result.get("session_size"):
+            record["timings"]["session_size"] = result["session_size"]
+        record["status"] = "ok"
+    record["elapsed_seconds"] = round(time.monotonic() - start, 3)
+    return record
+
+def _item_params(item):
+    return {key: item[key] for key in BATCH_ITEM_FIELDS if key in item and key not in ("type", "prompt")}
+
+def run_batch_item(client, item):
+    """1項目を生成し、結果レコードを返す（再試行後も失敗した例外は記録して握りつぶす）"""
+    record = _new_record(item)
+    start = time.monotonic()
+    try:
+        result = client.generate_asset(item["type"], item["prompt"], **_item_params(item))
+    except Exception as e:
+        result = e
+    return _fill_record(record, result, start)
+
+def session_group_key(client, item):
+    """1セッションにまとめられる項目のキー（タイプとプロンプト・出力名以外の設定が一致）。まとめられなければNone"""
+    session_capable = getattr(client, "session_capable", None)
+    if session_capable is None or not session_capable(item["type"]):
+        return None
+    return (item["type"],) + tuple((key, item.get(key)) for key in BATCH_ITEM_FIELDS
+                                   if key not in ("type", "prompt", "output_name"))
+
+def plan_batch_units(client, items):
+    """項目を実行単位に分割（互換な項目はセッション上限までまとめ、それ以外は1件ずつ）"""
+    limit = getattr(client, "session_batch_size", 1)
+    units = []
+    open_groups = {}
+    for item in items:
+        key = session_group_key(client, item)
+        if key is None or limit <= 1:
+            units.append([item])
+            continue
+        group = open_groups.get(key)
+        if group is None or len(group) >= limit:
+            group = open_groups[key] = []
+            units.append(group)
+        group.append(item)
+    return units
+
+def run_batch_unit(client, items):
+    """実行単位（1件、または1セッションにまとめる複数件）を生成し、項目ごとの結果レコードを返す"""
+    if len(items) == 1:
+        return [run_batch_item(client, items[0])]
+    
+    records = [_new_record(item) for item in items]
+    start = time.monotonic()
+    shared = _item_params(items[0])
+    group_items = [{"prompt": item["prompt"], "output_name": item.get("output_name")} for item in items]
+    try:
+        results = client.generate_asset_group(items[0]["type"], group_items, **shared)
+    except Exception as e:
+        results = [e] * len(items)
+    return [_fill_record(record, result, start) for record, result in zip(records, results)]
+
+def run_batch(client, items, max_workers=4, output=None):
+    """バッチ項目をワーカープールで実行し、完了順にJSONLで結果を出力"""
+    if output is None:
+        output = sys.stdout
+    
+    summary = {"total": len(items), "ok": 0, "failed": 0}
+    
+    with ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="batch") as executor:
+        futures = [executor.submit(contextvars.copy_context().run, run_batch_unit, client, unit)
+                   for unit in plan_batch_units(client, items)]
+        for future in as_completed(futures):
+            for record in future.result():
+                summary["ok" if record["status"] == "ok" else "failed"] += 1
+                output.write(json.dumps(record, ensure_ascii=False) + "\n")
+            output.flush()
+    
+    return summary
+
+def run_jobs(client, store, batch=None, max_workers=4, output=None, retry_failed=False):
+    """ジョブストアの未完了ジョブを取得しながら実行（複数プロセスから同時に呼び出し可能）"""
+    if output is None:
+        output = sys.stdout
+    
+    summary = {"total": 0, "ok": 0, "failed": 0}
+    lock = threading.Lock()
+    limit = max(1, getattr(client, "session_batch_size", 1))
+    deadline = current_deadline()
+    
+    def worker():
+        while not deadline.done:
+            # 先頭のジョブと、同じセッションにまとめられるジョブを一括で取得
+            jobs = store.claim_many(batch=batch, retry_failed=retry_failed, limit=limit,
+                                    group_key=lambda item: session_group_key(client, item))
+            if not jobs:
+                return
+            records = run_batch_unit(client, [job["item"] for job in jobs])
+            if deadline.done:
+                # 中断で失敗したジョブは完了扱いにせず running のまま残す（--resume で再実行）
+                kept = [(job, record) for job, record in zip(jobs, records) if record["status"] == "ok"]
+                jobs = [job for job, _ in kept]
+                records = [record for _, record in kept]
+            for job, record in zip(jobs, records):
+                record["job_id"] = job["id"]
+                record["attempt"] = job["attempts"]
+                store.complete(job["id"], record)
+            with lock:
+                for record in records:
+                    summary["total"] += 1
+                    summary["ok" if record["status"] == "ok" else "failed"] += 1
+                    output.write(json.dumps(record, ensure_ascii=False) + "\n")
+                output.flush()
+    
+    with ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="job") as executor:
+        for future in [executor.submit(deadline.run, worker) for _ in range(max(1, max_workers))]:
+            future.result()
+    
+    return summary
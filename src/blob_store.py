@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Blob Store - 内容ダイジェスト名で生成物の実体を1つだけ保持し、outputs/ の各パスはハードリンク（不可ならシンボリックリンク）で参照
+"""
+
+import os
+import time
+import shutil
+import threading
+from pathlib import Path
+from generation_cache import file_digest
+from tracing import get_logger
+
+logger = get_logger(__name__)
+
+# 参照のないブロブでも、この秒数以内に作られたものは削除しない（取り込み直後〜リンク前の競合を避ける）
+DEFAULT_GC_GRACE_SECONDS = float(os.getenv("KAMUI_BLOB_GC_GRACE_SECONDS", "3600"))
+
+def default_blob_dir(outputs_dir):
+    """ブロブ置き場（KAMUI_BLOB_DIR、なければ outputs/.blobs。ハードリンクには同じファイルシステムが必要）"""
+    return Path(os.getenv("KAMUI_BLOB_DIR") or Path(outputs_dir) / ".blobs")
+
+class BlobStore:
+    """sha256ダイジェストをファイル名とするブロブ置き場（objects/<先頭2文字>/<ダイジェスト>）"""
+    
+    def __init__(self, root):
+        self.root = Path(root)
+        self.objects_dir = self.root / "objects"
+        self._lock = threading.Lock()
+    
+    def blob_path(self, digest):
+        return self.objects_dir / digest[:2] / digest
+    
+    def ingest(self, source, digest=None):
+        """ファイルをブロブとして取り込み（sourceは移動される。同じ内容が既にあれば破棄）、ブロブのパスを返す"""
+        source = Path(source)
+        if digest is None:
+            digest = file_digest(source)
+        blob = self.blob_path(digest)
+        blob.parent.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            if blob.exists():
+                source.unlink()
+            else:
+                os.replace(source, blob)
+                os.chmod(blob, 0o444)
+        return blob
+    
+    def link(self, blob, destination):
+        """destination をブロブへのハードリンクにする（別デバイス等ではシンボリックリンク、それも不可ならコピー）"""
+        destination = Path(destination)
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = destination.with_name(f".{destination.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            os.link(blob, tmp_path)
+        except OSError:
+            try:
+                os.symlink(os.path.abspath(blob), tmp_path)
+            except OSError:
+                shutil.copy2(blob, tmp_path)
+        os.replace(tmp_path, destination)
+        return destination
+    
+    def store(self, source, destination, digest=None):
+        """source を取り込み、destination から参照させる（ダウンロード完了時の配置）"""
+        return self.link(self.ingest(source, digest), destination)
+    
+    def adopt(self, path):
+        """既存の通常ファイルをブロブ化（同じ内容のブロブがあればリンクに置き換えて重複を解消）。節約バイト数を返す"""
+        path = Path(path)
+        if path.is_symlink() or not path.is_file():
+            return 0
+        blob = self.blob_path(file_digest(path))
+        if blob.exists():
+            if os.path.samefile(blob, path):
+                return 0
+            stat = path.stat()
+            self.link(blob, path)
+            return stat.st_size if stat.st_nlink == 1 else 0
+        blob.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.link(path, blob)
+            os.chmod(blob, 0o444)
+        except OSError:
+            # 別デバイスならブロブへコピーしてからリンク（シンボリックリンク）に置き換え
+            shutil.copy2(path, blob)
+            self.link(blob, path)
+        return 0
+    
+    def blobs(self):
+        if not self.objects_dir.exists():
+            return []
+        return [path for path in self.objects_dir.glob("*/*") if path.is_file()]
+    
+    def gc(self, roots=(), grace_seconds=DEFAULT_GC_GRACE_SECONDS, dry_run=False):
+        """どのパスからも参照されていないブロブを削除し、{"blobs", "removed", "freed_bytes"} を返す
+        
+        ハードリンク数が1のブロブを未参照とみなす。roots 配下のシンボリックリンクが指すブロブは参照扱い。
+        """
+        linked = set()
+        for root in roots:
+            for dirpath, _, filenames in os.walk(root):
+                for name in filenames:
+                    path = os.path.join(dirpath, name)
+                    if os.path.islink(path):
+                        linked.add(os.path.realpath(path))
+        
+        now = time.time()
+        blobs = self.blobs()
+        summary = {"blobs": len(blobs), "removed": 0, "freed_bytes": 0}
+        for blob in blobs:
+            stat = blob.stat()
+            if stat.st_nlink > 1 or str(blob.resolve()) in linked or now - stat.st_mtime < grace_seconds:
+                continue
+            if not dry_run:
+                blob.unlink()
+            summary["removed"] += 1
+            summary["freed_bytes"] += stat.st_size
+        return summary
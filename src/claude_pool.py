@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+Claude Worker Pool - 常駐claudeプロセス（stream-json入出力）のワーカープール
+"""
+
+import json
+import queue
+import threading
+import subprocess
+from deadline import current_deadline, kill_process_group
+
+# ワーカー1つあたりの最大ジョブ数（会話コンテキストの肥大化を防ぐため定期的に再起動）
+DEFAULT_MAX_JOBS_PER_WORKER = 20
+
+STREAM_ARGS = [
+    "--print",
+    "--input-format", "stream-json",
+    "--output-format", "stream-json",
+    "--verbose",
+]
+
+class ClaudeWorkerError(Exception):
+    """ワーカーの異常（ワーカーは破棄される）"""
+
+class ClaudeWorker:
+    """stream-jsonモードで起動した常駐claudeプロセス"""
+    
+    def __init__(self, cmd, env=None, cwd=None):
+        self.cmd = cmd
+        self.jobs = 0
+        self.healthy = True
+        self.process = subprocess.Popen(
+            cmd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            bufsize=1,
+            cwd=cwd,
+            env=env,
+            # 停止時にMCPサーバー等の子プロセスごと終了できるよう、独立したプロセスグループで起動
+            start_new_session=True,
+        )
+        self._lines = queue.Queue()
+        self._reader = threading.Thread(target=self._read_stdout, daemon=True)
+        self._reader.start()
+    
+    @property
+    def pid(self):
+        return self.process.pid
+    
+    def _read_stdout(self):
+        for line in self.process.stdout:
+            self._lines.put(line)
+        self._lines.put(None)
+    
+    def run(self, prompt, timeout=None):
+        """プロンプトを1件送信し、resultメッセージのテキストを返す"""
+        if self.process.poll() is not None:
+            self.healthy = False
+            raise ClaudeWorkerError(f"worker exited (code {self.process.returncode})")
+        
+        message = {"type": "user", "message": {"role": "user", "content": [{"type": "text", "text": prompt}]}}
+        try:
+            self.process.stdin.write(json.dumps(message, ensure_ascii=False) + "\n")
+            self.process.stdin.flush()
+        except (BrokenPipeError, OSError) as e:
+            self.healthy = False
+            raise ClaudeWorkerError(f"worker stdin closed: {e}")
+        
+        self.jobs += 1
+        assistant_text = []
+        while True:
+            try:
+                line = self._lines.get(timeout=timeout)
+            except queue.Empty:
+                self.healthy = False
+                raise ClaudeWorkerError(f"worker timeout after {timeout}s")
+            if line is None:
+                self.healthy = False
+                raise ClaudeWorkerError(f"worker exited (code {self.process.wait()})")
+            
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            
+            if event.get("type") == "assistant":
+                for block in event.get("message", {}).get("content", []):
+                    if block.get("type") == "text":
+                        assistant_text.append(block.get("text", ""))
+            elif event.get("type") == "result":
+                if event.get("is_error"):
+                    self.healthy = False
+                    raise ClaudeWorkerError(f"Claude Code error: {event.get('result') or event.get('subtype')}")
+                return event.get("result") or "\n".join(assistant_text)
+    
+    def kill(self):
+        """実行中のジョブごと子プロセスも含めて強制終了（キャンセル時）"""
+        self.healthy = False
+        kill_process_group(self.process)
+    
+    def close(self):
+        """プロセスを終了"""
+        self.healthy = False
+        if self.process.poll() is None:
+            try:
+                self.process.stdin.close()
+            except OSError:
+                pass
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                kill_process_group(self.process)
+                self.process.wait()
+
+class ClaudeWorkerPool:
+    """アイドルなワーカーにプロンプトを振り分けるプール"""
+    
+    def __init__(self, cmd, size=2, max_jobs_per_worker=DEFAULT_MAX_JOBS_PER_WORKER, env=None, cwd=None):
+        self.cmd = list(cmd) + STREAM_ARGS
+        self.size = max(1, size)
+        self.max_jobs_per_worker = max_jobs_per_worker
+        self.env = env
+        self.cwd = cwd
+        self._idle = queue.Queue()
+        self._slots = threading.Semaphore(self.size)
+        self._lock = threading.Lock()
+        self._workers = set()
+        self._closed = False
+    
+    def _acquire(self):
+        self._slots.acquire()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            worker = ClaudeWorker(self.cmd, env=self.env, cwd=self.cwd)
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._workers.add(worker)
+        return worker
+    
+    def _release(self, worker):
+        if worker.healthy and worker.jobs < self.max_jobs_per_worker and not self._closed:
+            self._idle.put(worker)
+        else:
+            self._discard(worker)
+        self._slots.release()
+    
+    def _discard(self, worker):
+        worker.close()
+        with self._lock:
+            self._workers.discard(worker)
+    
+    def run(self, prompt, timeout=None):
+        """アイドルワーカーでプロンプトを実行（現在の期限でタイムアウトし、キャンセルされたらワーカーを停止）"""
+        if self._closed:
+            raise ClaudeWorkerError("pool is closed")
+        deadline = current_deadline()
+        worker = self._acquire()
+        try:
+            with deadline.on_cancel(lambda reason: worker.kill()):
+                try:
+                    return worker.run(prompt, timeout=deadline.timeout(timeout))
+                except ClaudeWorkerError:
+                    deadline.check()
+                    raise
+        finally:
+            self._release(worker)
+    
+    def close(self):
+        """全ワーカーを終了"""
+        self._closed = True
+        with self._lock:
+            workers = list(self._workers)
+        for worker in workers:
+            self._discard(worker)
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+"""
+Daemon - 生成クライアントを常駐させ、Unixソケット経由でCLIのジョブを受け付ける（進捗はストリームで返す）
+
+プロトコル: 1接続1リクエスト。クライアントはJSON1行を送り、デーモンはJSON Lines でイベントを返す。
+  {"command": "run", "args": {...}, "log_level": "info"}  → {"event": "log" | "output" | "exit", ...}
+    実行中に同じ接続へ {"command": "cancel"} を送るか切断すると、ジョブの期限をキャンセルする
+  {"command": "ping"}                                      → {"event": "pong", "pid": ..., "jobs": ...}
+  {"command": "stop"}                                      → {"event": "exit", "code": 0}
+"""
+
+import os
+import json
+import socket
+import logging
+import threading
+import socketserver
+from pathlib import Path
+from deadline import Deadline
+from tracing import get_logger
+
+logger = get_logger(__name__)
+
+# 出力ディレクトリ内のソケットファイル名
+SOCKET_NAME = ".kamui.sock"
+
+# デーモン接続確認のタイムアウト（秒、応答がなければ起動していないとみなす）
+CONNECT_TIMEOUT = 1.0
+
+def default_socket_path():
+    """デーモンのソケットパス（KAMUI_SERVE_SOCKET、なければ出力ディレクトリ内）"""
+    if os.getenv("KAMUI_SERVE_SOCKET"):
+        return Path(os.environ["KAMUI_SERVE_SOCKET"])
+    outputs_dir = os.getenv("KAMUI_OUTPUTS_DIR") or Path(__file__).parent.parent / "outputs"
+    return Path(outputs_dir) / SOCKET_NAME
+
+def _encode(message):
+    return (json.dumps(message, ensure_ascii=False, default=str) + "\n").encode("utf-8")
+
+class DaemonJob:
+    """実行中ジョブの送信先（ログ・結果行を接続元へ転送）と期限
+
+    接続元が切断した・cancel を送った場合は deadline をキャンセルし、claudeプロセスやダウンロードを止める。
+    """
+    
+    def __init__(self, connection):
+        self._connection = connection
+        self._lock = threading.Lock()
+        self.disconnected = False
+        self.deadline = Deadline(name="daemon job")
+        self.stdout = _JobOutput(self)
+    
+    def send(self, event, **fields):
+        if self.disconnected:
+            return
+        data = _encode(dict(fields, event=event))
+        with self._lock:
+            try:
+                self._connection.sendall(data)
+            except OSError:
+                self.disconnected = True
+        if self.disconnected:
+            self.deadline.cancel("client disconnected")
+    
+    def watch(self, rfile):
+        """接続元からの cancel・切断（EOF）を待ち、ジョブの期限をキャンセル（接続が閉じるまで別スレッドで実行）"""
+        try:
+            for line in rfile:
+                try:
+                    command = json.loads(line).get("command")
+                except (json.JSONDecodeError, UnicodeDecodeError, AttributeError):
+                    continue
+                if command == "cancel":
+                    self.deadline.cancel("cancelled by client")
+        except (OSError, ValueError):
+            pass
+        self.disconnected = True
+        self.deadline.cancel("client disconnected")
+    
+    def log(self, text):
+        self.send("log", text=text)
+
+class _JobOutput:
+    """--batch-output - の結果行を接続元の標準出力へ転送するファイル風オブジェクト"""
+    
+    def __init__(self, job):
+        self._job = job
+    
+    def write(self, data):
+        if data:
+            self._job.send("output", data=data)
+        return len(data)
+    
+    def flush(self):
+        pass
+
+class _JobLogHandler(logging.Handler):
+    """kamui.* のログを実行中ジョブへ転送（レベルはジョブごとに接続元の指定に合わせる）"""
+    
+    def __init__(self):
+        super().__init__()
+        self.setFormatter(logging.Formatter("%(message)s"))
+        self.job = None
+    
+    def attach(self, job, level):
+        self.setLevel(getattr(logging, (level or "info").upper()))
+        self.job = job
+    
+    def detach(self):
+        self.job = None
+    
+    def emit(self, record):
+        job = self.job
+        if job is not None:
+            job.log(self.format(record))
+
+class KamuiDaemon:
+    """ソケットでジョブを受け付ける常駐サーバー（接続ごとのスレッドで受け付け、ジョブは1件ずつ実行）"""
+    
+    def __init__(self, socket_path, run_job):
+        self.socket_path = Path(socket_path)
+        self.run_job = run_job
+        self.jobs_run = 0
+        self._job_lock = threading.Lock()
+        self._log_handler = _JobLogHandler()
+        self._server = None
+    
+    def serve_forever(self):
+        """stop() されるまでジョブを受け付ける"""
+        if daemon_running(self.socket_path):
+            raise Exception(f"デーモンは既に起動しています: {self.socket_path}")
+        self.socket_path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            self.socket_path.unlink()
+        except FileNotFoundError:
+            pass
+        
+        daemon = self
+        
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                daemon._handle(self.connection, self.rfile)
+        
+        self._server = socketserver.ThreadingUnixStreamServer(str(self.socket_path), Handler)
+        self._server.daemon_threads = True
+        os.chmod(self.socket_path, 0o600)
+        
+        # ジョブ転送用ハンドラはジョブのレベルで絞るため、ロガー自体は全レベルを通す
+        root = logging.getLogger("kamui")
+        saved_level = root.level
+        for handler in root.handlers:
+            handler.setLevel(saved_level)
+        root.setLevel(logging.DEBUG)
+        root.addHandler(self._log_handler)
+        logger.info(f"🛰️ Daemon listening on {self.socket_path} (pid {os.getpid()})")
+        try:
+            self._server.serve_forever()
+        finally:
+            root.removeHandler(self._log_handler)
+            root.setLevel(saved_level)
+            self._server.server_close()
+            try:
+                self.socket_path.unlink()
+            except FileNotFoundError:
+                pass
+            logger.info(f"🛑 Daemon stopped after {self.jobs_run} jobs")
+    
+    def stop(self):
+        """受け付けを停止（シグナルハンドラ・接続スレッドのどちらからでも呼べるよう別スレッドで停止）"""
+        if self._server is not None:
+            threading.Thread(target=self._server.shutdown, daemon=True).start()
+    
+    def _handle(self, connection, rfile):
+        job = DaemonJob(connection)
+        try:
+            request = json.loads(rfile.readline())
+        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+            job.send("exit", code=1, error=f"invalid request: {e}")
+            return
+        
+        command = request.get("command")
+        if command == "ping":
+            job.send("pong", pid=os.getpid(), jobs=self.jobs_run)
+            return
+        if command == "stop":
+            job.send("exit", code=0)
+            self.stop()
+            return
+        if command != "run":
+            job.send("exit", code=1, error=f"unknown command: {command}")
+            return
+        
+        threading.Thread(target=job.watch, args=(rfile,), daemon=True).start()
+        if not self._job_lock.acquire(blocking=False):
+            job.log("⏳ Waiting for the running job to finish...")
+            self._job_lock.acquire()
+        try:
+            # 待機中に接続元が中断したジョブは実行しない
+            if job.deadline.cancelled:
+                logger.info(f"🛑 Skipped job ({job.deadline.reason})")
+                return
+            self._log_handler.attach(job, request.get("log_level"))
+            code = self.run_job(request["args"], job)
+        finally:
+            self._log_handler.detach()
+            self.jobs_run += 1
+            self._job_lock.release()
+        job.send("exit", code=code)
+
+def _connect(socket_path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(CONNECT_TIMEOUT)
+    try:
+        sock.connect(str(socket_path))
+    except OSError:
+        sock.close()
+        raise
+    sock.settimeout(None)
+    return sock
+
+def _request(socket_path, message):
+    """1リクエストを送り、応答イベントを順に返すジェネレータ"""
+    with _connect(socket_path) as sock, sock.makefile("rb") as rfile:
+        sock.sendall(_encode(message))
+        for line in rfile:
+            yield json.loads(line)
+
+def daemon_running(socket_path):
+    """ソケットのデーモンが応答するか（古いソケットファイルが残っているだけならFalse）"""
+    try:
+        return any(event.get("event") == "pong" for event in _request(socket_path, {"command": "ping"}))
+    except (OSError, json.JSONDecodeError):
+        return False
+
+def stop_daemon(socket_path):
+    """デーモンに停止を依頼（起動していなければFalse）"""
+    try:
+        return any(event.get("event") == "exit" for event in _request(socket_path, {"command": "stop"}))
+    except (OSError, json.JSONDecodeError):
+        return False
+
+def _relay(message, stdout, log_stream):
+    """デーモンのイベントを中継し、exit なら終了コードを返す（それ以外はNone）"""
+    kind = message.get("event")
+    if kind == "log":
+        print(message["text"], file=log_stream, flush=True)
+    elif kind == "output":
+        stdout.write(message["data"])
+        stdout.flush()
+    elif kind == "exit":
+        if message.get("error"):
+            print(f"❌ Daemon: {message['error']}", file=log_stream, flush=True)
+        return message["code"]
+    return None
+
+def submit_job(socket_path, args, stdout, log_stream, log_level=None):
+    """デーモンにジョブを送り、ログと結果行を中継して終了コードを返す（デーモンがなければNone）
+
+    Ctrl-C（KeyboardInterrupt）はデーモンへ cancel として転送し、ジョブの片付けを待ってから送出し直す。
+    """
+    try:
+        sock = _connect(socket_path)
+    except OSError:
+        return None
+    
+    with sock, sock.makefile("rb") as rfile:
+        sock.sendall(_encode({"command": "run", "args": args, "log_level": log_level}))
+        try:
+            for line in rfile:
+                code = _relay(json.loads(line), stdout, log_stream)
+                if code is not None:
+                    return code
+        except KeyboardInterrupt:
+            try:
+                sock.sendall(_encode({"command": "cancel"}))
+                for line in rfile:
+                    if _relay(json.loads(line), stdout, log_stream) is not None:
+                        break
+            except (OSError, json.JSONDecodeError):
+                pass
+            raise
+    raise Exception(f"デーモンとの接続がジョブの途中で切断されました: {socket_path}")
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+Deadline - 生成パイプライン全体への期限・キャンセルの伝搬（generate.py → 生成 → claude呼び出し・ダウンロード）
+"""
+
+import os
+import time
+import signal
+import threading
+import contextvars
+from contextlib import contextmanager
+from tracing import get_logger
+
+logger = get_logger(__name__)
+
+# ステージごとの持ち時間（秒）。KAMUI_BUDGET_<ステージ名の大文字> で上書き（0で無制限）
+STAGE_BUDGETS = {
+    "generate_image": 300,
+    "generate_video": 600,
+    "generate_music": 300,
+    "generate_3d_model": 600,
+    "image_to_video": 600,
+    "image_to_3d": 600,
+    "download": 120,
+}
+
+_current_deadline = contextvars.ContextVar("kamui_deadline", default=None)
+
+class Cancelled(Exception):
+    """キャンセルされた（Ctrl-C・CIの中断・同じジョブの他の枝の失敗）。再試行しない"""
+
+class DeadlineExceeded(Cancelled):
+    """ジョブ全体またはステージの持ち時間を超えた"""
+
+def stage_budget(stage):
+    """ステージの持ち時間（秒、無制限ならNone）"""
+    value = os.getenv(f"KAMUI_BUDGET_{stage.upper()}")
+    seconds = float(value) if value else STAGE_BUDGETS.get(stage)
+    return seconds or None
+
+class Deadline:
+    """期限とキャンセル状態（子の期限は親を超えず、親のキャンセルは子へ伝わる）"""
+    
+    def __init__(self, seconds=None, name="job", parent=None):
+        self.name = name
+        self.parent = parent
+        self.expires_at = time.monotonic() + seconds if seconds else None
+        if parent is not None and parent.expires_at is not None:
+            self.expires_at = parent.expires_at if self.expires_at is None else min(self.expires_at, parent.expires_at)
+        self.reason = None
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        if parent is not None:
+            parent._add_callback(self.cancel)
+    
+    def _add_callback(self, callback):
+        with self._lock:
+            if self.reason is None:
+                self._callbacks.append(callback)
+                return
+        callback(self.reason)
+    
+    def _remove_callback(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+    
+    def cancel(self, reason="cancelled"):
+        """キャンセルし、登録済みのコールバック（子のキャンセル・プロセス停止）を呼ぶ"""
+        with self._lock:
+            if self.reason is not None:
+                return
+            self.reason = reason
+            callbacks, self._callbacks = self._callbacks, []
+        self._event.set()
+        for callback in callbacks:
+            try:
+                callback(reason)
+            except Exception as e:
+                logger.debug(f"⚠️ Cancel callback failed: {e}")
+    
+    @property
+    def cancelled(self):
+        return self.reason is not None
+    
+    @property
+    def done(self):
+        """キャンセル済み、または期限切れ"""
+        remaining = self.remaining()
+        return self.reason is not None or (remaining is not None and remaining <= 0)
+    
+    def remaining(self):
+        """残り秒数（期限なしならNone）"""
+        if self.expires_at is None:
+            return None
+        return self.expires_at - time.monotonic()
+    
+    def check(self):
+        """キャンセル済みなら Cancelled、期限切れなら DeadlineExceeded を送出"""
+        if self.reason is not None:
+            raise Cancelled(f"{self.name}: {self.reason}")
+        remaining = self.remaining()
+        if remaining is not None and remaining <= 0:
+            raise DeadlineExceeded(f"{self.name}: 持ち時間を超えました")
+    
+    def timeout(self, default=None):
+        """ブロックする呼び出しに渡すタイムアウト（default と残り時間の短い方）"""
+        self.check()
+        remaining = self.remaining()
+        if remaining is None:
+            return default
+        return remaining if default is None else min(default, remaining)
+    
+    def sleep(self, seconds):
+        """キャンセルされたらすぐに戻る sleep（期限を過ぎる待機は期限で打ち切って送出）"""
+        self._event.wait(self.timeout(seconds))
+        self.check()
+    
+    @contextmanager
+    def on_cancel(self, callback):
+        """ブロック中にキャンセルされたら callback(reason) を呼ぶ（既にキャンセル済みなら即座に呼ぶ）"""
+        self._add_callback(callback)
+        try:
+            yield
+        finally:
+            self._remove_callback(callback)
+    
+    def child(self, seconds=None, name=None):
+        """この期限内の子（seconds は子自身の持ち時間）。不要になったら detach() する"""
+        return Deadline(seconds, name or self.name, parent=self)
+    
+    def detach(self):
+        """親のキャンセル通知から外す"""
+        if self.parent is not None:
+            self.parent._remove_callback(self.cancel)
+    
+    def run(self, func, *args, **kwargs):
+        """この期限を現在の期限として func を実行（スレッドプールへ渡す場合など）"""
+        with deadline_scope(self):
+            return func(*args, **kwargs)
+
+def current_deadline():
+    """現在の期限（スコープ外なら期限なし）"""
+    return _current_deadline.get() or Deadline(name="unbounded")
+
+@contextmanager
+def deadline_scope(deadline):
+    """with 内（同じスレッド・コンテキスト）の現在の期限を設定"""
+    token = _current_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current_deadline.reset(token)
+
+@contextmanager
+def stage(name, seconds=None):
+    """現在の期限の内側でステージの持ち時間（既定は STAGE_BUDGETS）を適用"""
+    deadline = current_deadline().child(seconds if seconds is not None else stage_budget(name), name=name)
+    try:
+        with deadline_scope(deadline):
+            deadline.check()
+            yield deadline
+    finally:
+        deadline.detach()
+
+@contextmanager
+def cancel_on_signals(deadline, signals=(signal.SIGINT, signal.SIGTERM)):
+    """SIGINT / SIGTERM（Ctrl-C・CIの中断）で deadline をキャンセルしてから KeyboardInterrupt を送出
+    
+    キャンセルを先に行うため、実行中のclaudeプロセスやダウンロードはスレッドの終了待ちより前に止まる。
+    メインスレッド以外では何もしない。
+    """
+    if threading.current_thread() is not threading.main_thread():
+        yield deadline
+        return
+    
+    def handler(signum, frame):
+        deadline.cancel(f"{signal.Signals(signum).name} received")
+        raise KeyboardInterrupt
+    
+    previous = {signum: signal.signal(signum, handler) for signum in signals}
+    try:
+        yield deadline
+    finally:
+        for signum, previous_handler in previous.items():
+            signal.signal(signum, previous_handler)
+
+def kill_process_group(process):
+    """start_new_session=True で起動したプロセスを、子プロセス（MCPサーバー等）ごと停止"""
+    try:
+        if hasattr(os, "killpg"):
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+    except (ProcessLookupError, PermissionError):
+        pass
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""
+Download Manager - 接続プール・Range並列取得・.partからの再開・アトミック配置
+"""
+
+import os
+import json
+import time
+import hashlib
+import threading
+import requests
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from generation_cache import file_digest
+from deadline import Cancelled, current_deadline
+
+MB = 1024 * 1024
+
+DEFAULT_CONNECT_TIMEOUT = float(os.getenv("KAMUI_DOWNLOAD_CONNECT_TIMEOUT", "10"))
+DEFAULT_READ_TIMEOUT = float(os.getenv("KAMUI_DOWNLOAD_READ_TIMEOUT", "60"))
+
+# セグメント並列取得の進捗を保存する間隔（秒）。クラッシュ後は最後に保存した位置から再開
+STATE_SAVE_INTERVAL = 1.0
+
+class DownloadError(Exception):
+    """ダウンロード失敗（.partファイルは再開用に残る。キャンセル・期限切れ時は削除）"""
+
+class DownloadManager:
+    """共有セッションによるダウンロード管理"""
+    
+    def __init__(self, pool_size=16, connect_timeout=DEFAULT_CONNECT_TIMEOUT, read_timeout=DEFAULT_READ_TIMEOUT,
+                 chunk_size=1 * MB, max_segments=4, min_segmented_size=32 * MB):
+        self.timeout = (connect_timeout, read_timeout)
+        self.chunk_size = chunk_size
+        self.max_segments = max(1, max_segments)
+        self.min_segmented_size = min_segmented_size
+        
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.pool_size = pool_size
+        self._segment_executor = None
+        self._lock = threading.Lock()
+    
+    def _get_segment_executor(self):
+        with self._lock:
+            if self._segment_executor is None:
+                self._segment_executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix="segment")
+            return self._segment_executor
+    
+    def close(self):
+        """スレッドプールと接続を解放（以降の呼び出しで再作成される）"""
+        with self._lock:
+            if self._segment_executor is not None:
+                self._segment_executor.shutdown(wait=True)
+                self._segment_executor = None
+        self.session.close()
+    
+    def _timeout(self, deadline):
+        """接続・読み込みタイムアウト（読み込みは期限までの残り時間以内）"""
+        connect_timeout, read_timeout = self.timeout
+        return (deadline.timeout(connect_timeout), deadline.timeout(read_timeout))
+    
+    def _probe(self, url, deadline):
+        """1バイトのRangeリクエストで全体サイズとRange対応を確認"""
+        try:
+            with self.session.get(url, headers={"Range": "bytes=0-0"}, stream=True,
+                                  timeout=self._timeout(deadline)) as response:
+                if response.status_code == 206:
+                    content_range = response.headers.get("Content-Range", "")
+                    total = content_range.rpartition("/")[2]
+                    return (int(total) if total.isdigit() else None), True
+                if response.status_code == 200:
+                    length = response.headers.get("Content-Length")
+                    return (int(length) if length and length.isdigit() else None), False
+        except requests.RequestException:
+            pass
+        return None, False
+    
+    @staticmethod
+    def _load_state(state_path, url, total):
+        """再開用の状態を読み込み（URL・サイズが一致する場合のみ）"""
+        if not state_path.exists():
+            return None
+        try:
+            with open(state_path, "r") as f:
+                state = json.load(f)
+        except (json.JSONDecodeError, OSError):
+            return None
+        if state.get("url") != url or state.get("total") != total:
+            return None
+        return state
+    
+    @staticmethod
+    def _save_state(state_path, state):
+        tmp_path = state_path.with_name(state_path.name + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, state_path)
+    
+    def download(self, url, output_path, blob_store=None):
+        """URLをoutput_pathへダウンロード（完了時のみ最終パスへ配置）
+
+        blob_store を指定すると、受信しながら計算したダイジェスト名のブロブとして取り込み、
+        output_path はそのブロブへのリンクになる（同じ内容は1つだけ保持）。
+        """
+        output_path = Path(output_path)
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        part_path = output_path.with_name(output_path.name + ".part")
+        state_path = output_path.with_name(output_path.name + ".part.json")
+        deadline = current_deadline()
+        
+        try:
+            total, ranges = self._probe(url, deadline)
+            state = self._load_state(state_path, url, total)
+            if state is None and part_path.exists():
+                part_path.unlink()
+            
+            hasher = None
+            if ranges and total and total >= self.min_segmented_size and self.max_segments > 1:
+                self._download_segmented(url, part_path, state_path, total, state, deadline)
+            else:
+                if state is None:
+                    self._save_state(state_path, {"url": url, "total": total})
+                hasher = self._download_stream(url, part_path, deadline, resume=ranges and state is not None)
+        except (Cancelled, DownloadError, requests.RequestException):
+            # キャンセル・期限切れ（期限で打ち切ったタイムアウトを含む）では再開用の途中ファイルも残さない
+            if deadline.done:
+                part_path.unlink(missing_ok=True)
+                state_path.unlink(missing_ok=True)
+                deadline.check()
+            raise
+        
+        size = part_path.stat().st_size
+        if total is not None and size != total:
+            raise DownloadError(f"サイズ不一致: {size} / {total} bytes ({url})")
+        
+        if blob_store is not None:
+            # セグメント並列取得は書き込み順が前後するため、完了後にまとめてハッシュ
+            digest = hasher.hexdigest() if hasher is not None else file_digest(part_path)
+            blob_store.store(part_path, output_path, digest)
+        else:
+            os.replace(part_path, output_path)
+        state_path.unlink(missing_ok=True)
+        return str(output_path)
+    
+    def _download_stream(self, url, part_path, deadline, resume=False):
+        """単一ストリームでダウンロード（可能なら途中から再開）し、書き込みながら計算したsha256を返す"""
+        offset = part_path.stat().st_size if resume and part_path.exists() else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        hasher = hashlib.sha256()
+        try:
+            with self.session.get(url, headers=headers, stream=True, timeout=self._timeout(deadline)) as response:
+                if response.status_code == 416 and offset:
+                    return None
+                response.raise_for_status()
+                mode = "ab" if offset and response.status_code == 206 else "wb"
+                if mode == "ab":
+                    # 再開時は取得済みの先頭部分を先にハッシュ
+                    with open(part_path, "rb") as f:
+                        for chunk in iter(lambda: f.read(self.chunk_size), b""):
+                            hasher.update(chunk)
+                with open(part_path, mode) as f:
+                    for chunk in response.iter_content(chunk_size=self.chunk_size):
+                        deadline.check()
+                        f.write(chunk)
+                        hasher.update(chunk)
+            return hasher
+        except requests.RequestException as e:
+            raise DownloadError(f"ダウンロードエラー ({url}): {e}")
+    
+    def _download_segmented(self, url, part_path, state_path, total, state, deadline):
+        """Rangeセグメントを並列取得して.partファイルの各位置へ書き込み"""
+        if state is None or "segments" not in state:
+            segment_size = -(-total // self.max_segments)
+            segments = [[start, min(start + segment_size, total) - 1, 0]
+                        for start in range(0, total, segment_size)]
+            state = {"url": url, "total": total, "segments": segments}
+            with open(part_path, "wb") as f:
+                f.truncate(total)
+            self._save_state(state_path, state)
+        elif not part_path.exists():
+            with open(part_path, "wb") as f:
+                f.truncate(total)
+            for segment in state["segments"]:
+                segment[2] = 0
+        
+        lock = threading.Lock()
+        last_saved = [time.monotonic()]
+        
+        def fetch(segment):
+            start, end, done = segment
+            if start + done > end:
+                return
+            headers = {"Range": f"bytes={start + done}-{end}"}
+            with self.session.get(url, headers=headers, stream=True, timeout=self._timeout(deadline)) as response:
+                if response.status_code != 206:
+                    raise DownloadError(f"Rangeリクエストが拒否されました (HTTP {response.status_code})")
+                with open(part_path, "r+b") as f:
+                    f.seek(start + done)
+                    for chunk in response.iter_content(chunk_size=self.chunk_size):
+                        deadline.check()
+                        f.write(chunk)
+                        # 書き込み済みの分だけを進捗として記録（保存した進捗より手前のデータは必ずディスク上にある）
+                        f.flush()
+                        with lock:
+                            segment[2] += len(chunk)
+                            if time.monotonic() - last_saved[0] >= STATE_SAVE_INTERVAL:
+                                self._save_state(state_path, state)
+                                last_saved[0] = time.monotonic()
+        
+        executor = self._get_segment_executor()
+        futures = [executor.submit(fetch, segment) for segment in state["segments"]]
+        errors = []
+        cancelled = None
+        for future in futures:
+            try:
+                future.result()
+            except (requests.RequestException, DownloadError) as e:
+                errors.append(e)
+            except Cancelled as e:
+                cancelled = e
+        if cancelled is not None:
+            raise cancelled
+        
+        # 進捗を保存して次回はそこから再開
+        self._save_state(state_path, state)
+        if errors:
+            raise DownloadError(f"セグメントのダウンロードに失敗しました ({url}): {errors[0]}")
+        
+        # .partは事前に全体サイズへ拡張しているため、サイズ比較では短いセグメント（ゼロ埋めの穴）を検出できない
+        short = [segment for segment in state["segments"] if segment[2] != segment[1] - segment[0] + 1]
+        if short:
+            start, end, done = short[0]
+            raise DownloadError(f"セグメントが不完全です: bytes {start}-{end} のうち {done} bytes ({url})")
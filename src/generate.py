@@ -6,50 +6,107 @@ Kamui Code, 3JS, Blender MCPを連携してクリエイティブ作品を生成
 
 import os
 import sys
+import time
+import signal
 import argparse
 import json
+import threading
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, wait
 from mcp_safety import safety_controller, require_kamui_mcp, allow_other_mcp
-from kamui_client import KamuiMCPClient
+from batch import load_batch_items, run_jobs
+from daemon import KamuiDaemon, default_socket_path, submit_job, stop_daemon
+from postprocess import PostProcessor
+from asset_manifest import AssetManifest, parse_date
+from blob_store import BlobStore, default_blob_dir
+from deadline import Deadline, Cancelled, current_deadline, deadline_scope, cancel_on_signals
+from job_store import JobStore
+from workflow_executor import load_workflow, WorkflowExecutor
+from tracing import get_logger, configure_logging, tracer, LOG_LEVELS
+
+logger = get_logger(__name__)
+
+# 生成物の出力先サブディレクトリ
+OUTPUT_SUBDIRS = ("images", "videos", "audio", "3d")
 
 def setup_environment():
     """環境設定とパスの準備"""
     project_root = Path(__file__).parent.parent
-    outputs_dir = project_root / "outputs"
+    outputs_dir = Path(os.getenv("KAMUI_OUTPUTS_DIR") or project_root / "outputs")
     
     # 出力ディレクトリを作成
-    for subdir in ["images", "videos", "audio", "3d"]:
+    for subdir in OUTPUT_SUBDIRS:
         (outputs_dir / subdir).mkdir(parents=True, exist_ok=True)
     
     return project_root, outputs_dir
 
-# グローバルKamuiクライアント
-kamui_client = KamuiMCPClient()
+# 3Dシーンが実際に消費する素材タイプ（シーンはこれらの完了のみを待つ）
+SCENE_INPUT_TYPES = ("3d", "image")
+
+# --type all の生成順序（結果はこの順序で収集）
+GENERATION_ORDER = ("image", "video", "music", "3d")
+
+# 呼び出し元のカレントディレクトリ基準のパス引数（デーモンへ送る前に絶対パス化）
+PATH_ARGUMENTS = ("batch", "batch_output", "workflow", "trace")
+
+# CLIオプションで変更されるクライアント設定（デーモンではジョブ後に元へ戻す）
+CLIENT_OPTION_ATTRIBUTES = ("transport", "session_batch_size", "hedge", "call_timeout", "pool_size", "cache_mode",
+                            "postprocess", "tier")
+
+# グローバルKamuiクライアント（初回使用時に作成。デーモンへ送るだけの実行では作らない）
+_kamui_client = None
+_kamui_client_lock = threading.Lock()
+
+def get_kamui_client():
+    """共有Kamuiクライアントを取得（なければ作成）"""
+    global _kamui_client
+    if _kamui_client is None:
+        with _kamui_client_lock:
+            if _kamui_client is None:
+                # requests等の読み込みもデーモンへ送るだけの実行では不要なため、ここで読み込む
+                from kamui_client import KamuiMCPClient
+                _kamui_client = KamuiMCPClient()
+    return _kamui_client
+
+def close_kamui_client():
+    """作成済みの共有Kamuiクライアントを閉じる"""
+    if _kamui_client is not None:
+        _kamui_client.close()
 
 @require_kamui_mcp
-def generate_image(prompt, style="photorealistic"):
+def generate_image(prompt, style="photorealistic", **options):
     """Kamui Code MCPで画像生成（Kamui必須）"""
-    return kamui_client.generate_image(prompt, style=style)
+    return get_kamui_client().generate_image(prompt, style=style, **options)
 
 @require_kamui_mcp
-def generate_video(prompt, duration=5):
+def generate_video(prompt, duration=5, **options):
     """Kamui Code MCPで動画生成（Kamui必須）"""
-    return kamui_client.generate_video(prompt, duration=duration)
+    return get_kamui_client().generate_video(prompt, duration=duration, **options)
 
 @require_kamui_mcp
-def generate_music(prompt, duration=30):
+def generate_music(prompt, duration=30, **options):
     """Kamui Code MCPで音楽生成（Kamui必須）"""
-    return kamui_client.generate_music(prompt, duration=duration)
+    return get_kamui_client().generate_music(prompt, duration=duration, **options)
 
 @require_kamui_mcp
-def generate_3d_model(prompt, complexity="medium"):
+def generate_3d_model(prompt, complexity="medium", **options):
     """Kamui Code MCPで3Dモデル生成（Kamui必須）"""
-    return kamui_client.generate_3d_model(prompt, complexity=complexity)
+    return get_kamui_client().generate_3d_model(prompt, complexity=complexity, **options)
+
+@require_kamui_mcp
+def image_to_video(image_path, motion_prompt="gentle movement", **options):
+    """Kamui Code MCPで画像から動画生成（Kamui必須）"""
+    return get_kamui_client().image_to_video(image_path, motion_prompt=motion_prompt, **options)
+
+@require_kamui_mcp
+def image_to_3d(image_path, **options):
+    """Kamui Code MCPで画像から3Dモデル生成（Kamui必須）"""
+    return get_kamui_client().image_to_3d(image_path, **options)
 
 @allow_other_mcp
 def create_3d_scene(assets, scene_config):
     """3JS MCPで3Dシーン作成（他MCP使用OK）"""
-    print(f"Creating 3D scene with {len(assets)} assets")
+    logger.info(f"Creating 3D scene with {len(assets)} assets")
     
     # 3JS MCP呼び出し（実装予定）
     
@@ -58,67 +115,534 @@ def create_3d_scene(assets, scene_config):
 @allow_other_mcp
 def process_with_blender(model_path, operations):
     """Blender MCPで3D処理（他MCP使用OK）"""
-    print(f"Processing 3D model: {model_path}")
-    print(f"Operations: {operations}")
+    logger.info(f"Processing 3D model: {model_path}")
+    logger.info(f"Operations: {operations}")
     
     # Blender MCP呼び出し（実装予定）
     
     return "outputs/3d/processed_model.blend"
 
+def workflow_operations():
+    """ワークフローのopとして使える操作"""
+    return {
+        "generate_image": generate_image,
+        "generate_video": generate_video,
+        "generate_music": generate_music,
+        "generate_3d_model": generate_3d_model,
+        "image_to_video": image_to_video,
+        "image_to_3d": image_to_3d,
+        "create_3d_scene": create_3d_scene,
+        "process_with_blender": process_with_blender,
+    }
+
+def run_workflow_mode(args, outputs_dir):
+    """--workflow: DAGワークフローを実行"""
+    variables = {"prompt": args.prompt}
+    for item in args.var or []:
+        key, sep, value = item.partition("=")
+        if not sep:
+            logger.error(f"❌ Invalid --var (expected KEY=VALUE): {item}")
+            sys.exit(1)
+        variables[key] = value
+    
+    try:
+        workflow = load_workflow(args.workflow)
+        executor = WorkflowExecutor(
+            workflow,
+            workflow_operations(),
+            state_path=outputs_dir / ".cache" / "workflow_nodes.json",
+            max_parallel=args.max_parallel,
+            variables=variables,
+        )
+    except Exception as e:
+        logger.error(f"❌ Workflow error: {e}")
+        sys.exit(1)
+    
+    logger.info(f"🧩 Workflow: {workflow['name']} ({len(executor.nodes)} nodes, max parallel: {args.max_parallel})")
+    results = executor.run()
+    
+    failed = [node_id for node_id, result in results.items() if result["status"] in ("failed", "skipped")]
+    logger.info(f"✅ Workflow finished: {len(results) - len(failed)} ok, {len(failed)} failed/skipped")
+    for node_id, result in results.items():
+        logger.info(f"  📄 {node_id} [{result['status']}]: {result['output']}")
+    if failed:
+        sys.exit(2)
+
+def build_generation_tasks(content_type, prompt):
+    """生成タイプに応じたタスク一覧を作成（GENERATION_ORDER順）"""
+    generators = {
+        "image": generate_image,
+        "video": generate_video,
+        "music": generate_music,
+        "3d": generate_3d_model,
+    }
+    
+    tasks = []
+    for asset_type in GENERATION_ORDER:
+        if content_type in [asset_type, "all"]:
+            tasks.append((asset_type, generators[asset_type], prompt))
+    return tasks
+
+def run_generation(content_type, prompt, max_parallel=1):
+    """独立した生成を並列実行し、結果を決定的な順序で返す（1つが失敗したら残りも中断）"""
+    tasks = build_generation_tasks(content_type, prompt)
+    max_parallel = max(1, min(max_parallel, len(tasks) or 1))
+    group = current_deadline().child(name="generation")
+    all_futures = []
+    
+    def run_branch(name, func, *func_args):
+        try:
+            return group.run(func, *func_args)
+        except Cancelled:
+            raise
+        except Exception as e:
+            # 失敗した枝があれば、残りの枝のclaude呼び出し・ダウンロードも止める
+            group.cancel(f"{name} failed: {e}")
+            raise
+    
+    try:
+        with ThreadPoolExecutor(max_workers=max_parallel, thread_name_prefix="generate") as executor:
+            futures = {asset_type: executor.submit(run_branch, asset_type, func, task_prompt)
+                       for asset_type, func, task_prompt in tasks}
+            
+            scene_future = None
+            if "3d" in futures:
+                # 3Dシーンは消費する素材だけを待ち、他の生成とは並行して作成
+                scene_inputs = [futures[asset_type] for asset_type in GENERATION_ORDER
+                                if asset_type in SCENE_INPUT_TYPES and asset_type in futures]
+                if not any(future.exception() for future in scene_inputs):
+                    scene_future = executor.submit(run_branch, "scene", create_3d_scene,
+                                                   [future.result() for future in scene_inputs], {"lighting": "ambient"})
+            
+            all_futures = [futures[asset_type] for asset_type, _, _ in tasks]
+            if scene_future is not None:
+                all_futures.append(scene_future)
+            wait(all_futures)
+    finally:
+        group.detach()
+    
+    # 巻き添えで中断された枝ではなく、最初の原因となったエラーを送出
+    errors = [future.exception() for future in all_futures if future.exception() is not None]
+    if errors:
+        raise next((error for error in errors if not isinstance(error, Cancelled)), errors[0])
+    return [future.result() for future in all_futures]
+
+def run_batch_mode(args, outputs_dir, stdout=None):
+    """--batch / --resume: ジョブストア経由でワーカープール生成（中断後は未完了分のみ再開）"""
+    store = JobStore(outputs_dir / ".jobs.db")
+    batch = None
+    
+    if args.batch:
+        default_type = args.type if args.type != "all" else "image"
+        try:
+            items = load_batch_items(args.batch, default_type=default_type)
+        except Exception as e:
+            logger.error(f"❌ Batch file error: {e}")
+            sys.exit(1)
+        batch = str(Path(args.batch).resolve())
+        store.enqueue(batch, items, reset=not args.resume)
+        logger.info(f"📦 Batch: {len(items)} items from {args.batch} (max parallel: {args.max_parallel})")
+    
+    if args.resume:
+        recovered = store.recover_stale(batch)
+        counts = store.counts(batch)
+        logger.info(f"🔁 Resume: {counts['queued']} queued, {counts['done']} done, "
+                    f"{counts['failed']} failed ({recovered} interrupted jobs requeued)")
+    
+    run_kwargs = {"batch": batch, "max_workers": args.max_parallel, "retry_failed": args.resume}
+    if args.batch_output == "-":
+        summary = run_jobs(get_kamui_client(), store, output=stdout or sys.stdout, **run_kwargs)
+    else:
+        stem = Path(args.batch).stem if args.batch else "resume"
+        output_path = Path(args.batch_output) if args.batch_output else \
+            outputs_dir / "batch" / f"{stem}_results.jsonl"
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(output_path, "a" if args.resume else "w", encoding="utf-8") as output:
+            summary = run_jobs(get_kamui_client(), store, output=output, **run_kwargs)
+        logger.info(f"📄 Results: {output_path}")
+    
+    counts = store.counts(batch)
+    store.close()
+    logger.info(f"✅ Batch finished: {summary['ok']} ok, {summary['failed']} failed in this run "
+                f"(store: {counts['done']} done, {counts['failed']} failed, {counts['queued'] + counts['running']} pending)")
+    if counts["failed"] or summary["failed"]:
+        sys.exit(2)
+
 def main():
     parser = argparse.ArgumentParser(description="Creative Factory Content Generator")
-    parser.add_argument("--type", choices=["image", "video", "music", "3d", "all"], 
-                       default="image", help="Content type to generate")
+    parser.add_argument("command", nargs="?", choices=["serve", "stop", "postprocess", "query", "gc", "promote"],
+                       help="serve: keep the client warm and accept jobs over a Unix socket; stop: stop the daemon; "
+                            "postprocess: create derivatives for existing outputs; query: search generated assets; "
+                            "gc: deduplicate outputs into the blob store and delete unreferenced blobs; "
+                            "promote: regenerate draft outputs at final quality with the same prompt and seed")
+    parser.add_argument("terms", nargs="*",
+                       help="query: words that must all appear in the prompt; promote: paths of draft outputs")
+    parser.add_argument("--type", choices=["image", "video", "music", "3d", "all"],
+                       help="Content type to generate (default: image; for query: filter by type)")
     parser.add_argument("--prompt", default="Beautiful landscape", help="Generation prompt")
     parser.add_argument("--output", help="Output filename")
+    parser.add_argument("--max-parallel", type=int, default=4,
+                       help="Maximum number of concurrent generations (1 = sequential)")
+    parser.add_argument("--batch", help="Batch file (JSONL or CSV) with one prompt per item")
+    parser.add_argument("--batch-output",
+                       help="JSONL result file for --batch (default: outputs/batch/<name>_results.jsonl, '-' for stdout)")
+    parser.add_argument("--resume", action="store_true",
+                       help="Resume unfinished batch jobs from outputs/.jobs.db (retries failed jobs up to KAMUI_JOB_MAX_ATTEMPTS)")
+    parser.add_argument("--no-cache", action="store_true", help="Disable the generation cache")
+    parser.add_argument("--refresh", action="store_true",
+                       help="Ignore cached results and regenerate (new results are still cached)")
+    parser.add_argument("--transport", choices=["auto", "http", "claude"],
+                       help="MCP transport: direct HTTP, claude subprocess, or HTTP with claude fallback (default: auto)")
+    parser.add_argument("--claude-pool", type=int, metavar="N",
+                       help="Keep N warm claude worker processes instead of one process per call (0 = off)")
+    parser.add_argument("--route-policy", choices=["fastest", "cheapest", "round_robin"],
+                       help="How to choose between equivalent MCP servers (default: fastest)")
+    parser.add_argument("--session-batch", type=int, metavar="N",
+                       help="With --transport claude, generate up to N compatible image/music batch items in one session")
+    parser.add_argument("--hedge", action="store_true",
+                       help="Send a duplicate request to an equivalent server when a call exceeds that server's p95 latency")
+    parser.add_argument("--call-timeout", type=float,
+                       help="Seconds before a claude call is killed (default: KAMUI_CALL_TIMEOUT or 900)")
+    parser.add_argument("--tier", choices=["draft", "final"],
+                       help="draft: fast servers, low resolution, short duration and low fps for iteration; "
+                            "final: full quality (default: KAMUI_TIER or final)")
+    parser.add_argument("--postprocess", action="store_true",
+                       help="Create thumbnails, WebP/AVIF previews, texture mips and video posters after download")
+    parser.add_argument("--workflow", help="Workflow file (YAML/JSON) declaring nodes and dependencies")
+    parser.add_argument("--var", action="append", metavar="KEY=VALUE",
+                       help="Workflow variable, referenced as ${vars.KEY} (repeatable)")
+    parser.add_argument("--log-level", choices=LOG_LEVELS,
+                       help="Log verbosity (default: KAMUI_LOG_LEVEL or info)")
+    parser.add_argument("--profile", action="store_true",
+                       help="Record a trace and print per-stage p50/p95 timings by operation and server")
+    parser.add_argument("--trace", metavar="PATH",
+                       help="Write span trace as JSONL (Chrome trace events; a .json for Perfetto is written alongside)")
+    parser.add_argument("--timeout", type=float, metavar="SECONDS",
+                       help="Deadline for the whole job; running claude processes are killed and partial downloads "
+                            "removed when it passes (default: KAMUI_JOB_TIMEOUT or none; per-stage budgets: KAMUI_BUDGET_<STAGE>)")
+    parser.add_argument("--no-daemon", action="store_true",
+                       help="Run in this process even when a 'serve' daemon is running")
+    parser.add_argument("--since", help="query: created on/after this date (YYYY-MM-DD or ISO 8601)")
+    parser.add_argument("--until", help="query: created before this date (YYYY-MM-DD or ISO 8601)")
+    parser.add_argument("--limit", type=int, default=50, help="query: maximum number of results")
+    parser.add_argument("--json", action="store_true", help="query: print one JSON object per asset")
+    parser.add_argument("--dry-run", action="store_true", help="gc: report what would be removed without changing files")
     parser.add_argument("--list-operations", action="store_true", help="List all available operations")
     
     args = parser.parse_args()
     
+    # --batch-output - のときはJSONLとログが混ざらないようログをstderrへ
+    output_stream = sys.stderr if args.batch_output == "-" else sys.stdout
+    configure_logging(args.log_level, stream=output_stream)
+    
     if args.list_operations:
         safety_controller.list_allowed_operations()
         return
     
-    # 安全性チェックを最初に実行
-    print("🔒 Checking Kamui Code MCP availability...")
+    if args.command == "query":
+        run_query_command(args)
+        return
+    
+    if args.terms and args.command != "promote":
+        parser.error("search terms are only accepted by the query command")
+    if args.command == "promote" and not args.terms:
+        parser.error("promote needs the paths of draft outputs (find them with 'query')")
+    args.type = args.type or "image"
+    
+    if args.command == "stop":
+        if stop_daemon(default_socket_path()):
+            logger.info("🛑 Daemon stopped")
+        else:
+            logger.info("ℹ️ No daemon running")
+        return
+    
+    # デーモンが起動していればジョブを送り、進捗を中継するだけ（クライアントの作成・設定確認を省略）
+    # Ctrl-C / SIGTERM はデーモン側のジョブのキャンセルとして転送
+    if args.command is None and not args.no_daemon:
+        try:
+            with cancel_on_signals(Deadline(name="daemon job")):
+                code = submit_job(default_socket_path(), daemon_request_args(args), stdout=sys.stdout,
+                                  log_stream=output_stream, log_level=args.log_level or os.getenv("KAMUI_LOG_LEVEL"))
+        except KeyboardInterrupt:
+            logger.warning("🛑 Cancelled: asked the daemon to stop the job")
+            sys.exit(130)
+        if code is not None:
+            sys.exit(code)
+    
+    project_root, outputs_dir = setup_environment()
+    
+    if args.command == "serve":
+        try:
+            run_serve(args, outputs_dir)
+        finally:
+            close_kamui_client()
+        return
+    
+    if args.command == "postprocess":
+        run_postprocess_command(outputs_dir)
+        return
+    
+    if args.command == "gc":
+        run_gc_command(args, outputs_dir)
+        return
+    
+    if args.command == "promote":
+        try:
+            run_promote_command(args)
+        finally:
+            close_kamui_client()
+        return
+    
+    # Ctrl-C / SIGTERM（CIの中断）はジョブの期限をキャンセルし、claudeプロセスと途中のダウンロードを片付けてから終了
+    start_tracing(args, outputs_dir)
+    job = Deadline(job_timeout(args))
+    try:
+        with cancel_on_signals(job), deadline_scope(job), tracer.span("run", mode=run_mode(args)):
+            run_cli(args, outputs_dir)
+    except KeyboardInterrupt:
+        logger.warning(f"🛑 Cancelled ({job.reason or 'interrupted'}): stopped claude processes and removed partial downloads")
+        sys.exit(130)
+    finally:
+        close_kamui_client()
+        finish_tracing(args, lambda text: print(text, file=output_stream))
+
+def job_timeout(args):
+    """ジョブ全体の期限（秒、なければNone）"""
+    return getattr(args, "timeout", None) or float(os.getenv("KAMUI_JOB_TIMEOUT", "0")) or None
+
+def run_mode(args):
+    return "batch" if args.batch or args.resume else "workflow" if args.workflow else "generate"
+
+def start_tracing(args, outputs_dir):
+    """--profile / --trace: スパン計測を開始"""
+    if args.profile or args.trace:
+        trace_path = Path(args.trace) if args.trace else \
+            outputs_dir / "traces" / f"trace-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.jsonl"
+        tracer.start(trace_path)
+
+def finish_tracing(args, console):
+    """トレースを書き出し、--profile ならステージ別集計をconsoleへ出力"""
+    chrome_path = tracer.close()
+    if chrome_path is not None:
+        logger.info(f"🧭 Trace: {tracer.path} (Chrome/Perfetto: {chrome_path})")
+    if args.profile:
+        console("\n⏱️ Profile (per stage, operation and server):")
+        console(tracer.format_summary())
+
+def daemon_request_args(args):
+    """デーモンへ送る引数（パスは呼び出し元のカレントディレクトリ基準で絶対パス化）"""
+    request_args = vars(args).copy()
+    for name in PATH_ARGUMENTS:
+        value = request_args.get(name)
+        if value and value != "-":
+            request_args[name] = str(Path(value).resolve())
+    return request_args
+
+def apply_client_options(client, args):
+    """CLIオプションをクライアント設定に反映"""
+    if args.transport:
+        client.transport = args.transport
+    
+    if args.session_batch is not None:
+        client.session_batch_size = args.session_batch
+    
+    if args.hedge:
+        client.hedge = True
+    
+    if args.call_timeout:
+        client.call_timeout = args.call_timeout
+    
+    if args.route_policy:
+        client.router.policy = args.route_policy
+    
+    if args.claude_pool is not None:
+        client.pool_size = args.claude_pool
+    
+    if args.postprocess:
+        client.postprocess = True
+    
+    if args.tier:
+        client.tier = args.tier
+    
+    if args.no_cache:
+        client.cache_mode = "off"
+    elif args.refresh:
+        client.cache_mode = "refresh"
+
+def snapshot_client_options(client):
+    options = {name: getattr(client, name) for name in CLIENT_OPTION_ATTRIBUTES}
+    options["route_policy"] = client.router.policy
+    return options
+
+def restore_client_options(client, options):
+    for name in CLIENT_OPTION_ATTRIBUTES:
+        setattr(client, name, options[name])
+    client.router.policy = options["route_policy"]
+
+def run_serve(args, outputs_dir):
+    """serve: クライアント・設定・接続プール・キャッシュを常駐させ、ソケット経由のジョブを1件ずつ実行"""
     try:
         safety_controller.verify_kamui_mcp_available()
-        print("✅ Kamui Code MCP ready")
     except Exception as e:
-        print(f"❌ Kamui Code MCP error: {e}")
+        logger.error(f"❌ Kamui Code MCP error: {e}")
         sys.exit(1)
     
-    project_root, outputs_dir = setup_environment()
+    # serve に渡したオプションがデーモンの既定値（ジョブごとのオプションはジョブ後に戻す）
+    client = get_kamui_client()
+    apply_client_options(client, args)
+    defaults = snapshot_client_options(client)
+    
+    def run_job(request_args, job):
+        job_args = argparse.Namespace(**request_args)
+        tracer.reset()
+        start_tracing(job_args, outputs_dir)
+        try:
+            # 接続元の中断・切断でキャンセルされる期限の内側で、ジョブの持ち時間を適用
+            deadline = job.deadline.child(job_timeout(job_args), name="job")
+            with deadline_scope(deadline), tracer.span("run", mode=run_mode(job_args)):
+                run_cli(job_args, outputs_dir, stdout=job.stdout)
+            return 0
+        except SystemExit as e:
+            return e.code if isinstance(e.code, int) else int(bool(e.code))
+        except Cancelled as e:
+            logger.warning(f"🛑 Job cancelled: {e}")
+            return 130
+        except Exception as e:
+            logger.error(f"❌ Job failed: {e}")
+            return 1
+        finally:
+            client.wait_postprocessing()
+            restore_client_options(client, defaults)
+            finish_tracing(job_args, job.log)
+            tracer.reset()
+    
+    daemon = KamuiDaemon(default_socket_path(), run_job)
+    signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        logger.error(f"❌ Daemon error: {e}")
+        sys.exit(1)
+
+def run_postprocess_command(outputs_dir):
+    """postprocess: 既存の生成物の派生ファイルを作成（前回から変わっていないファイルはスキップ）"""
+    paths = [path for subdir in OUTPUT_SUBDIRS for path in sorted((outputs_dir / subdir).iterdir())
+             if path.is_file()]
+    processor = PostProcessor(outputs_dir)
+    try:
+        summary = processor.process_all(paths)
+    finally:
+        processor.close()
+    logger.info(f"🖼️ Post-processing: {summary['processed']} done, {summary['skipped']} up to date or not media, "
+                f"{summary['unsupported']} skipped (missing tools), {summary['failed']} failed "
+                f"→ {processor.derived_dir}")
+    if summary["failed"]:
+        sys.exit(2)
+
+def run_gc_command(args, outputs_dir):
+    """gc: outputs/ の同じ内容のファイルをブロブへのリンクにまとめ、どこからも参照されないブロブを削除"""
+    store = BlobStore(default_blob_dir(outputs_dir))
+    roots = [outputs_dir / subdir for subdir in OUTPUT_SUBDIRS]
     
-    print(f"🎨 Creative Factory - Generating {args.type} content...")
-    print(f"📝 Prompt: {args.prompt}")
+    deduplicated = 0
+    if not args.dry_run:
+        for root in roots:
+            for path in sorted(root.rglob("*")):
+                # 隠しファイル・ダウンロード途中のファイルは対象外
+                if path.name.startswith(".") or path.name.endswith((".part", ".part.json")):
+                    continue
+                deduplicated += store.adopt(path)
     
-    generated_files = []
+    summary = store.gc(roots + [outputs_dir / ".cache"], dry_run=args.dry_run)
+    action = "would remove" if args.dry_run else "removed"
+    logger.info(f"🧹 Blobs: {summary['blobs']} total, {action} {summary['removed']} unreferenced "
+                f"({summary['freed_bytes'] / 1024 / 1024:.1f} MB); duplicates linked: {deduplicated / 1024 / 1024:.1f} MB")
+
+def run_promote_command(args):
+    """promote: draft の生成物を同じプロンプト・シードで final として作り直す"""
+    try:
+        safety_controller.verify_kamui_mcp_available()
+    except Exception as e:
+        logger.error(f"❌ Kamui Code MCP error: {e}")
+        sys.exit(1)
     
-    if args.type in ["image", "all"]:
-        image_file = generate_image(args.prompt)
-        generated_files.append(image_file)
+    client = get_kamui_client()
+    apply_client_options(client, args)
+    failed = 0
+    for path in args.terms:
+        try:
+            result = client.promote(path, output_name=args.output if len(args.terms) == 1 else None)
+            logger.info(f"  📄 {path} → {result['path']}")
+        except Exception as e:
+            failed += 1
+            logger.error(f"❌ Promote failed: {e}")
+    if failed:
+        sys.exit(2)
+
+def run_query_command(args):
+    """query: 生成物の索引をプロンプト・タイプ・日付で検索（ディレクトリは走査しない）"""
+    _, outputs_dir = setup_environment()
+    manifest = AssetManifest(outputs_dir / ".assets.db")
+    try:
+        rows = manifest.query(
+            text=" ".join(args.terms),
+            asset_type=args.type if args.type != "all" else None,
+            since=parse_date(args.since) if args.since else None,
+            until=parse_date(args.until) if args.until else None,
+            limit=args.limit,
+        )
+    except Exception as e:
+        logger.error(f"❌ Query error: {e}")
+        sys.exit(1)
+    finally:
+        manifest.close()
     
-    if args.type in ["video", "all"]:
-        video_file = generate_video(args.prompt)
-        generated_files.append(video_file)
+    for row in rows:
+        if args.json:
+            print(json.dumps(row, ensure_ascii=False))
+        else:
+            created = time.strftime("%Y-%m-%d %H:%M", time.localtime(row["created_at"]))
+            print(f"{created}  {row['type']:<5} {row['bytes'] or 0:>10,}  {row['path']}")
+            tier = " draft" if row["params"].get("tier") == "draft" else ""
+            print(f"    {row['prompt'] or '-'}  [{row['server'] or '-'}, {row['call_seconds'] or 0:.1f}s{tier}]")
+    if not args.json:
+        logger.info(f"🔎 {len(rows)} assets")
+
+def run_cli(args, outputs_dir, stdout=None):
+    """安全性チェック後、引数に応じたモードで生成を実行"""
+    # 安全性チェックを最初に実行
+    logger.info("🔒 Checking Kamui Code MCP availability...")
+    try:
+        safety_controller.verify_kamui_mcp_available()
+        logger.info("✅ Kamui Code MCP ready")
+    except Exception as e:
+        logger.error(f"❌ Kamui Code MCP error: {e}")
+        sys.exit(1)
+    
+    apply_client_options(get_kamui_client(), args)
+    
+    if args.batch or args.resume:
+        run_batch_mode(args, outputs_dir, stdout=stdout)
+        return
+    
+    if args.workflow:
+        run_workflow_mode(args, outputs_dir)
+        return
     
-    if args.type in ["music", "all"]:
-        music_file = generate_music(args.prompt)
-        generated_files.append(music_file)
+    logger.info(f"🎨 Creative Factory - Generating {args.type} content...")
+    logger.info(f"📝 Prompt: {args.prompt}")
     
-    if args.type in ["3d", "all"]:
-        # 3Dモデル生成（Kamui必須）+ 3Dシーン作成（他MCP OK）
-        model_file = generate_3d_model(args.prompt)
-        generated_files.append(model_file)
-        
-        # 生成した素材を組み合わせて3Dシーン作成
-        scene_file = create_3d_scene(generated_files, {"lighting": "ambient"})
-        generated_files.append(scene_file)
+    try:
+        generated_files = run_generation(args.type, args.prompt, max_parallel=args.max_parallel)
+    except Exception as e:
+        logger.error(f"❌ Generation failed: {e}")
+        sys.exit(1)
     
-    print(f"✅ Generated {len(generated_files)} files:")
+    logger.info(f"✅ Generated {len(generated_files)} files:")
     for file in generated_files:
-        print(f"  📄 {file}")
+        logger.info(f"  📄 {file}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
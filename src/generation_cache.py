@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Generation Cache - 生成結果のコンテンツアドレス型キャッシュ
+"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+from pathlib import Path
+from tracing import get_logger
+
+logger = get_logger(__name__)
+
+# デフォルトのキャッシュ上限
+DEFAULT_MAX_BYTES = int(float(os.getenv("KAMUI_CACHE_MAX_MB", "2048")) * 1024 * 1024)
+DEFAULT_MAX_AGE_DAYS = float(os.getenv("KAMUI_CACHE_MAX_AGE_DAYS", "30"))
+
+def cache_key(operation, params, server=None):
+    """(操作, パラメータ, 対象サーバー) から安定したダイジェストを作成"""
+    payload = {
+        "operation": operation,
+        "params": params,
+        "server": server or "auto",
+    }
+    canonical = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+def file_digest(path, chunk_size=1024 * 1024):
+    """ファイル内容のSHA-256ダイジェスト"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def link_or_copy(source, destination):
+    """ハードリンクを作成（別デバイス等で失敗した場合はコピー）"""
+    destination = Path(destination)
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = destination.with_name(f".{destination.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        os.link(source, tmp_path)
+    except OSError:
+        shutil.copy2(source, tmp_path)
+    os.replace(tmp_path, destination)
+    return destination
+
+class GenerationCache:
+    """生成物キャッシュ（インデックスはJSON、実体はハードリンクで保持）"""
+    
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES, max_age_days=DEFAULT_MAX_AGE_DAYS):
+        self.cache_dir = Path(cache_dir)
+        self.objects_dir = self.cache_dir / "objects"
+        self.index_path = self.cache_dir / "index.json"
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_days * 24 * 3600
+        self._lock = threading.Lock()
+    
+    def _load_index(self):
+        if not self.index_path.exists():
+            return {}
+        try:
+            with open(self.index_path, "r") as f:
+                return json.load(f)
+        except (json.JSONDecodeError, OSError):
+            logger.warning(f"⚠️ キャッシュインデックスが壊れているため再作成します: {self.index_path}")
+            return {}
+    
+    def _save_index(self, index):
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.index_path.with_name(f".index.{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(index, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.index_path)
+    
+    def lookup(self, key):
+        """キャッシュを検索（ヒット時はエントリを返す）"""
+        with self._lock:
+            index = self._load_index()
+            entry = index.get(key)
+            if entry is None:
+                return None
+            
+            object_path = self.cache_dir / entry["object"]
+            expired = time.time() - entry["created_at"] > self.max_age_seconds
+            if expired or not object_path.exists():
+                self._remove_entry(index, key)
+                self._save_index(index)
+                return None
+            
+            entry["last_used_at"] = time.time()
+            self._save_index(index)
+            return dict(entry, object_path=str(object_path))
+    
+    def materialize(self, entry, output_path):
+        """キャッシュ済みの実体を出力パスへ配置"""
+        output_path = Path(output_path)
+        object_path = Path(entry["object_path"])
+        if output_path.exists() and os.path.samefile(output_path, object_path):
+            return str(output_path)
+        link_or_copy(object_path, output_path)
+        return str(output_path)
+    
+    def store(self, key, artifact_path, url=None, operation=None):
+        """生成物をキャッシュに登録"""
+        artifact_path = Path(artifact_path)
+        if not artifact_path.exists():
+            return None
+        
+        object_name = f"objects/{key}{artifact_path.suffix}"
+        link_or_copy(artifact_path, self.cache_dir / object_name)
+        
+        now = time.time()
+        with self._lock:
+            index = self._load_index()
+            index[key] = {
+                "object": object_name,
+                "operation": operation,
+                "url": url,
+                "size": artifact_path.stat().st_size,
+                "created_at": now,
+                "last_used_at": now,
+            }
+            self._evict(index)
+            self._save_index(index)
+        return key
+    
+    def _remove_entry(self, index, key):
+        entry = index.pop(key, None)
+        if entry is not None:
+            try:
+                (self.cache_dir / entry["object"]).unlink()
+            except FileNotFoundError:
+                pass
+    
+    def _evict(self, index):
+        """期限切れ→LRU順で上限サイズまで削除"""
+        now = time.time()
+        for key in [k for k, e in index.items() if now - e["created_at"] > self.max_age_seconds]:
+            self._remove_entry(index, key)
+        
+        total = sum(entry["size"] for entry in index.values())
+        for key in sorted(index, key=lambda k: index[k]["last_used_at"]):
+            if total <= self.max_bytes:
+                break
+            total -= index[key]["size"]
+            self._remove_entry(index, key)
+    
+    def evict(self):
+        """エビクションを手動実行"""
+        with self._lock:
+            index = self._load_index()
+            self._evict(index)
+            self._save_index(index)
+            return len(index)
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+Job Store - SQLiteによる永続ジョブキュー（クラッシュ後の再開・複数プロセスでの取得に対応）
+"""
+
+import os
+import json
+import time
+import socket
+import sqlite3
+import threading
+from pathlib import Path
+
+# ジョブ状態
+JOB_STATES = ("queued", "running", "done", "failed")
+
+# 失敗ジョブを --resume で再試行する上限回数
+DEFAULT_MAX_ATTEMPTS = int(os.getenv("KAMUI_JOB_MAX_ATTEMPTS", "3"))
+
+# running のまま放置されたジョブを回収するまでの秒数（所有プロセスの生存を確認できない場合）
+DEFAULT_LEASE_SECONDS = float(os.getenv("KAMUI_JOB_LEASE_SECONDS", "1800"))
+
+# まとめて取得する際に走査する未完了ジョブの最大件数
+CLAIM_SCAN_ROWS = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    batch TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    payload TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease_expires REAL,
+    result_path TEXT,
+    result TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (state, batch, seq);
+"""
+
+def worker_id():
+    """このプロセスを識別するワーカーID（ホスト名:PID）"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+class JobStore:
+    """ジョブの状態・試行回数・結果パスをSQLiteに保持するキュー"""
+    
+    def __init__(self, db_path, max_attempts=DEFAULT_MAX_ATTEMPTS, lease_seconds=DEFAULT_LEASE_SECONDS):
+        self.db_path = Path(db_path)
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self.worker = worker_id()
+        self._local = threading.local()
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+    
+    def _connect(self):
+        """スレッドごとの接続（sqlite3接続はスレッド間で共有しない）"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(str(self.db_path), timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return _Transaction(conn)
+    
+    def enqueue(self, batch, items, reset=False):
+        """バッチ項目を登録（既存ジョブは保持、reset=True なら queued に戻す）
+
+        reset=True でも、生存中の別プロセスが実行中（running）のジョブはそのまま残す（二重実行を防ぐ）。
+        """
+        if reset:
+            # 所有プロセスが終了した running ジョブは先に回収し、下の UPDATE で一緒に戻す
+            self.recover_stale(batch)
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            for seq, item in enumerate(items):
+                job_id = f"{batch}#{item['id']}"
+                payload = json.dumps(item, ensure_ascii=False, sort_keys=True)
+                conn.execute(
+                    "INSERT OR IGNORE INTO jobs (id, batch, seq, payload, created_at, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (job_id, batch, seq, payload, now, now))
+                if reset:
+                    conn.execute(
+                        "UPDATE jobs SET payload = ?, state = 'queued', attempts = 0, worker = NULL, "
+                        "lease_expires = NULL, result_path = NULL, result = NULL, error = NULL, updated_at = ? "
+                        "WHERE id = ? AND state != 'running'",
+                        (payload, now, job_id))
+    
+    def recover_stale(self, batch=None):
+        """所有プロセスが終了した / リース切れの running ジョブを queued に戻す"""
+        now = time.time()
+        host = socket.gethostname()
+        recovered = 0
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            query = "SELECT id, worker, lease_expires FROM jobs WHERE state = 'running'"
+            args = ()
+            if batch is not None:
+                query += " AND batch = ?"
+                args = (batch,)
+            for row in conn.execute(query, args).fetchall():
+                owner_host, _, owner_pid = (row["worker"] or "").rpartition(":")
+                if owner_host == host and owner_pid.isdigit():
+                    stale = not _pid_alive(int(owner_pid))
+                else:
+                    stale = row["lease_expires"] is None or row["lease_expires"] < now
+                if stale:
+                    conn.execute(
+                        "UPDATE jobs SET state = 'queued', worker = NULL, lease_expires = NULL, updated_at = ? "
+                        "WHERE id = ? AND state = 'running'",
+                        (now, row["id"]))
+                    recovered += 1
+        return recovered
+    
+    def claim(self, batch=None, retry_failed=False):
+        """次の未完了ジョブを1件取得して running にする（なければNone）"""
+        jobs = self.claim_many(batch=batch, retry_failed=retry_failed)
+        return jobs[0] if jobs else None
+    
+    def claim_many(self, batch=None, retry_failed=False, limit=1, group_key=None):
+        """先頭の未完了ジョブと、group_key(項目) が同じジョブを最大limit件まとめて running にする
+
+        group_key がNoneを返す項目は他とまとめない。該当ジョブがなければ空リスト。
+        """
+        now = time.time()
+        conditions = ["state = 'queued'"]
+        args = []
+        if retry_failed:
+            conditions.append("(state = 'failed' AND attempts < ?)")
+            args.append(self.max_attempts)
+        query = f"SELECT id, payload, attempts FROM jobs WHERE ({' OR '.join(conditions)})"
+        if batch is not None:
+            query += " AND batch = ?"
+            args.append(batch)
+        query += " ORDER BY batch, seq LIMIT ?"
+        args.append(1 if limit <= 1 or group_key is None else CLAIM_SCAN_ROWS)
+        
+        # BEGIN IMMEDIATE で書き込みロックを先に取り、別プロセスとの二重取得を防ぐ
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute(query, args).fetchall()
+            if not rows:
+                return []
+            jobs = [{"id": row["id"], "attempts": row["attempts"] + 1, "item": json.loads(row["payload"])}
+                    for row in rows]
+            selected = jobs[:1]
+            key = group_key(jobs[0]["item"]) if group_key is not None and limit > 1 else None
+            if key is not None:
+                selected += [job for job in jobs[1:] if group_key(job["item"]) == key][:limit - 1]
+            for job in selected:
+                conn.execute(
+                    "UPDATE jobs SET state = 'running', attempts = attempts + 1, worker = ?, "
+                    "lease_expires = ?, error = NULL, updated_at = ? WHERE id = ?",
+                    (self.worker, now + self.lease_seconds, now, job["id"]))
+        return selected
+    
+    def complete(self, job_id, record):
+        """ジョブの結果を記録（record["status"] が ok なら done、それ以外は failed）"""
+        state = "done" if record.get("status") == "ok" else "failed"
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET state = ?, worker = NULL, lease_expires = NULL, result_path = ?, "
+                "result = ?, error = ?, updated_at = ? WHERE id = ?",
+                (state, record.get("path"), json.dumps(record, ensure_ascii=False), record.get("error"),
+                 time.time(), job_id))
+    
+    def counts(self, batch=None):
+        """状態ごとのジョブ数"""
+        counts = {state: 0 for state in JOB_STATES}
+        query = "SELECT state, COUNT(*) AS n FROM jobs"
+        args = ()
+        if batch is not None:
+            query += " WHERE batch = ?"
+            args = (batch,)
+        with self._connect() as conn:
+            for row in conn.execute(query + " GROUP BY state", args):
+                counts[row["state"]] = row["n"]
+        return counts
+    
+    def jobs(self, batch=None):
+        """ジョブ一覧（登録順）"""
+        query = "SELECT id, batch, state, attempts, result_path, error FROM jobs"
+        args = ()
+        if batch is not None:
+            query += " WHERE batch = ?"
+            args = (batch,)
+        with self._connect() as conn:
+            return [dict(row) for row in conn.execute(query + " ORDER BY batch, seq", args)]
+    
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+class _Transaction:
+    """autocommit接続で BEGIN ... COMMIT/ROLLBACK をまとめるコンテキスト"""
+    
+    def __init__(self, conn):
+        self.conn = conn
+    
+    def __enter__(self):
+        return self
+    
+    def execute(self, *args):
+        return self.conn.execute(*args)
+    
+    def executescript(self, script):
+        return self.conn.executescript(script)
+    
+    def __exit__(self, exc_type, exc, tb):
+        if self.conn.in_transaction:
+            if exc_type is None:
+                self.conn.execute("COMMIT")
+            else:
+                self.conn.execute("ROLLBACK")
+        return False
@@ -6,83 +6,358 @@ Kamui Code MCP Client - 実際のKamui Code MCPとの通信
 import subprocess
 import tempfile
 import os
-import re
-import requests
+import time
+import queue
+import inspect
+import threading
+import contextvars
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
-from mcp_safety import safety_controller
+from mcp_safety import safety_controller, MCPConfigIndex, OPERATION_CAPABILITIES, capability_of
+from mcp_http import MCPHttpTransport, MCPHttpError
+from mcp_router import MCPRouter
+from url_extractor import extract_urls, extract_item_urls, media_rank, RANK_EXPECTED
+from download_manager import DownloadManager
+from rate_limiter import RateLimiter, is_throttle_error
+from retry_policy import RetryPolicy, RetryableError, GenerationError, hedged_call
+from claude_pool import ClaudeWorkerPool, DEFAULT_MAX_JOBS_PER_WORKER
+from prompt_templates import render_prompt, render_session_prompt, is_batchable
+from generation_cache import GenerationCache, cache_key, file_digest
+from postprocess import PostProcessor
+from asset_manifest import AssetManifest
+from blob_store import BlobStore, default_blob_dir
+from deadline import Cancelled, current_deadline, stage, kill_process_group
+from tracing import get_logger, tracer
+
+logger = get_logger(__name__)
+
+# キャッシュモード: use=参照・保存 / refresh=保存のみ（再生成） / off=無効
+CACHE_MODES = ("use", "refresh", "off")
+
+# 通信方式: auto=HTTP直接（失敗時はclaudeへフォールバック） / http=HTTPのみ / claude=サブプロセスのみ
+TRANSPORTS = ("auto", "http", "claude")
+
+# 生成タイプ → 操作名
+ASSET_OPERATIONS = {
+    "image": "generate_image",
+    "video": "generate_video",
+    "music": "generate_music",
+    "3d": "generate_3d_model",
+}
+
+# 生成タイプ → リクエスト作成メソッド
+ASSET_REQUEST_BUILDERS = {
+    "image": "_build_image_request",
+    "video": "_build_video_request",
+    "music": "_build_music_request",
+    "3d": "_build_3d_model_request",
+}
+
+# 操作名 → リクエスト作成メソッド（promote で索引の記録から作り直す）
+OPERATION_REQUEST_BUILDERS = {
+    "generate_image": "_build_image_request",
+    "generate_video": "_build_video_request",
+    "generate_music": "_build_music_request",
+    "generate_3d_model": "_build_3d_model_request",
+    "image_to_video": "_build_image_to_video_request",
+    "image_to_3d": "_build_image_to_3d_request",
+}
+
+# 品質ティア: draft=高速サーバー・低解像度・短尺で試作 / final=本番品質
+TIERS = ("draft", "final")
+
+# draft ティアで上書きするパラメータ（数値は上限、それ以外は置き換え）
+DRAFT_PARAMS = {
+    "generate_image": {"resolution": "512px"},
+    "generate_video": {"duration": 2, "fps": 12},
+    "generate_music": {"duration": 10},
+    "generate_3d_model": {"complexity": "low"},
+    "image_to_video": {"duration": 2},
+    "image_to_3d": {"detail": "low"},
+}
+
+# draft ティアで優先するサーバー（名前にこれを含む高速版。候補になければ通常どおり選択）
+DRAFT_SERVER_HINT = "-fast"
 
 class KamuiMCPClient:
     """Kamui Code MCP通信クライアント"""
     
-    def __init__(self, config_path=None):
+    def __init__(self, config_path=None, outputs_dir=None, cache_mode="use", transport=None, pool_size=None,
+                 route_policy=None):
+        if config_path is None:
+            config_path = os.getenv("KAMUI_MCP_CONFIG")
         if config_path is None:
             # 環境に応じて設定パスを決定
             home_dir = os.path.expanduser("~")
             config_path = os.path.join(home_dir, ".claude", "mcp-kamuicode.json")
         self.config_path = config_path
+        self._config_index = MCPConfigIndex()
         self.project_root = Path(__file__).parent.parent
-        self.outputs_dir = self.project_root / "outputs"
+        if outputs_dir is None:
+            outputs_dir = os.getenv("KAMUI_OUTPUTS_DIR") or self.project_root / "outputs"
+        self.outputs_dir = Path(outputs_dir)
+        
+        # 生成結果キャッシュ
+        if cache_mode not in CACHE_MODES:
+            raise Exception(f"無効なキャッシュモード: {cache_mode}")
+        self.cache_mode = cache_mode
+        self.cache = GenerationCache(self.outputs_dir / ".cache")
+        
+        # MCP通信方式
+        if transport is None:
+            transport = os.getenv("KAMUI_TRANSPORT", "auto")
+        if transport not in TRANSPORTS:
+            raise Exception(f"無効な通信方式: {transport}")
+        self.transport = transport
+        self._http_transport = None
+        
+        # 同等サーバー間のルーティング（統計は実行をまたいで保持）
+        self.router = MCPRouter(self.outputs_dir / ".router_stats.json", policy=route_policy)
+        
+        # 常駐claudeワーカープール（0で無効 = 呼び出しごとにプロセス起動）
+        self.claude_executable = os.getenv("KAMUI_CLAUDE_BIN", "claude")
+        if pool_size is None:
+            pool_size = int(os.getenv("KAMUI_CLAUDE_POOL_SIZE", "0"))
+        self.pool_size = pool_size
+        self.pool_max_jobs = int(os.getenv("KAMUI_CLAUDE_POOL_MAX_JOBS", str(DEFAULT_MAX_JOBS_PER_WORKER)))
+        self._claude_pool = None
+        self._pool_lock = threading.Lock()
+        
+        # claude呼び出し1回あたりのタイムアウト（秒）
+        self.call_timeout = float(os.getenv("KAMUI_CALL_TIMEOUT", "900"))
+        
+        # サーバーごとのレート制限・同時実行制御と月間利用量台帳
+        self.limiter = RateLimiter(self.outputs_dir / ".usage_ledger.json")
+        
+        # 複数アセットを1セッションで生成する際の最大項目数（1で無効）
+        self.session_batch_size = int(os.getenv("KAMUI_SESSION_BATCH_SIZE", "1"))
+        
+        # 一時的なエラーの再試行と、p95超過時の同等サーバーへのヘッジ（既定は無効）
+        self.retry_policy = RetryPolicy()
+        self.hedge = os.getenv("KAMUI_HEDGE", "0") == "1"
+        
+        # 既定の品質ティア（生成メソッドの tier で個別に指定可）
+        self.tier = os.getenv("KAMUI_TIER", "final")
+        
+        # 生成物の実体（内容ダイジェスト名、outputs/ の各パスはリンク）
+        self.blobs = BlobStore(default_blob_dir(self.outputs_dir))
+        
+        # 生成物の索引（generate.py query で検索）
+        self.manifest = AssetManifest(self.outputs_dir / ".assets.db")
+        
+        # ダウンロード後の派生ファイル作成（サムネイル・プレビュー・mip・ポスター、既定は無効）
+        self.postprocess = os.getenv("KAMUI_POSTPROCESS", "0") == "1"
+        self._postprocessor = None
+        
+        # 早期ダウンロード用のスレッドプールと共有ダウンローダー
+        self._download_executor = None
+        self.downloader = DownloadManager()
         
         # 出力ディレクトリを確保
         for subdir in ["images", "videos", "audio", "3d"]:
             (self.outputs_dir / subdir).mkdir(parents=True, exist_ok=True)
     
-    def call_claude_with_kamui(self, prompt, working_dir=None):
-        """Claude CodeをKamui MCP設定で呼び出し"""
+    def _claude_env(self):
+        """claude実行用の環境変数"""
+        # PATH環境変数を設定
+        env = os.environ.copy()
+        home_dir = os.path.expanduser("~")
+        env['PATH'] = f"{home_dir}/.local/bin:" + env['PATH']
+        # 非対話モードを強制
+        env['CLAUDE_AUTO_YES'] = "1"
+        
+        # API key環境変数を確認・設定
+        if 'ANTHROPIC_API_KEY' in os.environ:
+            env['ANTHROPIC_API_KEY'] = os.environ['ANTHROPIC_API_KEY']
+            logger.debug(f"✅ API key found in environment (length: {len(os.environ['ANTHROPIC_API_KEY'])})")
+        else:
+            logger.warning("⚠️ No ANTHROPIC_API_KEY found in environment")
+        return env
+    
+    def _claude_command(self):
+        """Claude Code実行コマンド"""
+        return [
+            self.claude_executable,
+            f"--mcp-config={self.config_path}",
+            "--print",
+            "--dangerously-skip-permissions"
+        ]
+    
+    def get_claude_pool(self):
+        """常駐claudeワーカープールを取得（初回に作成）"""
+        with self._pool_lock:
+            if self._claude_pool is None:
+                # --print等はプール側でstream-json用に付与する
+                cmd = [arg for arg in self._claude_command() if arg != "--print"]
+                self._claude_pool = ClaudeWorkerPool(
+                    cmd,
+                    size=self.pool_size,
+                    max_jobs_per_worker=self.pool_max_jobs,
+                    env=self._claude_env(),
+                    cwd=self.project_root,
+                )
+                logger.info(f"♨️ Claude worker pool started (size: {self.pool_size})")
+            return self._claude_pool
+    
+    def _get_download_executor(self):
+        """早期ダウンロード用のスレッドプールを取得"""
+        with self._pool_lock:
+            if self._download_executor is None:
+                self._download_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="download")
+            return self._download_executor
+    
+    def _get_postprocessor(self):
+        """後処理用のプロセスプールを取得"""
+        with self._pool_lock:
+            if self._postprocessor is None:
+                self._postprocessor = PostProcessor(self.outputs_dir)
+            return self._postprocessor
+    
+    def wait_postprocessing(self):
+        """予約済みの後処理の完了を待つ"""
+        if self._postprocessor is None:
+            return {"processed": 0, "unsupported": 0, "failed": 0}
+        summary = self._postprocessor.wait()
+        if any(summary.values()):
+            logger.info(f"🖼️ Post-processing: {summary['processed']} done, {summary['failed']} failed, "
+                        f"{summary['unsupported']} skipped (missing tools)")
+        return summary
+    
+    def close(self):
+        """プール等のリソースを解放"""
+        if self._postprocessor is not None:
+            self.wait_postprocessing()
+            self._postprocessor.close()
+            self._postprocessor = None
+        if self._download_executor is not None:
+            self._download_executor.shutdown(wait=True)
+            self._download_executor = None
+        if self._claude_pool is not None:
+            self._claude_pool.close()
+            self._claude_pool = None
+        if self._http_transport is not None:
+            self._http_transport.close()
+            self._http_transport = None
+        self.downloader.close()
+        self.manifest.close()
+    
+    def _communicate_streaming(self, process, prompt, timeout, on_url=None):
+        """stdoutを逐次読み込み、URLを検出次第on_urlを呼ぶ（timeout超過でkill）"""
+        lines = queue.Queue()
+        stderr_chunks = []
+        
+        def read_stdout():
+            for line in process.stdout:
+                lines.put(line)
+            lines.put(None)
+        
+        def read_stderr():
+            stderr_chunks.append(process.stderr.read())
+        
+        readers = [threading.Thread(target=read_stdout, daemon=True),
+                   threading.Thread(target=read_stderr, daemon=True)]
+        for reader in readers:
+            reader.start()
+        
+        try:
+            process.stdin.write(prompt)
+            process.stdin.close()
+        except (BrokenPipeError, OSError):
+            pass
+        
+        deadline = time.monotonic() + timeout if timeout else None
+        stdout_lines = []
+        seen_urls = set()
+        while True:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            try:
+                if remaining is not None and remaining <= 0:
+                    raise queue.Empty
+                line = lines.get(timeout=remaining)
+            except queue.Empty:
+                kill_process_group(process)
+                process.wait()
+                raise subprocess.TimeoutExpired(process.args, timeout)
+            if line is None:
+                break
+            
+            stdout_lines.append(line)
+            if on_url is not None:
+                for url in self.extract_urls_from_response(line):
+                    if url not in seen_urls:
+                        seen_urls.add(url)
+                        on_url(url)
+        
+        remaining = None if deadline is None else max(0.1, deadline - time.monotonic())
+        try:
+            process.wait(timeout=remaining)
+        except subprocess.TimeoutExpired:
+            kill_process_group(process)
+            process.wait()
+            raise
+        readers[1].join(timeout=5)
+        return "".join(stdout_lines), "".join(stderr_chunks)
+    
+    def call_claude_with_kamui(self, prompt, working_dir=None, timeout=None, on_url=None):
+        """Claude CodeをKamui MCP設定で呼び出し（on_url: URL検出時のコールバック）
+        
+        タイムアウトは timeout（既定は call_timeout）と現在の期限の短い方。キャンセルされたら
+        claudeプロセスをMCPサーバー等の子プロセスごと停止して Cancelled を送出する。
+        """
         # 安全性チェック
         safety_controller.verify_kamui_mcp_available()
         
+        deadline = current_deadline()
+        if timeout is None:
+            timeout = self.call_timeout
+        
+        # 常駐ワーカーがあればそちらで実行
+        if self.pool_size > 0 and working_dir is None:
+            with tracer.span("claude.pool"):
+                return self.get_claude_pool().run(prompt, timeout=timeout)
+        timeout = deadline.timeout(timeout)
+        
         # 作業ディレクトリ設定
         if working_dir is None:
             working_dir = self.project_root
         
+        cmd = self._claude_command()
+        
         try:
-            # PATH環境変数を設定
-            env = os.environ.copy()
-            home_dir = os.path.expanduser("~")
-            env['PATH'] = f"{home_dir}/.local/bin:" + env['PATH']
-            # 非対話モードを強制
-            env['CLAUDE_AUTO_YES'] = "1"
+            env = self._claude_env()
             
-            # API key環境変数を確認・設定
-            if 'ANTHROPIC_API_KEY' in os.environ:
-                env['ANTHROPIC_API_KEY'] = os.environ['ANTHROPIC_API_KEY']
-                print(f"✅ API key found in environment (length: {len(os.environ['ANTHROPIC_API_KEY'])})")
-            else:
-                print("⚠️ No ANTHROPIC_API_KEY found in environment")
-            
-            # Claude Code実行コマンド
-            cmd = [
-                "claude",
-                f"--mcp-config={self.config_path}",
-                "--print",
-                "--dangerously-skip-permissions"
-            ]
-            
-            print(f"🔧 Executing: {' '.join(cmd)}")
-            print(f"📂 Working directory: {working_dir}")
-            print(f"📄 Config path: {self.config_path}")
+            logger.debug(f"🔧 Executing: {' '.join(cmd)}")
+            logger.debug(f"📂 Working directory: {working_dir}")
+            logger.debug(f"📄 Config path: {self.config_path}")
             
             # プロンプトを標準入力で送信
-            process = subprocess.Popen(
-                cmd,
-                stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                cwd=working_dir,
-                env=env
-            )
+            with tracer.span("claude.spawn"):
+                process = subprocess.Popen(
+                    cmd,
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    text=True,
+                    cwd=working_dir,
+                    env=env,
+                    # キャンセル・タイムアウト時にMCPサーバー等の子プロセスごと停止するため独立したグループで起動
+                    start_new_session=True
+                )
             
-            stdout, stderr = process.communicate(input=prompt)
+            # モデル・ツール呼び出しを含む応答待ち
+            with tracer.span("claude.response") as span, \
+                    deadline.on_cancel(lambda reason: kill_process_group(process)):
+                stdout, stderr = self._communicate_streaming(process, prompt, timeout, on_url=on_url)
+                span.set("exit_code", process.returncode)
+            deadline.check()
             
-            print(f"📤 Return code: {process.returncode}")
-            print(f"📥 Stdout length: {len(stdout)}")
+            logger.debug(f"📤 Return code: {process.returncode}")
+            logger.debug(f"📥 Stdout length: {len(stdout)}")
             if stderr:
-                print(f"⚠️ Stderr: {stderr}")
+                logger.debug(f"⚠️ Stderr: {stderr}")
             else:
-                print("ℹ️ No stderr output")
+                logger.debug("ℹ️ No stderr output")
             
             if process.returncode != 0:
                 error_msg = f"Claude Code error (exit {process.returncode})"
@@ -97,231 +372,664 @@ class KamuiMCPClient:
         except FileNotFoundError as e:
             raise Exception(f"Claude Code not found. Make sure it's installed and in PATH: {e}")
         except subprocess.TimeoutExpired:
-            raise Exception("Claude Code execution timeout")
+            deadline.check()
+            raise Exception(f"Claude Code execution timeout ({timeout:.0f}s)")
+        except Cancelled:
+            raise
         except Exception as e:
-            print(f"❌ Error calling Claude Code: {e}")
-            print(f"🔍 Command: {' '.join(cmd)}")
-            print(f"🔍 Working dir: {working_dir}")
-            print(f"🔍 Config exists: {os.path.exists(self.config_path)}")
+            logger.error(f"❌ Error calling Claude Code: {e}")
+            logger.debug(f"🔍 Command: {' '.join(cmd)}")
+            logger.debug(f"🔍 Working dir: {working_dir}")
+            logger.debug(f"🔍 Config exists: {os.path.exists(self.config_path)}")
             raise
     
-    def extract_urls_from_response(self, response_text):
-        """レスポンスからダウンロードURLを抽出"""
-        # URLパターンを検索
-        url_patterns = [
-            r'https://[^\s<>"\']+\.(?:jpg|jpeg|png|gif|mp4|mov|mp3|wav|obj|fbx|gltf)',
-            r'https://storage\.googleapis\.com/[^\s<>"\']+',
-            r'https://[a-zA-Z0-9.-]+\.googleusercontent\.com/[^\s<>"\']+',
-            r'https://fal\.media/[^\s<>"\']+',
-        ]
+    def _load_servers(self):
+        """MCP設定からサーバー名 → URLを取得（HTTPサーバーのみ）"""
+        servers = self._config_index.load(self.config_path).servers
+        return {name: server["url"] for name, server in servers.items()
+                if server.get("type") == "http" and server.get("url")}
+    
+    def get_http_transport(self):
+        """HTTPトランスポートを取得（初回に作成し以降は再利用）"""
+        if self._http_transport is None:
+            self._http_transport = MCPHttpTransport(self._load_servers())
+        return self._http_transport
+    
+    def servers_for_operation(self, operation):
+        """操作に対応するMCPサーバー候補（設定順）"""
+        capability = OPERATION_CAPABILITIES.get(operation)
+        if capability is None or not os.path.exists(self.config_path):
+            return []
+        return list(self._config_index.load(self.config_path).servers_for_capability(capability))
+    
+    def candidate_servers(self, request):
+        """リクエストの候補サーバー（draft ティアは高速版があればそれに限定）"""
+        candidates = self.servers_for_operation(request["operation"])
+        if request["params"].get("tier") == "draft":
+            candidates = [name for name in candidates if DRAFT_SERVER_HINT in name] or candidates
+        return candidates
+    
+    def route_server(self, request):
+        """リクエストの対象サーバーを決定（指定がなければルーターで選択）"""
+        if request.get("server"):
+            return request["server"]
+        candidates = self.candidate_servers(request)
+        if not candidates:
+            return None
+        server_configs = self._config_index.load(self.config_path).servers
+        return self.router.choose(request["operation"], candidates, server_configs)
+    
+    def call_kamui_http(self, request, server=None):
+        """MCPサーバーへHTTPで直接ツール呼び出し"""
+        safety_controller.verify_kamui_mcp_available(request["operation"])
         
-        urls = []
-        for pattern in url_patterns:
-            found_urls = re.findall(pattern, response_text)
-            urls.extend(found_urls)
+        if server is None:
+            server = self.route_server(request)
+        if server is None or server not in self._load_servers():
+            raise MCPHttpError(f"{request['operation']} に対応するHTTP MCPサーバーがありません")
         
-        return list(set(urls))  # 重複削除
+        logger.info(f"🔌 MCP HTTP: {server}")
+        with tracer.span("mcp.http", operation=request["operation"], server=server):
+            return self.get_http_transport().generate(server, request["params"])
+    
+    def _invoke(self, request, server=None, on_url=None):
+        """レート制限・予算の範囲内でリクエストをMCPへ送信し、レスポンステキストを返す"""
+        capability = capability_of(server) if server else OPERATION_CAPABILITIES.get(request["operation"])
+        with tracer.span("limiter.wait", operation=request["operation"], server=server):
+            permit = self.limiter.acquire(server, capability, count=len(request.get("items", ())) or 1)
+        with permit:
+            return self._send(request, server, on_url)
+    
+    def _send(self, request, server=None, on_url=None):
+        """リクエストをMCPへ送信（HTTP直接 → 失敗時はclaude経由）"""
+        # 入力画像のURLがない操作・複数アセットの一括生成はHTTPで直接渡せないためclaude経由
+        needs_image_url = request["operation"] in ("image_to_video", "image_to_3d")
+        use_http = self.transport != "claude" and "items" not in request and \
+            not (needs_image_url and not request["params"].get("image_url"))
+        
+        if use_http:
+            start = time.monotonic()
+            try:
+                response = self.call_kamui_http(request, server)
+                self.router.record(server, time.monotonic() - start, ok=True)
+                return response
+            except MCPHttpError as e:
+                self.router.record(server, time.monotonic() - start, ok=False)
+                # スロットリングは同じバックエンドに当たるclaude経由でも解消しないため、そのまま返す
+                if self.transport == "http" or is_throttle_error(e):
+                    raise Exception(f"MCP HTTP error: {e}")
+                logger.warning(f"⚠️ MCP HTTP failed, falling back to Claude Code: {e}")
+        
+        kamui_prompt = request["kamui_prompt"]
+        if server:
+            kamui_prompt += f"\n使用するMCPサーバー: {server}（このサーバーのツールで生成してください）\n"
+        
+        start = time.monotonic()
+        try:
+            response = self.call_claude_with_kamui(kamui_prompt, on_url=on_url)
+        except Exception:
+            self.router.record(server, time.monotonic() - start, ok=False)
+            raise
+        self.router.record(server, time.monotonic() - start, ok=True)
+        return response
+    
+    def extract_urls_from_response(self, response_text, operation=None):
+        """レスポンスからダウンロードURLを抽出（操作に合うメディアを優先）"""
+        return extract_urls(response_text, operation)
     
     def download_file(self, url, output_path):
-        """URLからファイルをダウンロード"""
+        """URLからファイルをダウンロード（一時的なエラーは再試行、最終的に失敗したらNone。キャンセルは送出）"""
         try:
-            print(f"📥 Downloading: {url}")
-            response = requests.get(url, stream=True)
-            response.raise_for_status()
-            
-            output_path = Path(output_path)
-            output_path.parent.mkdir(parents=True, exist_ok=True)
-            
-            with open(output_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    f.write(chunk)
-            
-            print(f"✅ Downloaded: {output_path}")
-            return str(output_path)
+            logger.info(f"📥 Downloading: {url}")
+            with tracer.span("download", url=url), stage("download"):
+                downloaded = self.retry_policy.call(self.downloader.download, url, output_path, self.blobs,
+                                                    description=f"Download {url}")
+            logger.info(f"✅ Downloaded: {downloaded}")
+            return downloaded
             
+        except Cancelled:
+            raise
         except Exception as e:
-            print(f"❌ Download failed: {e}")
+            logger.error(f"❌ Download failed: {e}")
             return None
     
-    def generate_image(self, prompt, style="photorealistic", aspect_ratio="1:1", output_name=None):
-        """画像生成"""
-        if output_name is None:
-            output_name = f"image_{hash(prompt) % 10000}.jpg"
+    def _hedge_alternate(self, request, server):
+        """ヘッジ先の同等サーバー（ヘッジ無効・サーバー指定あり・候補なしならNone）"""
+        if not self.hedge or server is None or request.get("server"):
+            return None
+        alternates = [name for name in self.candidate_servers(request) if name != server]
+        if not alternates:
+            return None
+        server_configs = self._config_index.load(self.config_path).servers
+        return self.router.choose(request["operation"], alternates, server_configs)
+    
+    def _attempt_generation(self, request, on_url):
+        """1回分の生成呼び出し（遅ければ同等サーバーへヘッジ）。(サーバー, レスポンス, URL一覧) を返す"""
+        server = self.route_server(request)
+        alternate = self._hedge_alternate(request, server)
+        hedge_after = self.router.p95(server) if alternate else None
         
-        output_path = self.outputs_dir / "images" / output_name
+        with tracer.span("mcp.call", operation=request["operation"], server=server) as span:
+            if hedge_after is None:
+                response = self._invoke(request, server, on_url=on_url)
+            else:
+                server, response = hedged_call(lambda name: self._invoke(request, name, on_url=on_url),
+                                               server, alternate, hedge_after)
+                span.set("server", server)
         
-        kamui_prompt = f"""
-{prompt}をテーマにした画像を生成してください。
-
-設定:
-- スタイル: {style}
-- アスペクト比: {aspect_ratio}
-- 高品質で生成してください
-
-生成完了したら、必ず以下を実行してください:
-1. ダウンロードURLのフルパス表示（省略なし）
-2. 今いるディレクトリ（{output_path.parent}）にダウンロード
-3. ダウンロード完了後にopenコマンドで開く
-
-保存したファイルの場所は~からのフルパスで表示してください。
-"""
+        with tracer.span("url.extract", operation=request["operation"]):
+            urls = self.extract_urls_from_response(response, request["operation"])
+        if not urls:
+            raise RetryableError("No download URL found in response")
+        return server, urls
+    
+    def _store_cached(self, request, server, downloaded_file, url):
+        """生成物を実際に生成したサーバーのキーでキャッシュに登録"""
+        key = cache_key(request["operation"], request["params"], server)
+        with tracer.span("cache.store", operation=request["operation"]):
+            self.cache.store(key, downloaded_file, url=url, operation=request["operation"])
+    
+    def _cached_result(self, request):
+        """キャッシュヒット時は出力パスに実体化して結果dictを返す（ミス・無効時はNone）
+        
+        キャッシュは生成したサーバーごとに分かれる。サーバー指定があればそのサーバーの生成物だけ、
+        なければ候補サーバー（draft ティアなら高速版）のいずれかの生成物を使う。
+        """
+        if self.cache_mode != "use":
+            return None
+        servers = [request["server"]] if request.get("server") else self.candidate_servers(request) or [None]
+        with tracer.span("cache.lookup", operation=request["operation"]):
+            for server in servers:
+                key = cache_key(request["operation"], request["params"], server)
+                entry = self.cache.lookup(key)
+                if entry is not None:
+                    break
+        if entry is None:
+            return None
+        logger.info(f"♻️ Cache hit: {key[:12]} ({server or 'auto'})")
+        return {
+            "operation": request["operation"],
+            "server": server,
+            "path": self.cache.materialize(entry, request["output_path"]),
+            "url": entry["url"],
+            "url_fetched_at": entry["created_at"],
+            "downloaded": True,
+            "cached": True,
+            "call_seconds": 0.0,
+            "download_seconds": 0.0,
+        }
+    
+    def _run_generation(self, request):
+        """生成リクエストを実行し、結果（パス・URL・所要時間）を返す（生成物を得られなければ GenerationError）"""
+        with tracer.span("generate", operation=request["operation"]) as span, stage(request["operation"]):
+            try:
+                result = self._generate(request)
+            except Cancelled:
+                raise
+            except Exception as e:
+                # 再利用した元URLが受け付けられなければ、ローカルの画像を渡して（アップロードして）やり直す
+                if not request["params"].get("image_url"):
+                    raise
+                logger.warning(f"⚠️ Origin URL was not accepted ({e}); retrying with the local image")
+                request = self._local_image_request(request)
+                result = self._generate(request)
+            span.set("server", result["server"])
+            span.set("cached", result["cached"])
+        self._finish_result(request, result)
+        return result
+    
+    def _finish_result(self, request, result):
+        """生成物を索引に記録し、有効時は派生ファイル作成をプロセスプールに予約（生成スレッドは待たない）"""
+        try:
+            self.manifest.record(request, result)
+        except Exception as e:
+            logger.warning(f"⚠️ Asset manifest update failed: {e}")
+        if self.postprocess:
+            self._get_postprocessor().submit(result["path"])
+    
+    def _generate(self, request):
+        """_run_generation の本体（キャッシュ参照 → 生成 → ダウンロード → キャッシュ保存）"""
+        output_path = request["output_path"]
+        logger.info(request["message"])
+        
+        cached = self._cached_result(request)
+        if cached is not None:
+            return cached
+        
+        # 出力中にURLが現れたら、プロセス終了を待たずにダウンロードを開始（ヘッジ時も1件のみ）
+        early = {}
+        early_lock = threading.Lock()
+        def start_early_download(url):
+            if media_rank(url, request["operation"]) != RANK_EXPECTED:
+                return
+            with early_lock:
+                if early:
+                    return
+                logger.info(f"⚡ Early download: {url}")
+                early["url"] = url
+                early["start"] = time.monotonic()
+                early["future"] = self._get_download_executor().submit(
+                    contextvars.copy_context().run, self.download_file, url, output_path)
+        
+        start = time.monotonic()
+        try:
+            server, urls = self.retry_policy.call(self._attempt_generation, request, start_early_download,
+                                                  description=request["operation"])
+        except RetryableError as e:
+            raise GenerationError(f"{e} ({request['operation']})")
+        call_seconds = time.monotonic() - start
+        
+        result = {
+            "operation": request["operation"],
+            "server": server,
+            "path": str(output_path),
+            "url": None,
+            "url_fetched_at": time.time(),
+            "downloaded": False,
+            "cached": False,
+            "call_seconds": round(call_seconds, 3),
+            "download_seconds": 0.0,
+        }
         
-        print(f"🎨 Generating image: {prompt}")
-        response = self.call_claude_with_kamui(kamui_prompt)
+        # 早期ダウンロードは最上位のURL（先に流れたプレビュー等ではない）で、成功した場合のみ採用
+        downloaded_file = None
+        if early:
+            early_file = early["future"].result()
+            if early_file and early["url"] == urls[0]:
+                downloaded_file = early_file
+                result["url"] = early["url"]
+                result["download_seconds"] = round(time.monotonic() - early["start"], 3)
         
-        # URLを抽出してダウンロード
-        urls = self.extract_urls_from_response(response)
-        if urls:
+        if result["url"] is None:
+            result["url"] = urls[0]
+            download_start = time.monotonic()
             downloaded_file = self.download_file(urls[0], output_path)
-            if downloaded_file:
-                return downloaded_file
+            result["download_seconds"] = round(time.monotonic() - download_start, 3)
         
-        print("⚠️ No download URL found in response")
-        return str(output_path)
+        if not downloaded_file:
+            raise GenerationError(f"Download failed: {result['url']}")
+        
+        result["path"] = downloaded_file
+        result["downloaded"] = True
+        if self.cache_mode != "off":
+            self._store_cached(request, server, downloaded_file, result["url"])
+        return result
     
-    def generate_video(self, prompt, duration=5, fps=24, output_name=None):
-        """動画生成"""
-        if output_name is None:
-            output_name = f"video_{hash(prompt) % 10000}.mp4"
+    def generate_asset(self, asset_type, prompt, **params):
+        """タイプ名を指定して生成し、結果dictを返す（バッチ処理用）"""
+        if asset_type not in ASSET_REQUEST_BUILDERS:
+            raise Exception(f"未対応の生成タイプ: {asset_type}")
         
-        output_path = self.outputs_dir / "videos" / output_name
+        builder = getattr(self, ASSET_REQUEST_BUILDERS[asset_type])
+        accepted = inspect.signature(builder).parameters
+        builder_params = {key: value for key, value in params.items()
+                          if key in accepted and value is not None}
         
-        kamui_prompt = f"""
-{prompt}をテーマにした動画を生成してください。
-
-設定:
-- 継続時間: {duration}秒
-- FPS: {fps}
-- 高品質で生成してください
-
-生成完了したら、必ず以下を実行してください:
-1. ダウンロードURLのフルパス表示（省略なし）
-2. 今いるディレクトリ（{output_path.parent}）にダウンロード
-3. ダウンロード完了後にopenコマンドで開く
+        request = builder(prompt, **builder_params)
+        safety_controller.ensure_kamui_for_operation(request["operation"])
+        return self._run_generation(request)
+    
+    def promote(self, path, output_name=None):
+        """draft ティアの生成物を同じプロンプト・シードで final ティアとして作り直し、結果dictを返す"""
+        row = self.manifest.get(path)
+        if row is None:
+            raise Exception(f"索引に記録されていない生成物です: {path}")
+        params = dict(row["params"])
+        if params.pop("tier", None) != "draft":
+            raise Exception(f"draft ティアの生成物ではありません: {path}")
+        
+        # draft で上書きした値を元に戻す（元の指定がなかったものは既定値）
+        for key, value in params.pop("requested", {}).items():
+            if value is None:
+                params.pop(key, None)
+            else:
+                params[key] = value
+        params.pop("image_url", None)
+        if "image" in params:
+            # 画像入力の操作は、入力画像（ダイジェスト）の現在のパスを索引から探す
+            image_path = self.manifest.path_for_digest(params.pop("image"))
+            if image_path is None:
+                raise Exception(f"入力画像が見つかりません（索引に記録されていないか削除済み）: {path}")
+            params["image_path"] = image_path
+        
+        builder = getattr(self, OPERATION_REQUEST_BUILDERS[row["operation"]])
+        accepted = inspect.signature(builder).parameters
+        builder_params = {key: value for key, value in params.items() if key in accepted}
+        request = builder(output_name=output_name, tier="final", **builder_params)
+        logger.info(f"⏫ Promoting draft {Path(path).name} to final (seed: {params.get('seed')})")
+        safety_controller.ensure_kamui_for_operation(request["operation"])
+        return self._run_generation(request)
+    
+    def session_capable(self, asset_type):
+        """このタイプを1セッションでまとめて生成できるか（claude経由・一括対応の操作・上限2以上）"""
+        return self.session_batch_size > 1 and self.transport == "claude" and \
+            is_batchable(ASSET_OPERATIONS.get(asset_type))
+    
+    def generate_asset_group(self, asset_type, items, **shared):
+        """同じ設定の複数アセットを1回のclaudeセッションで生成し、項目ごとの出力に分割
 
-保存したファイルの場所は~からのフルパスで表示してください。
-"""
+        items は prompt（必須）と output_name を持つdictのリスト、shared は全項目共通のパラメータ。
+        戻り値は items と同じ順のリストで、各要素は結果dict（失敗した項目は例外オブジェクト）。
+        一括生成できない場合や結果に含まれなかった項目は1件ずつ生成する。
+        """
+        if asset_type not in ASSET_REQUEST_BUILDERS:
+            raise Exception(f"未対応の生成タイプ: {asset_type}")
         
-        print(f"🎬 Generating video: {prompt}")
-        response = self.call_claude_with_kamui(kamui_prompt)
+        builder = getattr(self, ASSET_REQUEST_BUILDERS[asset_type])
+        accepted = inspect.signature(builder).parameters
+        shared_params = {key: value for key, value in shared.items()
+                         if key in accepted and key not in ("prompt", "output_name") and value is not None}
+        requests = [builder(item["prompt"], output_name=item.get("output_name"), **shared_params) for item in items]
+        if not requests:
+            return []
+        safety_controller.ensure_kamui_for_operation(requests[0]["operation"])
         
-        # URLを抽出してダウンロード
-        urls = self.extract_urls_from_response(response)
-        if urls:
-            downloaded_file = self.download_file(urls[0], output_path)
-            if downloaded_file:
-                return downloaded_file
+        results = [self._cached_result(request) for request in requests]
+        pending = [index for index, result in enumerate(results) if result is None]
+        for request, result in zip(requests, results):
+            if result is not None:
+                self._finish_result(request, result)
+        if len(pending) > 1 and self.session_capable(asset_type):
+            for offset in range(0, len(pending), self.session_batch_size):
+                chunk = pending[offset:offset + self.session_batch_size]
+                if len(chunk) > 1:
+                    self._run_session(requests, chunk, results)
         
-        print("⚠️ No download URL found in response")
-        return str(output_path)
+        for index, request in enumerate(requests):
+            if results[index] is None:
+                try:
+                    results[index] = self._run_generation(request)
+                except Exception as e:
+                    results[index] = e
+        return results
     
-    def generate_music(self, prompt, duration=30, genre="ambient", output_name=None):
-        """音楽生成"""
+    def _run_session(self, requests, indices, results):
+        """indices の項目を1セッションで生成し、URLが返った項目の結果を results に格納"""
+        chunk = [requests[index] for index in indices]
+        operation = chunk[0]["operation"]
+        # シードは項目ごとに異なるため共通設定に含めず、各項目の行で渡す
+        shared_values = {key: value for key, value in chunk[0]["params"].items() if key not in ("prompt", "seed")}
+        items = [(str(number), request["params"]["prompt"], request["params"].get("seed"))
+                 for number, request in enumerate(chunk, 1)]
+        session_request = {
+            "operation": operation,
+            "params": shared_values,
+            "items": items,
+            "server": chunk[0].get("server"),
+            "kamui_prompt": render_session_prompt(operation, items, shared_values),
+        }
+        logger.info(f"📚 Generating {len(items)} assets in one session ({operation})")
+        
+        server = self.route_server(session_request)
+        start = time.monotonic()
+        try:
+            with tracer.span("mcp.session", operation=operation, server=server, items=len(items)), stage(operation):
+                response = self.retry_policy.call(self._invoke, session_request, server,
+                                                  description=f"{operation} session")
+        except Cancelled:
+            raise
+        except Exception as e:
+            logger.warning(f"⚠️ Session generation failed, falling back to one call per asset: {e}")
+            return
+        call_seconds = time.monotonic() - start
+        
+        item_urls = extract_item_urls(response, operation)
+        missing = [item_id for item_id, *_ in items if item_id not in item_urls]
+        if missing:
+            logger.warning(f"⚠️ Session returned no URL for {len(missing)} of {len(items)} items; generating them individually")
+        
+        executor = self._get_download_executor()
+        downloads = {}
+        for (item_id, *_), index in zip(items, indices):
+            if item_id in item_urls:
+                downloads[index] = (item_urls[item_id], time.monotonic(),
+                                    executor.submit(contextvars.copy_context().run, self.download_file,
+                                                    item_urls[item_id], requests[index]["output_path"]))
+        
+        for index, (url, download_start, future) in downloads.items():
+            downloaded_file = future.result()
+            if not downloaded_file:
+                results[index] = GenerationError(f"Download failed: {url}")
+                continue
+            request = requests[index]
+            if self.cache_mode != "off":
+                self._store_cached(request, server, downloaded_file, url)
+            results[index] = {
+                "operation": operation,
+                "server": server,
+                "path": downloaded_file,
+                "url": url,
+                "url_fetched_at": time.time(),
+                "downloaded": True,
+                "cached": False,
+                # セッション全体の所要時間を項目数で按分
+                "call_seconds": round(call_seconds / len(items), 3),
+                "download_seconds": round(time.monotonic() - download_start, 3),
+                "session_size": len(items),
+            }
+            self._finish_result(request, results[index])
+    
+    def _build_image_request(self, prompt, style="photorealistic", aspect_ratio="1:1", output_name=None, server=None, tier=None, seed=None):
+        """画像生成リクエストを作成"""
+        params = {"prompt": prompt, "style": style, "aspect_ratio": aspect_ratio}
+        self._apply_tier("generate_image", params, tier, seed)
+        key = cache_key("generate_image", params, server)
         if output_name is None:
-            output_name = f"music_{hash(prompt) % 10000}.mp3"
+            output_name = f"image_{key[:12]}.jpg"
         
-        output_path = self.outputs_dir / "audio" / output_name
+        output_path = self.outputs_dir / "images" / output_name
         
-        kamui_prompt = f"""
-{prompt}をテーマにした音楽を生成してください。
-
-設定:
-- 継続時間: {duration}秒
-- ジャンル: {genre}
-- 高品質で生成してください
-
-生成完了したら、必ず以下を実行してください:
-1. ダウンロードURLのフルパス表示（省略なし）
-2. 今いるディレクトリ（{output_path.parent}）にダウンロード
-3. ダウンロード完了後にopenコマンドで開く
-
-保存したファイルの場所は~からのフルパスで表示してください。
-"""
+        kamui_prompt = render_prompt("generate_image", params, output_path.parent)
         
-        print(f"🎵 Generating music: {prompt}")
-        response = self.call_claude_with_kamui(kamui_prompt)
+        return {
+            "operation": "generate_image",
+            "params": params,
+            "cache_key": key,
+            "server": server,
+            "kamui_prompt": kamui_prompt,
+            "output_path": output_path,
+            "message": f"🎨 Generating image: {prompt}",
+        }
+    
+    def generate_image(self, prompt, style="photorealistic", aspect_ratio="1:1", output_name=None, server=None, tier=None, seed=None):
+        """画像生成"""
+        request = self._build_image_request(prompt, style=style, aspect_ratio=aspect_ratio, output_name=output_name, server=server, tier=tier, seed=seed)
+        return self._run_generation(request)["path"]
+    
+    def _build_video_request(self, prompt, duration=5, fps=24, output_name=None, server=None, tier=None, seed=None):
+        """動画生成リクエストを作成"""
+        params = {"prompt": prompt, "duration": duration, "fps": fps}
+        self._apply_tier("generate_video", params, tier, seed)
+        key = cache_key("generate_video", params, server)
+        if output_name is None:
+            output_name = f"video_{key[:12]}.mp4"
         
-        # URLを抽出してダウンロード
-        urls = self.extract_urls_from_response(response)
-        if urls:
-            downloaded_file = self.download_file(urls[0], output_path)
-            if downloaded_file:
-                return downloaded_file
+        output_path = self.outputs_dir / "videos" / output_name
+        
+        kamui_prompt = render_prompt("generate_video", params, output_path.parent)
         
-        print("⚠️ No download URL found in response")
-        return str(output_path)
+        return {
+            "operation": "generate_video",
+            "params": params,
+            "cache_key": key,
+            "server": server,
+            "kamui_prompt": kamui_prompt,
+            "output_path": output_path,
+            "message": f"🎬 Generating video: {prompt}",
+        }
     
-    def generate_3d_model(self, prompt, complexity="medium", output_name=None):
-        """3Dモデル生成"""
+    def generate_video(self, prompt, duration=5, fps=24, output_name=None, server=None, tier=None, seed=None):
+        """動画生成"""
+        request = self._build_video_request(prompt, duration=duration, fps=fps, output_name=output_name, server=server, tier=tier, seed=seed)
+        return self._run_generation(request)["path"]
+    
+    def _build_music_request(self, prompt, duration=30, genre="ambient", output_name=None, server=None, tier=None, seed=None):
+        """音楽生成リクエストを作成"""
+        params = {"prompt": prompt, "duration": duration, "genre": genre}
+        self._apply_tier("generate_music", params, tier, seed)
+        key = cache_key("generate_music", params, server)
         if output_name is None:
-            output_name = f"model_{hash(prompt) % 10000}.obj"
+            output_name = f"music_{key[:12]}.mp3"
         
-        output_path = self.outputs_dir / "3d" / output_name
+        output_path = self.outputs_dir / "audio" / output_name
         
-        kamui_prompt = f"""
-{prompt}をテーマにした3Dモデルを生成してください。
-
-設定:
-- 複雑さ: {complexity}
-- 高品質で生成してください
-
-生成完了したら、必ず以下を実行してください:
-1. ダウンロードURLのフルパス表示（省略なし）
-2. 今いるディレクトリ（{output_path.parent}）にダウンロード
-3. ダウンロード完了後にopenコマンドで開く
-
-保存したファイルの場所は~からのフルパスで表示してください。
-"""
+        kamui_prompt = render_prompt("generate_music", params, output_path.parent)
         
-        print(f"🗿 Generating 3D model: {prompt}")
-        response = self.call_claude_with_kamui(kamui_prompt)
+        return {
+            "operation": "generate_music",
+            "params": params,
+            "cache_key": key,
+            "server": server,
+            "kamui_prompt": kamui_prompt,
+            "output_path": output_path,
+            "message": f"🎵 Generating music: {prompt}",
+        }
+    
+    def generate_music(self, prompt, duration=30, genre="ambient", output_name=None, server=None, tier=None, seed=None):
+        """音楽生成"""
+        request = self._build_music_request(prompt, duration=duration, genre=genre, output_name=output_name, server=server, tier=tier, seed=seed)
+        return self._run_generation(request)["path"]
+    
+    def _build_3d_model_request(self, prompt, complexity="medium", output_name=None, server=None, tier=None, seed=None):
+        """3Dモデル生成リクエストを作成"""
+        params = {"prompt": prompt, "complexity": complexity}
+        self._apply_tier("generate_3d_model", params, tier, seed)
+        key = cache_key("generate_3d_model", params, server)
+        if output_name is None:
+            output_name = f"model_{key[:12]}.obj"
         
-        # URLを抽出してダウンロード
-        urls = self.extract_urls_from_response(response)
-        if urls:
-            downloaded_file = self.download_file(urls[0], output_path)
-            if downloaded_file:
-                return downloaded_file
+        output_path = self.outputs_dir / "3d" / output_name
+        
+        kamui_prompt = render_prompt("generate_3d_model", params, output_path.parent)
         
-        print("⚠️ No download URL found in response")
-        return str(output_path)
+        return {
+            "operation": "generate_3d_model",
+            "params": params,
+            "cache_key": key,
+            "server": server,
+            "kamui_prompt": kamui_prompt,
+            "output_path": output_path,
+            "message": f"🗿 Generating 3D model: {prompt}",
+        }
     
-    def image_to_video(self, image_path, motion_prompt="gentle movement", duration=5, output_name=None):
-        """画像から動画生成"""
+    def generate_3d_model(self, prompt, complexity="medium", output_name=None, server=None, tier=None, seed=None):
+        """3Dモデル生成"""
+        request = self._build_3d_model_request(prompt, complexity=complexity, output_name=output_name, server=server, tier=tier, seed=seed)
+        return self._run_generation(request)["path"]
+    
+    def _apply_tier(self, operation, params, tier=None, seed=None):
+        """品質ティアに応じて params を調整（draft は短尺・低FPS・低解像度にし、シードを固定して記録）"""
+        tier = tier or self.tier
+        if tier not in TIERS:
+            raise Exception(f"無効なティア: {tier}")
+        if tier == "draft":
+            requested = {}
+            for key, value in DRAFT_PARAMS.get(operation, {}).items():
+                draft_value = min(params[key], value) if isinstance(value, int) and key in params else value
+                if params.get(key) != draft_value:
+                    requested[key] = params.get(key)
+                    params[key] = draft_value
+            params["tier"] = "draft"
+            # promote で final として作り直すときの元の値
+            if requested:
+                params["requested"] = requested
+            if seed is None:
+                # 同じ下書きは同じシード（キャッシュも効く）
+                seed = int(cache_key(operation, params)[:8], 16) % 2 ** 31
+        if seed is not None:
+            params["seed"] = seed
+        return params
+    
+    def _image_input(self, image_path):
+        """入力画像の (キャッシュキー用の参照, 再利用できる元URL) を返す（元URLは索引に記録された有効なもののみ）"""
+        if not Path(image_path).exists():
+            return str(Path(image_path).resolve()), None
+        digest = file_digest(image_path)
+        try:
+            image_url = self.manifest.origin_url(digest)
+        except Exception as e:
+            logger.warning(f"⚠️ Asset manifest lookup failed: {e}")
+            image_url = None
+        if image_url:
+            logger.info(f"🔗 Reusing origin URL for {Path(image_path).name}: {image_url}")
+        return digest, image_url
+    
+    def _local_image_request(self, request):
+        """元URLの代わりにローカルの入力画像を渡すリクエスト（元URLは以降の再利用から外す）"""
+        try:
+            self.manifest.forget_origin_url(request["params"]["image_url"])
+        except Exception as e:
+            logger.warning(f"⚠️ Asset manifest update failed: {e}")
+        params = {key: value for key, value in request["params"].items() if key != "image_url"}
+        output_path = request["output_path"]
+        kamui_prompt = render_prompt(request["operation"], dict(params, image_path=request["image_path"]),
+                                     output_path.parent)
+        return dict(request, params=params, kamui_prompt=kamui_prompt)
+    
+    def _build_image_to_video_request(self, image_path, motion_prompt="gentle movement", duration=5, output_name=None, server=None, tier=None, seed=None):
+        """画像から動画生成リクエストを作成"""
+        image_reference, image_url = self._image_input(image_path)
+        params = {"image": image_reference, "motion_prompt": motion_prompt, "duration": duration}
+        self._apply_tier("image_to_video", params, tier, seed)
+        key = cache_key("image_to_video", params, server)
         if output_name is None:
-            output_name = f"i2v_{hash(motion_prompt) % 10000}.mp4"
+            output_name = f"i2v_{key[:12]}.mp4"
         
         output_path = self.outputs_dir / "videos" / output_name
         
-        # 画像のフルパスを取得
-        image_full_path = Path(image_path).resolve()
+        # 元URLが有効ならそのまま入力に使い、なければローカルのフルパスを渡す（claude経由でアップロード）
+        if image_url:
+            params["image_url"] = image_url
+        image_full_path = image_url or Path(image_path).resolve()
         
-        kamui_prompt = f"""
-画像から動画を生成してください。
-
-入力画像: {image_full_path}
-モーション: {motion_prompt}
-継続時間: {duration}秒
-
-※入力URLはgoogleからのものを使ってください（省略なし）。
-
-生成完了したら、必ず以下を実行してください:
-1. ダウンロードURLのフルパス表示（省略なし）
-2. 今いるディレクトリ（{output_path.parent}）にダウンロード
-3. ダウンロード完了後にopenコマンドで開く
-
-保存したファイルの場所は~からのフルパスで表示してください。
-"""
+        kamui_prompt = render_prompt("image_to_video", dict(params, image_path=image_full_path), output_path.parent)
+        
+        return {
+            "operation": "image_to_video",
+            "params": params,
+            "image_path": str(Path(image_path).resolve()),
+            "cache_key": key,
+            "server": server,
+            "kamui_prompt": kamui_prompt,
+            "output_path": output_path,
+            "message": f"🎬 Converting image to video: {image_path}",
+        }
+    
+    def image_to_video(self, image_path, motion_prompt="gentle movement", duration=5, output_name=None, server=None, tier=None, seed=None):
+        """画像から動画生成"""
+        request = self._build_image_to_video_request(image_path, motion_prompt=motion_prompt, duration=duration, output_name=output_name, server=server, tier=tier, seed=seed)
+        return self._run_generation(request)["path"]
+    
+    def _build_image_to_3d_request(self, image_path, detail="medium", output_name=None, server=None, tier=None, seed=None):
+        """画像から3Dモデル生成リクエストを作成"""
+        image_reference, image_url = self._image_input(image_path)
+        params = {"image": image_reference, "detail": detail}
+        self._apply_tier("image_to_3d", params, tier, seed)
+        key = cache_key("image_to_3d", params, server)
+        if output_name is None:
+            output_name = f"i2m_{key[:12]}.glb"
         
-        print(f"🎬 Converting image to video: {image_path}")
-        response = self.call_claude_with_kamui(kamui_prompt)
+        output_path = self.outputs_dir / "3d" / output_name
         
-        # URLを抽出してダウンロード
-        urls = self.extract_urls_from_response(response)
-        if urls:
-            downloaded_file = self.download_file(urls[0], output_path)
-            if downloaded_file:
-                return downloaded_file
+        # 元URLが有効ならそのまま入力に使い、なければローカルのフルパスを渡す（claude経由でアップロード）
+        if image_url:
+            params["image_url"] = image_url
+        image_full_path = image_url or Path(image_path).resolve()
         
-        print("⚠️ No download URL found in response")
-        return str(output_path)
\ No newline at end of file
+        kamui_prompt = render_prompt("image_to_3d", dict(params, image_path=image_full_path), output_path.parent)
+        
+        return {
+            "operation": "image_to_3d",
+            "params": params,
+            "image_path": str(Path(image_path).resolve()),
+            "cache_key": key,
+            "server": server,
+            "kamui_prompt": kamui_prompt,
+            "output_path": output_path,
+            "message": f"🗿 Converting image to 3D model: {image_path}",
+        }
+    
+    def image_to_3d(self, image_path, detail="medium", output_name=None, server=None, tier=None, seed=None):
+        """画像から3Dモデル生成"""
+        request = self._build_image_to_3d_request(image_path, detail=detail, output_name=output_name, server=server, tier=tier, seed=seed)
+        return self._run_generation(request)["path"]
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+"""
+MCP HTTP Transport - claudeサブプロセスを介さずにMCPサーバーへ直接JSON-RPCで接続
+"""
+
+import re
+import json
+import time
+import itertools
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from deadline import current_deadline
+
+MCP_PROTOCOL_VERSION = "2025-03-26"
+
+CLIENT_INFO = {"name": "creative-factory", "version": "1.0"}
+
+# スキーマのプロパティ名 → リクエストパラメータ名の候補
+ARGUMENT_ALIASES = {
+    "prompt": ["prompt", "text", "description"],
+    "aspect_ratio": ["aspect_ratio", "aspectRatio"],
+    "duration": ["duration", "duration_seconds", "seconds"],
+    "fps": ["fps", "frame_rate"],
+    "image_url": ["image_url", "imageUrl", "image", "input_image_url"],
+    "seed": ["seed"],
+    "style": ["style"],
+    "genre": ["genre"],
+}
+
+# 非同期ツール（submit → status → result）の判定
+SUBMIT_SUFFIX = "_submit"
+STATUS_SUFFIX = "_status"
+RESULT_SUFFIX = "_result"
+COMPLETED_STATES = ("completed", "succeeded", "success", "done")
+FAILED_STATES = ("failed", "error", "cancelled", "canceled")
+
+# ステータス本文中の「status: <状態>」形式
+STATUS_FIELD_PATTERN = re.compile(r'\b(?:status|state)"?\s*[:=]\s*"?([A-Za-z_]+)', re.IGNORECASE)
+
+class MCPHttpError(Exception):
+    """MCP HTTP通信エラー（claudeサブプロセスへのフォールバック対象）"""
+    
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+def _parse_sse(text, request_id):
+    """text/event-streamレスポンスから該当IDのJSON-RPCメッセージを取得"""
+    data_lines = []
+    for line in text.splitlines() + [""]:
+        if line.startswith("data:"):
+            data_lines.append(line[5:].strip())
+        elif line == "" and data_lines:
+            message = json.loads("\n".join(data_lines))
+            data_lines = []
+            if message.get("id") == request_id:
+                return message
+    raise MCPHttpError(f"SSEレスポンスにID {request_id} の応答がありません")
+
+def content_to_text(result):
+    """tools/callの結果をテキストに変換"""
+    parts = []
+    for item in result.get("content", []):
+        if item.get("type") == "text":
+            parts.append(item.get("text", ""))
+        elif item.get("type") == "resource":
+            resource = item.get("resource", {})
+            parts.append(resource.get("uri", "") or resource.get("text", ""))
+    if "structuredContent" in result:
+        parts.append(json.dumps(result["structuredContent"], ensure_ascii=False))
+    return "\n".join(part for part in parts if part)
+
+def job_status(text):
+    """ステータスツールの結果から状態名（小文字）を取り出す（JSONの status / state、「status: X」、単語1つの行）
+
+    部分一致では「not completed」等を完了と誤判定するため、状態名そのものを取り出して完全一致で比較する。
+    """
+    for line in text.splitlines():
+        line = line.strip()
+        try:
+            data = json.loads(line)
+        except ValueError:
+            data = None
+        if isinstance(data, dict):
+            value = data.get("status") or data.get("state")
+            if isinstance(value, str):
+                return value.strip().lower()
+        match = STATUS_FIELD_PATTERN.search(line)
+        if match:
+            return match.group(1).lower()
+        if re.fullmatch(r'"?[A-Za-z_]+"?', line):
+            return line.strip('"').lower()
+    return None
+
+class MCPHttpSession:
+    """1つのMCPサーバーとのセッション"""
+    
+    def __init__(self, url, http, timeout=60):
+        self.url = url
+        self.http = http
+        self.timeout = timeout
+        self.session_id = None
+        self._ids = itertools.count(1)
+        self._tools = None
+        self._lock = threading.Lock()
+        self._initialized = False
+    
+    def _post(self, payload):
+        headers = {
+            "Content-Type": "application/json",
+            "Accept": "application/json, text/event-stream",
+        }
+        if self.session_id:
+            headers["Mcp-Session-Id"] = self.session_id
+        # 待ち時間は現在の期限の残りで打ち切る（キャンセル済みなら送らずに Cancelled）
+        timeout = current_deadline().timeout(self.timeout)
+        try:
+            response = self.http.post(self.url, data=json.dumps(payload), headers=headers, timeout=timeout)
+        except requests.RequestException as e:
+            raise MCPHttpError(f"MCPサーバーに接続できません ({self.url}): {e}")
+        if response.status_code >= 400:
+            raise MCPHttpError(f"MCPサーバーエラー (HTTP {response.status_code}): {response.text[:200]}",
+                               status_code=response.status_code)
+        if "Mcp-Session-Id" in response.headers:
+            self.session_id = response.headers["Mcp-Session-Id"]
+        return response
+    
+    def _rpc(self, method, params=None):
+        request_id = next(self._ids)
+        payload = {"jsonrpc": "2.0", "id": request_id, "method": method}
+        if params is not None:
+            payload["params"] = params
+        response = self._post(payload)
+        
+        try:
+            if response.headers.get("Content-Type", "").startswith("text/event-stream"):
+                message = _parse_sse(response.text, request_id)
+            else:
+                message = response.json()
+        except ValueError as e:
+            raise MCPHttpError(f"MCPレスポンスの解析エラー: {e}")
+        
+        if "error" in message:
+            error = message["error"]
+            raise MCPHttpError(f"MCP {method} エラー: {error.get('message', error)}")
+        return message.get("result", {})
+    
+    def initialize(self):
+        """initializeハンドシェイク（初回のみ）"""
+        with self._lock:
+            if self._initialized:
+                return
+            self._rpc("initialize", {
+                "protocolVersion": MCP_PROTOCOL_VERSION,
+                "capabilities": {},
+                "clientInfo": CLIENT_INFO,
+            })
+            self._post({"jsonrpc": "2.0", "method": "notifications/initialized"})
+            self._initialized = True
+    
+    def list_tools(self):
+        """tools/list（結果はセッション内でキャッシュ）"""
+        self.initialize()
+        if self._tools is None:
+            self._tools = self._rpc("tools/list").get("tools", [])
+        return self._tools
+    
+    def call_tool(self, name, arguments):
+        """tools/call"""
+        self.initialize()
+        result = self._rpc("tools/call", {"name": name, "arguments": arguments})
+        if result.get("isError"):
+            raise MCPHttpError(f"ツール {name} がエラーを返しました: {content_to_text(result)[:200]}")
+        return result
+
+def build_arguments(tool, params):
+    """ツールのinputSchemaに合わせて引数を作成"""
+    schema = tool.get("inputSchema", {})
+    properties = schema.get("properties", {})
+    arguments = {}
+    
+    for param_name, aliases in ARGUMENT_ALIASES.items():
+        value = params.get(param_name)
+        if value is None:
+            continue
+        for alias in aliases:
+            if alias not in properties:
+                continue
+            spec = properties[alias]
+            if spec.get("type") == "string":
+                value = str(value)
+            elif spec.get("type") in ("integer", "number") and isinstance(value, str) and value.isdigit():
+                value = int(value)
+            if "enum" in spec and value not in spec["enum"]:
+                break
+            arguments[alias] = value
+            break
+    
+    # スキーマにない補助パラメータはプロンプトに含める
+    prompt_key = next((alias for alias in ARGUMENT_ALIASES["prompt"] if alias in arguments), None)
+    if prompt_key:
+        extras = [f"{name}: {params[name]}" for name in ("style", "genre", "complexity", "resolution")
+                  if params.get(name) is not None and name not in arguments]
+        if extras:
+            arguments[prompt_key] = f"{arguments[prompt_key]} ({', '.join(extras)})"
+    return arguments
+
+def _extract_request_id(result):
+    """submitの結果からrequest_idを取得"""
+    structured = result.get("structuredContent") or {}
+    if "request_id" in structured:
+        return structured["request_id"]
+    text = content_to_text(result)
+    try:
+        data = json.loads(text)
+        if isinstance(data, dict) and "request_id" in data:
+            return data["request_id"]
+    except ValueError:
+        pass
+    for token in text.replace('"', " ").replace(",", " ").split():
+        if token.count("-") >= 2 and len(token) >= 16:
+            return token
+    raise MCPHttpError(f"submit結果からrequest_idを取得できません: {text[:200]}")
+
+class MCPHttpTransport:
+    """MCPサーバー群へのプール済みHTTPトランスポート"""
+    
+    def __init__(self, servers, pool_size=16, timeout=60, poll_interval=2.0, poll_timeout=900):
+        self.servers = dict(servers)
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.poll_timeout = poll_timeout
+        
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.http.mount("http://", adapter)
+        self.http.mount("https://", adapter)
+        
+        self._sessions = {}
+        self._lock = threading.Lock()
+    
+    def session(self, server_name):
+        """サーバーごとのセッションを取得（再利用）"""
+        with self._lock:
+            if server_name not in self._sessions:
+                if server_name not in self.servers:
+                    raise MCPHttpError(f"未知のMCPサーバー: {server_name}")
+                self._sessions[server_name] = MCPHttpSession(self.servers[server_name], self.http, self.timeout)
+            return self._sessions[server_name]
+    
+    def generate(self, server_name, params):
+        """生成ツールを呼び出し、結果テキストを返す"""
+        session = self.session(server_name)
+        tools = {tool["name"]: tool for tool in session.list_tools()}
+        if not tools:
+            raise MCPHttpError(f"{server_name}: ツールがありません")
+        
+        submit = next((name for name in tools if name.endswith(SUBMIT_SUFFIX)), None)
+        if submit is not None:
+            base = submit[:-len(SUBMIT_SUFFIX)]
+            status, result = base + STATUS_SUFFIX, base + RESULT_SUFFIX
+            if status in tools and result in tools:
+                return self._generate_async(session, tools, submit, status, result, params)
+        
+        tool = next((tool for name, tool in tools.items()
+                     if not name.endswith((STATUS_SUFFIX, RESULT_SUFFIX))), None)
+        if tool is None:
+            raise MCPHttpError(f"{server_name}: 生成ツールがありません")
+        return content_to_text(session.call_tool(tool["name"], build_arguments(tool, params)))
+    
+    def _generate_async(self, session, tools, submit, status, result, params):
+        """submit → statusポーリング → result"""
+        submitted = session.call_tool(submit, build_arguments(tools[submit], params))
+        request_id = _extract_request_id(submitted)
+        
+        deadline = time.monotonic() + self.poll_timeout
+        while True:
+            current_deadline().check()
+            state_text = content_to_text(session.call_tool(status, {"request_id": request_id}))
+            state = job_status(state_text)
+            if state in COMPLETED_STATES:
+                break
+            if state in FAILED_STATES:
+                raise MCPHttpError(f"生成ジョブが失敗しました ({request_id}): {state_text[:200]}")
+            if time.monotonic() > deadline:
+                raise MCPHttpError(f"生成ジョブがタイムアウトしました ({request_id})")
+            current_deadline().sleep(self.poll_interval)
+        
+        return content_to_text(session.call_tool(result, {"request_id": request_id}))
+    
+    def close(self):
+        self.http.close()
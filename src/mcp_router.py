@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+MCP Router - 同等のKamui MCPサーバー間でレイテンシ・エラー率に基づきルーティング
+"""
+
+import os
+import json
+import time
+import threading
+import itertools
+from pathlib import Path
+from tracing import percentile
+
+ROUTE_POLICIES = ("fastest", "cheapest", "round_robin")
+
+# EWMAの平滑化係数（大きいほど直近の結果を重視）
+DEFAULT_ALPHA = 0.3
+
+# エラー率によるレイテンシスコアのペナルティ倍率
+ERROR_PENALTY = 4.0
+
+# エラー率の半減期（秒）。最後の記録から時間が経つほどエラーの影響を弱める
+ERROR_HALF_LIFE_SECONDS = 600.0
+
+# 失敗しか記録がないサーバーは、減衰後のエラー率がこの値を下回ったら未計測扱いで再度試す
+REPROBE_ERROR_THRESHOLD = 0.25
+
+# p95算出用に保持する直近レイテンシのサンプル数と、算出に必要な最小サンプル数
+LATENCY_SAMPLES = 50
+MIN_P95_SAMPLES = 5
+
+# 設定にcostがない場合のサーバー名による相対コスト推定
+COST_HINTS = (
+    ("-fast", 1.0),
+    ("-pro", 3.0),
+    ("-max", 3.0),
+    ("-ultra", 4.0),
+)
+DEFAULT_COST = 2.0
+
+def estimate_cost(server_name, server_config=None):
+    """サーバーの相対コスト（設定のcost優先、なければ名前から推定）"""
+    if server_config and "cost" in server_config:
+        return float(server_config["cost"])
+    for hint, cost in COST_HINTS:
+        if hint in server_name:
+            return cost
+    return DEFAULT_COST
+
+class MCPRouter:
+    """操作ごとの候補サーバーから最適なサーバーを選択"""
+    
+    def __init__(self, stats_path=None, policy=None, alpha=DEFAULT_ALPHA):
+        if policy is None:
+            policy = os.getenv("KAMUI_ROUTE_POLICY", "fastest")
+        if policy not in ROUTE_POLICIES:
+            raise Exception(f"無効なルーティングポリシー: {policy}")
+        self.policy = policy
+        self.alpha = alpha
+        self.stats_path = Path(stats_path) if stats_path else None
+        self._lock = threading.Lock()
+        self._round_robin = {}
+        self.stats = self._load()
+    
+    def _load(self):
+        if self.stats_path is None or not self.stats_path.exists():
+            return {}
+        try:
+            with open(self.stats_path, "r") as f:
+                return json.load(f)
+        except (json.JSONDecodeError, OSError):
+            return {}
+    
+    def _save(self):
+        if self.stats_path is None:
+            return
+        self.stats_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.stats_path.with_name(f".{self.stats_path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.stats, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.stats_path)
+    
+    @staticmethod
+    def _error_rate(stats):
+        """最後の記録からの経過時間で減衰させたエラー率"""
+        age = max(0.0, time.time() - stats.get("updated_at", 0.0))
+        return stats.get("error_ewma", 0.0) * 0.5 ** (age / ERROR_HALF_LIFE_SECONDS)
+    
+    def _latency_score(self, server):
+        stats = self.stats.get(server)
+        if not stats:
+            # 未計測のサーバーを優先して計測する
+            return -1.0
+        error_rate = self._error_rate(stats)
+        if stats.get("latency_ewma") is None:
+            # 失敗しか記録がないサーバーは最後に回し、エラー率が十分に減衰したら再度試す
+            return -1.0 if error_rate < REPROBE_ERROR_THRESHOLD else float("inf")
+        return stats["latency_ewma"] * (1.0 + ERROR_PENALTY * error_rate)
+    
+    def choose(self, operation, candidates, server_configs=None):
+        """ポリシーに従って候補からサーバーを選択"""
+        candidates = list(candidates)
+        if not candidates:
+            return None
+        if len(candidates) == 1:
+            return candidates[0]
+        
+        with self._lock:
+            if self.policy == "round_robin":
+                counter = self._round_robin.setdefault(operation, itertools.count())
+                return candidates[next(counter) % len(candidates)]
+            
+            if self.policy == "cheapest":
+                server_configs = server_configs or {}
+                return min(candidates, key=lambda name: (estimate_cost(name, server_configs.get(name)),
+                                                         self._latency_score(name)))
+            
+            return min(candidates, key=self._latency_score)
+    
+    def record(self, server, latency, ok=True):
+        """リクエスト結果を記録（EWMAを更新して永続化）"""
+        if server is None:
+            return
+        with self._lock:
+            stats = self.stats.setdefault(server, {"latency_ewma": None, "error_ewma": 0.0,
+                                                   "count": 0, "errors": 0})
+            stats["count"] += 1
+            if ok:
+                if stats["latency_ewma"] is None:
+                    stats["latency_ewma"] = latency
+                else:
+                    stats["latency_ewma"] = self.alpha * latency + (1 - self.alpha) * stats["latency_ewma"]
+                samples = stats.setdefault("samples", [])
+                samples.append(round(latency, 3))
+                del samples[:-LATENCY_SAMPLES]
+            else:
+                stats["errors"] += 1
+            stats["error_ewma"] = self.alpha * (0.0 if ok else 1.0) + (1 - self.alpha) * stats["error_ewma"]
+            stats["updated_at"] = time.time()
+            self._save()
+    
+    def p95(self, server):
+        """成功したリクエストの直近レイテンシのp95（サンプル不足ならNone）"""
+        with self._lock:
+            samples = list(self.stats.get(server, {}).get("samples", []))
+        if len(samples) < MIN_P95_SAMPLES:
+            return None
+        return percentile(samples, 0.95)
@@ -5,10 +5,18 @@ MCP Safety Controller - Kamui Code MCP必須操作の安全制御
 
 import os
 import json
+import inspect
+import functools
+import threading
 from pathlib import Path
+from types import MappingProxyType
+from deadline import current_deadline, deadline_scope
+from tracing import get_logger, tracer
 
-# Kamui Code MCP必須の生成操作（ホワイトリスト）
-KAMUI_REQUIRED_OPERATIONS = {
+logger = get_logger(__name__)
+
+# Kamui Code MCP必須の生成操作（ホワイトリスト。実行時の追加は operation_registry へ）
+KAMUI_REQUIRED_OPERATIONS = frozenset({
     "generate_image",
     "generate_video", 
     "generate_music",
@@ -18,10 +26,10 @@ KAMUI_REQUIRED_OPERATIONS = {
     "image_to_3d",
     "text_to_speech",
     # 今後の生成系機能はここに追加
-}
+})
 
-# 加工・表示系操作（他MCP使用OK）
-PROCESSING_OPERATIONS = {
+# 加工・表示系操作（他MCP使用OK。@allow_other_mcp の関数はデコレート時に operation_registry へ追加）
+PROCESSING_OPERATIONS = frozenset({
     "create_3d_scene",       # 3JS
     "process_3d_model",      # Blender  
     "combine_assets",        # 3JS
@@ -29,107 +37,237 @@ PROCESSING_OPERATIONS = {
     "optimize_model",        # Blender
     "create_animation",      # 3JS/Blender
     "compose_scene"          # 3JS
+})
+
+# 生成操作 → 必要なKamui MCPサーバーのプレフィックス（機能）
+OPERATION_CAPABILITIES = {
+    "generate_image": "t2i-",
+    "generate_video": "t2v-",
+    "generate_music": "t2m-",
+    # generate_3d_model（テキスト→3D）に対応する機能はないため対応付けない（claude経由でサーバーを選ばせる）
+    "image_to_video": "i2v-",
+    "image_to_3d": "i2i3d-",
 }
 
+# インデックス対象の機能プレフィックス
+CAPABILITY_PREFIXES = ("t2i-", "t2v-", "t2m-", "i2v-", "i2i-", "i2i3d-", "v2v-")
+
+def capability_of(server_name):
+    """サーバー名から機能プレフィックスを取得（例: t2i-google-imagen3 → t2i-）"""
+    head, sep, _ = server_name.partition("-")
+    return head + sep if sep else None
+
+class OperationRegistry:
+    """操作の分類（generation / processing）の登録簿
+    
+    読み取りは不変のスナップショット（frozenset と読み取り専用dict）を1回参照するだけでロック不要。
+    登録時のみロックして新しいスナップショットを作り、参照を差し替える。
+    """
+    
+    def __init__(self, generation=(), processing=()):
+        self._lock = threading.Lock()
+        self._snapshot = self._build(frozenset(generation), frozenset(processing))
+    
+    @staticmethod
+    def _build(generation, processing):
+        # 両方に含まれる操作は生成系（Kamui必須）を優先
+        kinds = {name: "processing" for name in processing}
+        kinds.update({name: "generation" for name in generation})
+        return generation, processing, MappingProxyType(kinds)
+    
+    @property
+    def generation(self):
+        return self._snapshot[0]
+    
+    @property
+    def processing(self):
+        return self._snapshot[1]
+    
+    def kind(self, operation_name):
+        """操作の分類（generation / processing / unknown）"""
+        return self._snapshot[2].get(operation_name, "unknown")
+    
+    def register(self, operation_name, kind):
+        """操作を generation または processing として登録（登録済みなら何もしない）。追加したらTrue"""
+        if kind not in ("generation", "processing"):
+            raise ValueError(f"操作の分類が無効です: {kind}")
+        with self._lock:
+            generation, processing, _ = self._snapshot
+            current = generation if kind == "generation" else processing
+            if operation_name in current:
+                return False
+            if kind == "generation":
+                generation = generation | {operation_name}
+            else:
+                processing = processing | {operation_name}
+            self._snapshot = self._build(generation, processing)
+        return True
+
+# 操作の分類（全スレッドで共有）
+operation_registry = OperationRegistry(KAMUI_REQUIRED_OPERATIONS, PROCESSING_OPERATIONS)
+
+class MCPConfigIndex:
+    """MCP設定のキャッシュ（mtime変更時のみ再読み込み）と機能別インデックス"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stamp = None
+        self.servers = {}
+        self.by_capability = {}
+    
+    def load(self, config_path):
+        """設定を取得（変更がなければキャッシュを返す）"""
+        try:
+            stat = os.stat(config_path)
+        except FileNotFoundError:
+            raise Exception(f"Kamui Code MCP設定が見つかりません: {config_path}")
+        
+        stamp = (str(config_path), stat.st_mtime_ns, stat.st_size)
+        if stamp == self._stamp:
+            return self
+        
+        with self._lock:
+            if stamp == self._stamp:
+                return self
+            try:
+                with open(config_path, 'r') as f:
+                    config = json.load(f)
+            except json.JSONDecodeError as e:
+                raise Exception(f"Kamui Code MCP設定の読み込みエラー: {e}")
+            
+            if "mcpServers" not in config:
+                raise Exception("Kamui Code MCP設定が無効です")
+            
+            servers = config["mcpServers"]
+            by_capability = {}
+            for name in servers:
+                capability = capability_of(name)
+                if capability:
+                    by_capability.setdefault(capability, []).append(name)
+            
+            self.servers = servers
+            self.by_capability = {key: tuple(names) for key, names in by_capability.items()}
+            self._stamp = stamp
+            logger.debug(f"✅ 利用可能なKamui MCPサービス: {len(servers)}個")
+        return self
+    
+    def servers_for_capability(self, capability):
+        """機能プレフィックスに対応するサーバー名（設定順）"""
+        return self.by_capability.get(capability, ())
+
 class MCPSafetyController:
     """MCP操作の安全性を制御"""
     
     def __init__(self, config_path=None):
+        if config_path is None:
+            config_path = os.getenv("KAMUI_MCP_CONFIG")
         if config_path is None:
             # 環境に応じて設定パスを決定
             home_dir = os.path.expanduser("~")
             config_path = os.path.join(home_dir, ".claude", "mcp-kamuicode.json")
         self.kamui_config_path = config_path
+        self._config_index = MCPConfigIndex()
         self.strict_mode = os.getenv("KAMUI_STRICT_MODE", "true").lower() == "true"
     
-    def verify_kamui_mcp_available(self):
-        """Kamui Code MCPの利用可能性を確認"""
-        if not os.path.exists(self.kamui_config_path):
-            raise Exception(f"Kamui Code MCP設定が見つかりません: {self.kamui_config_path}")
-        
-        try:
-            with open(self.kamui_config_path, 'r') as f:
-                config = json.load(f)
-            
-            if "mcpServers" not in config:
-                raise Exception("Kamui Code MCP設定が無効です")
+    def verify_kamui_mcp_available(self, operation_name=None):
+        """Kamui Code MCPの利用可能性を確認（操作指定時は必要な機能の存在も確認）"""
+        with tracer.span("config.verify", operation=operation_name):
+            config = self._config_index.load(self.kamui_config_path)
             
-            # 主要な生成機能の存在確認
-            servers = config["mcpServers"]
-            required_services = ["t2i-", "t2v-", "t2m-"]  # text-to-image, video, music
-            
-            available_services = [key for key in servers.keys()]
-            print(f"✅ 利用可能なKamui MCPサービス: {len(available_services)}個")
-            
-            return True
-            
-        except json.JSONDecodeError as e:
-            raise Exception(f"Kamui Code MCP設定の読み込みエラー: {e}")
+            capability = OPERATION_CAPABILITIES.get(operation_name)
+            if capability and not config.servers_for_capability(capability):
+                raise Exception(f"{operation_name} に必要なKamui MCPサービス（{capability}*）が設定にありません")
+        
+        return True
+    
+    def servers_for_operation(self, operation_name):
+        """操作に対応するKamui MCPサーバー名（設定順）"""
+        capability = OPERATION_CAPABILITIES.get(operation_name)
+        if capability is None:
+            return ()
+        return self._config_index.load(self.kamui_config_path).servers_for_capability(capability)
     
     def ensure_kamui_for_operation(self, operation_name):
         """指定された操作でKamui Code MCPの使用を強制"""
-        if operation_name in KAMUI_REQUIRED_OPERATIONS:
+        self.enforce(operation_name, operation_registry.kind(operation_name))
+    
+    def enforce(self, operation_name, kind):
+        """分類済みの操作に制約を適用（デコレータは分類をデコレート時に解決して渡す）"""
+        if kind == "generation":
             if self.strict_mode:
-                self.verify_kamui_mcp_available()
-                print(f"🔒 {operation_name}: Kamui Code MCP使用を確認")
+                self.verify_kamui_mcp_available(operation_name)
+                logger.debug(f"🔒 {operation_name}: Kamui Code MCP使用を確認")
             else:
-                print(f"⚠️  {operation_name}: Kamui Code MCP推奨（strict_mode無効）")
+                logger.warning(f"⚠️  {operation_name}: Kamui Code MCP推奨（strict_mode無効）")
         
-        elif operation_name in PROCESSING_OPERATIONS:
-            print(f"🔧 {operation_name}: 加工系操作（他MCP使用OK）")
+        elif kind == "processing":
+            logger.debug(f"🔧 {operation_name}: 加工系操作（他MCP使用OK）")
         
         else:
             if self.strict_mode:
                 raise Exception(f"未定義の操作: {operation_name}")
             else:
-                print(f"❓ {operation_name}: 未定義操作（注意が必要）")
+                logger.warning(f"❓ {operation_name}: 未定義操作（注意が必要）")
     
     def get_operation_type(self, operation_name):
         """操作タイプを判定"""
-        if operation_name in KAMUI_REQUIRED_OPERATIONS:
-            return "generation"
-        elif operation_name in PROCESSING_OPERATIONS:
-            return "processing"
-        else:
-            return "unknown"
+        return operation_registry.kind(operation_name)
     
     def list_allowed_operations(self):
         """利用可能な操作一覧を表示"""
         print("🎨 Kamui Code MCP必須（生成系）:")
-        for op in sorted(KAMUI_REQUIRED_OPERATIONS):
+        for op in sorted(operation_registry.generation):
             print(f"  - {op}")
         
         print("\n🔧 他MCP使用可能（加工系）:")
-        for op in sorted(PROCESSING_OPERATIONS):
+        for op in sorted(operation_registry.processing):
             print(f"  - {op}")
     
     def add_kamui_operation(self, operation_name):
         """新しいKamui必須操作を追加"""
-        KAMUI_REQUIRED_OPERATIONS.add(operation_name)
-        print(f"✅ Kamui必須操作に追加: {operation_name}")
+        if operation_registry.register(operation_name, "generation"):
+            logger.info(f"✅ Kamui必須操作に追加: {operation_name}")
     
     def add_processing_operation(self, operation_name):
         """新しい加工系操作を追加"""
-        PROCESSING_OPERATIONS.add(operation_name)
-        print(f"✅ 加工系操作に追加: {operation_name}")
+        if operation_registry.register(operation_name, "processing"):
+            logger.info(f"✅ 加工系操作に追加: {operation_name}")
 
 # グローバルインスタンス
 safety_controller = MCPSafetyController()
 
 # デコレータとして使用可能
 def require_kamui_mcp(func):
-    """関数にKamui MCP必須制約を追加するデコレータ"""
-    def wrapper(*args, **kwargs):
-        operation_name = func.__name__
-        safety_controller.ensure_kamui_for_operation(operation_name)
-        return func(*args, **kwargs)
+    """関数にKamui MCP必須制約を追加するデコレータ（同期関数・コルーチン関数の両方に対応）
+    
+    操作の分類はデコレート時に1回だけ解決する（後から登録した操作に適用するにはデコレートし直す）。
+    呼び出しごとの処理は設定の確認（mtimeキャッシュ）と期限の確認のみ。
+    """
+    operation_name = func.__name__
+    kind = operation_registry.kind(operation_name)
+    
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, deadline=None, **kwargs):
+            safety_controller.enforce(operation_name, kind)
+            deadline = deadline or current_deadline()
+            deadline.check()
+            with deadline_scope(deadline):
+                return await func(*args, **kwargs)
+        async_wrapper.operation_kind = kind
+        return async_wrapper
+    
+    @functools.wraps(func)
+    def wrapper(*args, deadline=None, **kwargs):
+        safety_controller.enforce(operation_name, kind)
+        # 期限・キャンセルは呼び出し元から引き継ぐ（deadline を渡せばその期限で実行）
+        deadline = deadline or current_deadline()
+        deadline.check()
+        return deadline.run(func, *args, **kwargs)
+    wrapper.operation_kind = kind
     return wrapper
 
 def allow_other_mcp(func):
-    """関数で他MCP使用を明示的に許可するデコレータ"""
-    def wrapper(*args, **kwargs):
-        operation_name = func.__name__
-        if operation_name not in PROCESSING_OPERATIONS:
-            PROCESSING_OPERATIONS.add(operation_name)
-        return func(*args, **kwargs)
-    return wrapper
\ No newline at end of file
+    """関数で他MCP使用を明示的に許可するデコレータ（デコレート時に加工系操作として登録し、関数はそのまま返す）"""
+    operation_registry.register(func.__name__, "processing")
+    return func
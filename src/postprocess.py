@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+Post Processor - 生成物からWeb向け派生ファイル（サムネイル・プレビュー・テクスチャmip・動画ポスター）をプロセスプールで作成
+"""
+
+import os
+import json
+import shutil
+import threading
+import subprocess
+import multiprocessing
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from generation_cache import file_digest
+from tracing import get_logger, tracer
+
+logger = get_logger(__name__)
+
+try:
+    from PIL import Image, features
+except ImportError:  # Pillowがなければ画像の派生ファイルは作らない
+    Image = None
+
+# 派生ファイルの作り方を変えたら上げる（既存の派生ファイルを作り直す）
+RECIPE_VERSION = 1
+
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".webp"}
+VIDEO_EXTENSIONS = {".mp4", ".mov", ".webm"}
+
+# 画像: サムネイル / プレビューの長辺ピクセル数
+THUMBNAIL_SIZE = 256
+PREVIEW_SIZE = 1024
+PREVIEW_QUALITY = 80
+
+# テクスチャmip: 最上位レベルの最大辺（2のべき乗に切り下げ、1x1まで半分ずつ縮小）
+MIP_MAX_SIZE = 2048
+
+# 動画: ポスターフレームの位置（秒）とプレビュークリップの長さ・高さ
+POSTER_AT_SECONDS = 1.0
+CLIP_SECONDS = 3
+CLIP_HEIGHT = 480
+
+# ffmpeg 1回あたりのタイムアウト（秒）
+FFMPEG_TIMEOUT = 120
+
+def _floor_power_of_two(value):
+    return 1 << (max(1, value).bit_length() - 1)
+
+def mip_sizes(width, height, max_size=MIP_MAX_SIZE):
+    """2のべき乗のmipチェーンの各レベルのサイズ（最上位は max_size 以下、1x1まで）"""
+    width = min(_floor_power_of_two(width), max_size)
+    height = min(_floor_power_of_two(height), max_size)
+    sizes = [(width, height)]
+    while width > 1 or height > 1:
+        width, height = max(1, width // 2), max(1, height // 2)
+        sizes.append((width, height))
+    return sizes
+
+def _save_preview(image, path_stem, fmt, extension):
+    path = path_stem.with_suffix(extension)
+    image.save(path, fmt, quality=PREVIEW_QUALITY)
+    return path
+
+def process_image(source, target_dir):
+    """画像のサムネイル・WebP/AVIFプレビュー・mipチェーンを作成（作成したパスのリストを返す）"""
+    if Image is None:
+        return []
+    target_dir = Path(target_dir)
+    target_dir.mkdir(parents=True, exist_ok=True)
+    webp = features.check("webp")
+    outputs = []
+    
+    with Image.open(source) as opened:
+        image = opened.convert("RGBA" if opened.mode in ("RGBA", "LA", "P") else "RGB")
+    
+    thumbnail = image.copy()
+    thumbnail.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE), Image.LANCZOS)
+    if webp:
+        outputs.append(_save_preview(thumbnail, target_dir / "thumb", "WEBP", ".webp"))
+    else:
+        thumbnail.save(target_dir / "thumb.png", "PNG", optimize=True)
+        outputs.append(target_dir / "thumb.png")
+    
+    preview = image.copy()
+    preview.thumbnail((PREVIEW_SIZE, PREVIEW_SIZE), Image.LANCZOS)
+    if webp:
+        outputs.append(_save_preview(preview, target_dir / "preview", "WEBP", ".webp"))
+    if features.check("avif"):
+        outputs.append(_save_preview(preview, target_dir / "preview", "AVIF", ".avif"))
+    
+    # 3Dシーン用テクスチャ: 上位レベルから順に縮小して各レベルを保存
+    mip_dir = target_dir / "mips"
+    mip_dir.mkdir(exist_ok=True)
+    level_image = image
+    for level, size in enumerate(mip_sizes(*image.size)):
+        level_image = level_image.resize(size, Image.LANCZOS)
+        path = mip_dir / f"mip_{level}_{size[0]}x{size[1]}.png"
+        level_image.save(path, "PNG")
+        outputs.append(path)
+    return [str(path) for path in outputs]
+
+def _ffmpeg(*arguments):
+    subprocess.run(["ffmpeg", "-nostdin", "-loglevel", "error", "-y", *arguments],
+                   check=True, capture_output=True, timeout=FFMPEG_TIMEOUT)
+
+def process_video(source, target_dir):
+    """動画のポスターフレームと短いプレビュークリップを作成（ffmpegがなければ何もしない）"""
+    if shutil.which("ffmpeg") is None:
+        return []
+    target_dir = Path(target_dir)
+    target_dir.mkdir(parents=True, exist_ok=True)
+    poster = target_dir / "poster.jpg"
+    clip = target_dir / "preview.mp4"
+    
+    try:
+        _ffmpeg("-ss", str(POSTER_AT_SECONDS), "-i", str(source), "-frames:v", "1", str(poster))
+    except subprocess.CalledProcessError:
+        # 動画がポスター位置より短い場合は先頭フレーム
+        _ffmpeg("-i", str(source), "-frames:v", "1", str(poster))
+    _ffmpeg("-i", str(source), "-t", str(CLIP_SECONDS), "-an", "-vf", f"scale=-2:{CLIP_HEIGHT}",
+            "-c:v", "libx264", "-preset", "veryfast", "-crf", "28", "-movflags", "+faststart", str(clip))
+    return [str(poster), str(clip)]
+
+# 拡張子 → 派生ファイル作成関数（プロセスプールで実行するためモジュール直下の関数）
+PROCESSORS = {extension: process_image for extension in IMAGE_EXTENSIONS}
+PROCESSORS.update({extension: process_video for extension in VIDEO_EXTENSIONS})
+
+def missing_tools():
+    """派生ファイル作成に使えない外部ツール（警告表示用）"""
+    missing = []
+    if Image is None:
+        missing.append("Pillow (pip install Pillow)")
+    if shutil.which("ffmpeg") is None:
+        missing.append("ffmpeg")
+    return missing
+
+class PostProcessor:
+    """ダウンロード済みの生成物を非同期に後処理（入力内容が変わらなければスキップ）"""
+    
+    def __init__(self, outputs_dir, max_workers=None, processors=None):
+        self.outputs_dir = Path(outputs_dir)
+        self.derived_dir = self.outputs_dir / "derived"
+        self.manifest_path = self.outputs_dir / ".cache" / "postprocess.json"
+        if max_workers is None:
+            max_workers = int(os.getenv("KAMUI_POSTPROCESS_WORKERS", "0")) or min(4, os.cpu_count() or 1)
+        self.max_workers = max_workers
+        self.processors = processors or PROCESSORS
+        self._executor = None
+        self._lock = threading.Lock()
+        self._pending = []
+        self._warned = False
+    
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # 生成スレッドが動いているプロセスからforkしないよう、forkserver（なければspawn）で起動
+                methods = multiprocessing.get_all_start_methods()
+                context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context)
+            return self._executor
+    
+    def _load_manifest(self):
+        if not self.manifest_path.exists():
+            return {}
+        try:
+            with open(self.manifest_path, "r") as f:
+                return json.load(f)
+        except (json.JSONDecodeError, OSError):
+            return {}
+    
+    def _save_entry(self, key, entry):
+        with self._lock:
+            manifest = self._load_manifest()
+            manifest[key] = entry
+            self.manifest_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.manifest_path.with_name(f".{self.manifest_path.name}.{os.getpid()}.tmp")
+            with open(tmp_path, "w") as f:
+                json.dump(manifest, f, indent=1, sort_keys=True)
+            os.replace(tmp_path, self.manifest_path)
+    
+    def _target_dir(self, source):
+        """派生ファイルの出力先（outputs/derived/<種類>/<ファイル名>）"""
+        try:
+            relative = source.resolve().relative_to(self.outputs_dir.resolve())
+        except ValueError:
+            relative = Path("external") / source.name
+        return self.derived_dir / relative.parent / relative.name.replace(".", "_")
+    
+    def submit(self, path):
+        """生成物の後処理を予約（対象外・処理済みならNone）。完了は wait() で待つ"""
+        source = Path(path)
+        processor = self.processors.get(source.suffix.lower())
+        if processor is None or not source.is_file():
+            return None
+        
+        key = str(source.resolve())
+        with self._lock:
+            if any(pending_key == key for _, pending_key, _, _ in self._pending):
+                return None
+        digest = file_digest(source)
+        entry = self._load_manifest().get(key)
+        if entry and entry["digest"] == digest and entry["recipe"] == RECIPE_VERSION and \
+                all(os.path.exists(output) for output in entry["outputs"]):
+            logger.debug(f"♻️ Derivatives up to date: {source.name}")
+            return None
+        
+        future = self._get_executor().submit(processor, str(source), str(self._target_dir(source)))
+        with self._lock:
+            self._pending.append((future, key, digest, source))
+        return future
+    
+    def _record(self, future, key, digest, source):
+        """完了した後処理を記録し、結果（processed / unsupported / failed）を返す"""
+        try:
+            outputs = future.result()
+        except Exception as e:
+            logger.warning(f"⚠️ Post-processing failed for {source.name}: {e}")
+            return "failed"
+        # ツール不足で何も作れなかった入力は記録せず、ツール導入後に作り直す
+        if not outputs:
+            return "unsupported"
+        self._save_entry(key, {"digest": digest, "recipe": RECIPE_VERSION, "outputs": outputs})
+        logger.info(f"🖼️ Derivatives: {source.name} → {len(outputs)} files")
+        return "processed"
+    
+    def process_all(self, paths):
+        """複数ファイルを後処理し、完了まで待って件数（processed / unsupported / failed / skipped）を返す"""
+        futures = [self.submit(path) for path in paths]
+        summary = self.wait()
+        summary["skipped"] = futures.count(None)
+        return summary
+    
+    def wait(self):
+        """予約済みの後処理の完了を待って記録し、結果ごとの件数を返す"""
+        with self._lock:
+            pending, self._pending = self._pending, []
+        summary = {"processed": 0, "unsupported": 0, "failed": 0}
+        if not pending:
+            return summary
+        with tracer.span("postprocess.wait", files=len(pending)):
+            for entry in pending:
+                summary[self._record(*entry)] += 1
+        if summary["unsupported"] and not self._warned:
+            self._warned = True
+            logger.warning(f"⚠️ Some derivatives were skipped; not available: {', '.join(missing_tools())}")
+        return summary
+    
+    def close(self):
+        self.wait()
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Prompt Templates - Kamui Code向けプロンプトの共有レジストリ（単体・複数アセット一括）
+"""
+
+# 生成完了後の共通指示
+DOWNLOAD_INSTRUCTIONS = """生成完了したら、必ず以下を実行してください:
+1. ダウンロードURLのフルパス表示（省略なし）
+2. 今いるディレクトリ（{output_dir}）にダウンロード
+3. ダウンロード完了後にopenコマンドで開く
+
+保存したファイルの場所は~からのフルパスで表示してください。
+"""
+
+# 入力画像を使う操作の注意書き
+IMAGE_INPUT_NOTE = "※入力URLはgoogleからのものを使ってください（省略なし）。"
+
+# 品質ティアごとの品質指示（draft=反復用の高速・低解像度プレビュー / final=本番品質）
+QUALITY_INSTRUCTIONS = {
+    "draft": "下書き用のプレビューです。低解像度で素早く生成してください",
+    "final": "高品質で生成してください",
+}
+
+# 値があるときだけ設定に加える行（ラベル, キー）
+OPTIONAL_SETTINGS = [("解像度", "resolution"), ("シード", "seed")]
+
+# 操作ごとのテンプレート
+#   subject: 依頼文 / settings: (ラベル, 書式) の設定行 / batchable: 1セッションで複数生成できるか
+PROMPT_TEMPLATES = {
+    "generate_image": {
+        "subject": "{prompt}をテーマにした画像を生成してください。",
+        "noun": "画像",
+        "settings": [("スタイル", "{style}"), ("アスペクト比", "{aspect_ratio}")],
+        "batchable": True,
+    },
+    "generate_video": {
+        "subject": "{prompt}をテーマにした動画を生成してください。",
+        "noun": "動画",
+        "settings": [("継続時間", "{duration}秒"), ("FPS", "{fps}")],
+        "batchable": False,
+    },
+    "generate_music": {
+        "subject": "{prompt}をテーマにした音楽を生成してください。",
+        "noun": "音楽",
+        "settings": [("継続時間", "{duration}秒"), ("ジャンル", "{genre}")],
+        "batchable": True,
+    },
+    "generate_3d_model": {
+        "subject": "{prompt}をテーマにした3Dモデルを生成してください。",
+        "noun": "3Dモデル",
+        "settings": [("複雑さ", "{complexity}")],
+        "batchable": False,
+    },
+    "image_to_video": {
+        "subject": "画像から動画を生成してください。",
+        "noun": "動画",
+        "inputs": [("入力画像", "{image_path}"), ("モーション", "{motion_prompt}"), ("継続時間", "{duration}秒")],
+        "batchable": False,
+    },
+    "image_to_3d": {
+        "subject": "画像から3Dモデルを生成してください。",
+        "noun": "3Dモデル",
+        "inputs": [("入力画像", "{image_path}"), ("詳細度", "{detail}")],
+        "batchable": False,
+    },
+}
+
+def is_batchable(operation):
+    """1セッションで複数アセットをまとめて生成できる操作か"""
+    return PROMPT_TEMPLATES.get(operation, {}).get("batchable", False)
+
+def _settings_lines(template, values):
+    return "".join(f"- {label}: {fmt.format(**values)}\n" for label, fmt in template["settings"])
+
+def _tier_lines(values, prefix="- ", quality=True):
+    """任意の設定行と品質指示（values の tier、なければ final）。quality=False なら final の品質指示は省略"""
+    lines = "".join(f"{prefix}{label}: {values[key]}\n" for label, key in OPTIONAL_SETTINGS
+                    if values.get(key) is not None)
+    tier = values.get("tier") or "final"
+    if quality or tier != "final":
+        lines += f"{prefix}{QUALITY_INSTRUCTIONS[tier]}\n"
+    return lines
+
+def render_prompt(operation, values, output_dir):
+    """単体生成のプロンプトを作成"""
+    template = PROMPT_TEMPLATES[operation]
+    body = template["subject"].format(**values) + "\n\n"
+    if "inputs" in template:
+        body += "".join(f"{label}: {fmt.format(**values)}\n" for label, fmt in template["inputs"])
+        body += _tier_lines(values, prefix="", quality=False)
+        body += f"\n{IMAGE_INPUT_NOTE}\n\n"
+    else:
+        body += "設定:\n" + _settings_lines(template, values) + _tier_lines(values) + "\n"
+    return "\n" + body + DOWNLOAD_INSTRUCTIONS.format(output_dir=output_dir)
+
+def render_session_prompt(operation, items, shared_values):
+    """複数アセットを1セッションで生成するプロンプト（結果はID付きJSONで返させる）
+    
+    items は (id, prompt) または (id, prompt, シード) のリスト。shared_values は全項目に共通する設定値。
+    """
+    template = PROMPT_TEMPLATES[operation]
+    if not template.get("batchable"):
+        raise Exception(f"一括生成に未対応の操作です: {operation}")
+    
+    lines = [
+        "",
+        f"以下の{len(items)}件の{template['noun']}を、それぞれ個別に生成してください。",
+        "",
+        "共通設定:",
+        (_settings_lines(template, shared_values) + _tier_lines(shared_values)).rstrip("\n"),
+        "",
+        "生成する項目:",
+    ]
+    for item_id, prompt, *seed in items:
+        # シードは項目ごとに異なるため項目の行に付ける（draft を final で作り直すときに同じシードを使うため）
+        suffix = f" (シード: {seed[0]})" if seed and seed[0] is not None else ""
+        lines.append(f"- [{item_id}] {prompt}{suffix}")
+    lines += [
+        "",
+        "各項目の生成が終わったら、ファイルのダウンロードは不要です。",
+        "すべて完了したら、最後に次の形式のJSONコードブロックだけを出力してください（URLは省略なし、失敗した項目はurlをnullに）:",
+        "```json",
+        '{"results": [{"id": "<項目ID>", "url": "<ダウンロードURL>"}]}',
+        "```",
+        "",
+    ]
+    return "\n".join(lines)
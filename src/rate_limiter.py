@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+"""
+Rate Limiter - MCPサーバーごとのトークンバケット・AIMD同時実行制御と月間利用量台帳
+"""
+
+import os
+import json
+import time
+import threading
+from datetime import datetime, timezone
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # Windows: 台帳のプロセス間ロックなし
+    fcntl = None
+
+# 機能ごとのデフォルト制限（workflows/rate-limits.json で上書き）
+#   requests_per_minute: トークンバケットの補充速度 / burst: バケット容量
+#   max_concurrency: AIMDの上限 / cost: 1リクエストあたりの利用量（台帳の単位）
+DEFAULT_CAPABILITY_LIMITS = {
+    "t2i": {"requests_per_minute": 20, "burst": 4, "max_concurrency": 4, "cost": 1},
+    "t2v": {"requests_per_minute": 4, "burst": 2, "max_concurrency": 2, "cost": 10},
+    "t2m": {"requests_per_minute": 6, "burst": 2, "max_concurrency": 2, "cost": 3},
+    "i2v": {"requests_per_minute": 4, "burst": 2, "max_concurrency": 2, "cost": 10},
+    "i2i": {"requests_per_minute": 10, "burst": 2, "max_concurrency": 2, "cost": 2},
+    "i2i3d": {"requests_per_minute": 4, "burst": 2, "max_concurrency": 2, "cost": 5},
+    "v2v": {"requests_per_minute": 4, "burst": 2, "max_concurrency": 2, "cost": 10},
+}
+FALLBACK_LIMITS = {"requests_per_minute": 10, "burst": 2, "max_concurrency": 2, "cost": 1}
+
+# 制限超過（スロットリング）とみなすエラーの手がかり
+THROTTLE_MARKERS = ("429", "rate limit", "too many requests", "quota", "throttl", "resource_exhausted")
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+class QuotaExceededError(Exception):
+    """月間予算を超えるため生成を拒否"""
+
+def is_throttle_error(error):
+    """例外がレート制限・クォータ超過によるものか"""
+    if getattr(error, "status_code", None) in (429, 503):
+        return True
+    text = str(error).lower()
+    return any(marker in text for marker in THROTTLE_MARKERS)
+
+def load_rate_limits(path=None):
+    """機能ごとの制限と予算を読み込み（ファイルがなければデフォルト）"""
+    if path is None:
+        path = os.getenv("KAMUI_RATE_LIMITS")
+    if path is None:
+        path = Path(__file__).parent.parent / "workflows" / "rate-limits.json"
+    limits = {"capabilities": {name: dict(values) for name, values in DEFAULT_CAPABILITY_LIMITS.items()},
+              "budget": {}}
+    path = Path(path)
+    if path.exists():
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+        except json.JSONDecodeError as e:
+            raise Exception(f"レート制限設定の読み込みエラー ({path}): {e}")
+        for name, values in data.get("capabilities", {}).items():
+            limits["capabilities"].setdefault(name.rstrip("-"), dict(FALLBACK_LIMITS)).update(values)
+        limits["budget"].update(data.get("budget", {}))
+    
+    budget = os.getenv("KAMUI_MONTHLY_BUDGET")
+    if budget:
+        limits["budget"]["monthly_units"] = float(budget)
+    return limits
+
+class TokenBucket:
+    """一定速度で補充されるトークンバケット（取得できるまで待機）"""
+    
+    def __init__(self, rate_per_second, capacity, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate_per_second
+        self.capacity = max(1.0, float(capacity))
+        self.tokens = self.capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._updated = clock()
+        self._lock = threading.Lock()
+    
+    def _refill(self):
+        now = self._clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+    
+    def acquire(self):
+        """トークンを1つ取得（待機した秒数を返す）"""
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return waited
+                delay = (1.0 - self.tokens) / self.rate
+            self._sleep(delay)
+            waited += delay
+    
+    def drain(self):
+        """スロットリング時にバケットを空にして以降の送信を遅らせる"""
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.tokens, 0.0)
+
+class AIMDLimiter:
+    """加算増加・乗算減少で同時実行数の上限を調整するセマフォ"""
+    
+    def __init__(self, max_limit, initial=1, min_limit=1, decrease_factor=0.5):
+        self.max_limit = max(1, int(max_limit))
+        self.min_limit = max(1, int(min_limit))
+        self.limit = float(min(max(initial, self.min_limit), self.max_limit))
+        self.decrease_factor = decrease_factor
+        self.in_flight = 0
+        self._condition = threading.Condition()
+    
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+    
+    def release(self, outcome="ok"):
+        """スロットを返却し、結果に応じて上限を調整（ok: +1/limit、throttled・error: 乗算減少）"""
+        with self._condition:
+            self.in_flight -= 1
+            if outcome == "ok":
+                # 上限ぶんの成功でおよそ +1（TCPの輻輳回避と同じ増加速度）
+                self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+            else:
+                self.limit = max(float(self.min_limit), self.limit * self.decrease_factor)
+            self._condition.notify_all()
+
+class UsageLedger:
+    """月ごとの利用量をJSONに記録し、予算を超える予約を拒否"""
+    
+    def __init__(self, ledger_path, monthly_budget=None):
+        self.ledger_path = Path(ledger_path)
+        self.monthly_budget = monthly_budget
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def month():
+        return datetime.now(timezone.utc).strftime("%Y-%m")
+    
+    def _locked(self):
+        return _LedgerFileLock(self.ledger_path.with_name(self.ledger_path.name + ".lock"))
+    
+    def _load(self):
+        if not self.ledger_path.exists():
+            return {}
+        try:
+            with open(self.ledger_path, "r") as f:
+                return json.load(f)
+        except (json.JSONDecodeError, OSError):
+            return {}
+    
+    def _save(self, ledger):
+        self.ledger_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.ledger_path.with_name(f".{self.ledger_path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(ledger, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.ledger_path)
+    
+    def _entry(self, ledger):
+        entry = ledger.setdefault(self.month(), {"units": 0.0, "requests": 0, "by_capability": {}})
+        # 予約はPIDごとに保持し、異常終了したプロセスの予約は次回参照時に解放する
+        reserved = entry.setdefault("reserved", {})
+        for pid in list(reserved):
+            if not _pid_alive(int(pid)):
+                del reserved[pid]
+        return entry
+    
+    def reserve(self, capability, units):
+        """利用量を予約（予算を超える場合は QuotaExceededError）。予算がなければ何もしない（台帳は実際の利用時に作成）"""
+        if self.monthly_budget is None:
+            return
+        with self._lock, self._locked():
+            ledger = self._load()
+            entry = self._entry(ledger)
+            committed = entry["units"] + sum(entry["reserved"].values())
+            if self.monthly_budget is not None and committed + units > self.monthly_budget:
+                raise QuotaExceededError(
+                    f"月間予算を超えるため生成を中止しました ({capability}: {units:g} units, "
+                    f"使用済み+予約 {committed:g} / 予算 {self.monthly_budget:g})")
+            pid = str(os.getpid())
+            entry["reserved"][pid] = entry["reserved"].get(pid, 0.0) + units
+            self._save(ledger)
+    
+    def settle(self, capability, units, used=True, requests=1):
+        """予約を確定（used=False なら失敗として返却）。requests は生成したアセット数"""
+        if self.monthly_budget is None and not used:
+            return
+        with self._lock, self._locked():
+            ledger = self._load()
+            entry = self._entry(ledger)
+            if self.monthly_budget is not None:
+                pid = str(os.getpid())
+                remaining = entry["reserved"].get(pid, 0.0) - units
+                if remaining > 1e-9:
+                    entry["reserved"][pid] = remaining
+                else:
+                    entry["reserved"].pop(pid, None)
+            if used:
+                entry["units"] += units
+                entry["requests"] += requests
+                by_capability = entry["by_capability"].setdefault(capability, {"units": 0.0, "requests": 0})
+                by_capability["units"] += units
+                by_capability["requests"] += requests
+            self._save(ledger)
+    
+    def usage(self, month=None):
+        """指定月（デフォルトは当月）の利用量"""
+        with self._lock:
+            return self._load().get(month or self.month(), {"units": 0.0, "requests": 0, "reserved": {},
+                                                             "by_capability": {}})
+
+class _LedgerFileLock:
+    """台帳ファイルのプロセス間排他ロック（fcntlがない環境では何もしない）"""
+    
+    def __init__(self, lock_path):
+        self.lock_path = lock_path
+        self._file = None
+    
+    def __enter__(self):
+        if fcntl is not None:
+            self.lock_path.parent.mkdir(parents=True, exist_ok=True)
+            self._file = open(self.lock_path, "a")
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        if self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+        return False
+
+class RateLimiter:
+    """サーバー単位のトークンバケット + AIMD と、全体の利用量台帳をまとめた入口"""
+    
+    def __init__(self, ledger_path=None, limits=None):
+        self.limits = limits if limits is not None else load_rate_limits()
+        self.ledger = UsageLedger(ledger_path, self.limits["budget"].get("monthly_units")) if ledger_path else None
+        self._buckets = {}
+        self._concurrency = {}
+        self._lock = threading.Lock()
+    
+    def capability_limits(self, capability):
+        return self.limits["capabilities"].get((capability or "").rstrip("-"), FALLBACK_LIMITS)
+    
+    def _controls(self, key, capability):
+        with self._lock:
+            if key not in self._buckets:
+                limits = self.capability_limits(capability)
+                self._buckets[key] = TokenBucket(limits["requests_per_minute"] / 60.0, limits["burst"])
+                self._concurrency[key] = AIMDLimiter(limits["max_concurrency"],
+                                                     initial=limits.get("initial_concurrency",
+                                                                     max(1, limits["max_concurrency"] // 2)))
+            return self._buckets[key], self._concurrency[key]
+    
+    def acquire(self, server, capability, count=1):
+        """送信許可を取得（予算確認 → 同時実行枠 → トークン）。withで使用する
+        
+        count は1回の呼び出しで生成するアセット数（一括生成時）。予算・トークンをその数だけ消費する。
+        """
+        capability = (capability or "").rstrip("-")
+        units = float(self.capability_limits(capability).get("cost", 1)) * count
+        if self.ledger is not None:
+            self.ledger.reserve(capability, units)
+        
+        bucket, concurrency = self._controls(server or capability, capability)
+        concurrency.acquire()
+        try:
+            for _ in range(count):
+                bucket.acquire()
+        except BaseException:
+            concurrency.release("error")
+            if self.ledger is not None:
+                self.ledger.settle(capability, units, used=False)
+            raise
+        return _Permit(self, capability, units, count, bucket, concurrency)
+    
+    def snapshot(self):
+        """現在のAIMD上限・実行中数（デバッグ・テスト用）"""
+        with self._lock:
+            return {key: {"limit": round(limiter.limit, 2), "in_flight": limiter.in_flight}
+                    for key, limiter in self._concurrency.items()}
+
+class _Permit:
+    """1リクエスト分の送信許可。終了時の例外からok / throttled / errorを判定して返却"""
+    
+    def __init__(self, limiter, capability, units, count, bucket, concurrency):
+        self.limiter = limiter
+        self.capability = capability
+        self.units = units
+        self.count = count
+        self.bucket = bucket
+        self.concurrency = concurrency
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        if exc is None:
+            outcome = "ok"
+        elif is_throttle_error(exc):
+            outcome = "throttled"
+            self.bucket.drain()
+        else:
+            outcome = "error"
+        self.concurrency.release(outcome)
+        if self.limiter.ledger is not None:
+            self.limiter.ledger.settle(self.capability, self.units, used=outcome == "ok", requests=self.count)
+        return False
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Retry Policy - 一時的なエラーの指数バックオフ再試行と、遅いリクエストのヘッジ
+"""
+
+import os
+import queue
+import random
+import threading
+import contextvars
+
+from rate_limiter import QuotaExceededError, is_throttle_error
+from download_manager import DownloadError
+from deadline import Cancelled, current_deadline
+from tracing import get_logger
+
+logger = get_logger(__name__)
+
+# 再試行しない（設定・認証・安全性の問題）エラーの手がかり
+PERMANENT_MARKERS = (
+    "not found", "api key", "authentication", "unauthorized", "forbidden", "permission",
+    "invalid", "未対応", "許可されていません", "見つかりません",
+)
+
+# 再試行する（ネットワーク・一時的な障害）エラーの手がかり
+TRANSIENT_MARKERS = (
+    "timeout", "timed out", "connection", "temporarily", "unavailable", "reset by peer",
+    "http 500", "http 502", "http 503", "http 504", "claude code error (exit",
+    "接続できません", "タイムアウト",
+)
+
+class RetryableError(Exception):
+    """再試行で解消する可能性のあるエラー（例: レスポンスにURLがない）"""
+
+class GenerationError(Exception):
+    """再試行しても生成物を得られなかった"""
+
+def is_transient(error):
+    """例外が再試行に値する一時的なエラーか"""
+    if isinstance(error, (QuotaExceededError, Cancelled)):
+        return False
+    if isinstance(error, RetryableError) or is_throttle_error(error):
+        return True
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    if isinstance(error, DownloadError):
+        # 途中切断・サイズ不一致・Range拒否は取り直せば解消しうる（キャンセル起因・HTTP 4xxは除く）
+        cause = error.__cause__ or error.__context__
+        if isinstance(cause, Cancelled):
+            return False
+        response = getattr(cause, "response", None)
+        if response is not None:
+            return response.status_code >= 500 or response.status_code in (408, 429)
+        return True
+    status_code = getattr(error, "status_code", None)
+    if status_code is not None:
+        return status_code >= 500 or status_code in (408, 429)
+    text = str(error).lower()
+    if any(marker in text for marker in PERMANENT_MARKERS):
+        return False
+    return any(marker in text for marker in TRANSIENT_MARKERS)
+
+class RetryPolicy:
+    """上限付き・フルジッター指数バックオフの再試行"""
+    
+    def __init__(self, max_attempts=None, base_delay=None, max_delay=60.0, classify=is_transient,
+                 sleep=None, rng=random.random):
+        if max_attempts is None:
+            max_attempts = int(os.getenv("KAMUI_RETRY_ATTEMPTS", "3"))
+        if base_delay is None:
+            base_delay = float(os.getenv("KAMUI_RETRY_BASE_DELAY", "2.0"))
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.classify = classify
+        # 既定の待機は現在の期限に従う（キャンセルで即座に中断、期限を過ぎる待機はしない）
+        self._sleep = sleep or (lambda seconds: current_deadline().sleep(seconds))
+        self._rng = rng
+    
+    def delay(self, attempt):
+        """attempt回目の失敗後の待機秒数（0〜min(max_delay, base·2^(attempt-1)) の一様乱数）"""
+        return self._rng() * min(self.max_delay, self.base_delay * (2 ** (attempt - 1)))
+    
+    def call(self, func, *args, description="request", **kwargs):
+        """funcを実行し、一時的なエラーなら待機して再試行（上限到達・恒久的なエラーはそのまま送出）"""
+        for attempt in range(1, self.max_attempts + 1):
+            current_deadline().check()
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                if attempt >= self.max_attempts or not self.classify(e):
+                    raise
+                delay = self.delay(attempt)
+                logger.warning(f"🔁 {description} failed (attempt {attempt}/{self.max_attempts}), "
+                               f"retrying in {delay:.1f}s: {e}")
+                self._sleep(delay)
+
+def hedged_call(func, primary, alternate, hedge_after):
+    """func(primary) が hedge_after 秒で終わらなければ func(alternate) も開始し、先に成功した方を返す
+    
+    戻り値は (採用したキー, 結果)。両方失敗した場合は最初のエラーを送出する。
+    各呼び出しは呼び出し元の期限の子で実行し、勝負がついたら負けた方をキャンセルする
+    （claude_pool・call_claude_with_kamui がプロセスを止めて枠を返す）。
+    """
+    results = queue.Queue()
+    parent = current_deadline()
+    deadlines = {}
+    
+    def run(key):
+        try:
+            results.put((key, True, func(key)))
+        except Exception as e:
+            results.put((key, False, e))
+    
+    def start(key):
+        # トレースのコンテキストを引き継ぎ、呼び出しごとの子の期限の下で実行
+        context = contextvars.copy_context()
+        deadlines[key] = parent.child()
+        threading.Thread(target=context.run, args=(deadlines[key].run, run, key),
+                         daemon=True, name=f"hedge-{key}").start()
+    
+    start(primary)
+    pending = 1
+    hedged = False
+    errors = []
+    try:
+        while pending:
+            try:
+                key, ok, value = results.get(timeout=None if hedged else parent.timeout(hedge_after))
+            except queue.Empty:
+                parent.check()
+                logger.info(f"🪁 {primary} exceeded p95 ({hedge_after:.1f}s), hedging with {alternate}")
+                start(alternate)
+                pending += 1
+                hedged = True
+                continue
+            pending -= 1
+            if ok:
+                for loser, deadline in deadlines.items():
+                    if loser != key:
+                        deadline.cancel(f"{key} が先に完了しました")
+                return key, value
+            errors.append(value)
+        # 主リクエストがヘッジ前に失敗した場合はヘッジせずに送出（再試行はRetryPolicyに任せる）
+        raise errors[0]
+    finally:
+        for deadline in deadlines.values():
+            deadline.detach()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Tracing - ステージごとの計測スパン（Chrome trace互換JSONL出力）とレベル制御付きロガー
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import logging
+import threading
+import contextvars
+from pathlib import Path
+from contextlib import contextmanager
+
+LOG_LEVELS = ("debug", "info", "warning", "error")
+
+# プロファイル集計でグループ化するスパン属性
+PROFILE_GROUP_ATTRIBUTES = ("operation", "server")
+
+_current_span = contextvars.ContextVar("kamui_current_span", default=None)
+
+def get_logger(name):
+    """モジュール用ロガー（kamui.* 配下、configure_loggingでレベルを一括制御）"""
+    return logging.getLogger("kamui." + name.rsplit(".", 1)[-1])
+
+def configure_logging(level=None, stream=None):
+    """kamui.* ロガーの出力先とレベルを設定（デフォルトは KAMUI_LOG_LEVEL または info）"""
+    if level is None:
+        level = os.getenv("KAMUI_LOG_LEVEL", "info")
+    root = logging.getLogger("kamui")
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    root.addHandler(handler)
+    root.setLevel(getattr(logging, level.upper()))
+    root.propagate = False
+    return root
+
+def percentile(values, q):
+    """最近傍法のパーセンタイル（valuesが空ならNone）"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+class Span:
+    """実行中のスパン（set()で属性を後から追加できる）"""
+    
+    def __init__(self, name, attributes, parent_id):
+        self.name = name
+        self.attributes = attributes
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.start_us = time.time_ns() // 1000
+        self._start = time.perf_counter()
+        self.duration = None
+        self.error = None
+    
+    def set(self, key, value):
+        self.attributes[key] = value
+
+class _NullSpan:
+    """計測無効時のスパン（何もしない）"""
+    
+    def set(self, key, value):
+        pass
+
+_NULL_SPAN = _NullSpan()
+
+class Tracer:
+    """スパンを記録し、Chrome trace形式のJSONLとステージ別集計を出力"""
+    
+    def __init__(self):
+        self.enabled = False
+        self.trace_id = uuid.uuid4().hex
+        self.path = None
+        self.spans = []
+        self._file = None
+        self._lock = threading.Lock()
+    
+    def start(self, path=None):
+        """計測を開始（pathを指定するとスパンをJSONLに逐次追記）"""
+        self.enabled = True
+        if path is not None:
+            self.path = Path(path)
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._file = open(self.path, "a", encoding="utf-8")
+    
+    @contextmanager
+    def span(self, name, **attributes):
+        """with tracer.span("download", url=url) as span: ... の区間を計測"""
+        if not self.enabled:
+            yield _NULL_SPAN
+            return
+        parent = _current_span.get()
+        span = Span(name, attributes, parent.span_id if parent else None)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            _current_span.reset(token)
+            span.duration = time.perf_counter() - span._start
+            self._record(span)
+    
+    def _record(self, span):
+        event = {
+            "name": span.name,
+            "cat": span.name.split(".", 1)[0],
+            "ph": "X",
+            "ts": span.start_us,
+            "dur": int(span.duration * 1_000_000),
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": dict(span.attributes, trace_id=self.trace_id, span_id=span.span_id,
+                         parent_span_id=span.parent_id),
+        }
+        if span.error:
+            event["args"]["error"] = span.error
+        with self._lock:
+            self.spans.append(span)
+            if self._file is not None:
+                self._file.write(json.dumps(event, ensure_ascii=False, default=str) + "\n")
+                self._file.flush()
+    
+    def summary(self):
+        """ステージ（スパン名）ごと、および operation / server ごとの件数・p50・p95・合計秒数"""
+        groups = {}
+        with self._lock:
+            spans = list(self.spans)
+        for span in spans:
+            keys = [(span.name, None, None)]
+            for attribute in PROFILE_GROUP_ATTRIBUTES:
+                if span.attributes.get(attribute):
+                    keys.append((span.name, attribute, str(span.attributes[attribute])))
+            for key in keys:
+                groups.setdefault(key, []).append(span.duration)
+        
+        rows = []
+        for (name, attribute, value), durations in sorted(groups.items(), key=lambda item: (
+                item[0][0], item[0][1] or "", item[0][2] or "")):
+            rows.append({
+                "stage": name,
+                "group": f"{attribute}={value}" if attribute else "",
+                "count": len(durations),
+                "p50": percentile(durations, 0.5),
+                "p95": percentile(durations, 0.95),
+                "total": sum(durations),
+            })
+        return rows
+    
+    def format_summary(self):
+        """summary() を表形式の文字列に整形"""
+        rows = self.summary()
+        if not rows:
+            return "(no spans recorded)"
+        header = f"{'stage':<22} {'group':<40} {'count':>5} {'p50 s':>9} {'p95 s':>9} {'total s':>9}"
+        lines = [header, "-" * len(header)]
+        for row in rows:
+            lines.append(f"{row['stage']:<22} {row['group'][:40]:<40} {row['count']:>5} "
+                         f"{row['p50']:>9.3f} {row['p95']:>9.3f} {row['total']:>9.3f}")
+        return "\n".join(lines)
+    
+    def close(self):
+        """JSONLを閉じ、Chrome / Perfettoで開ける .json（traceEvents形式）も書き出す"""
+        with self._lock:
+            if self._file is None:
+                return None
+            self._file.close()
+            self._file = None
+        events = []
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    events.append(json.loads(line))
+        chrome_path = self.path.with_suffix(".json")
+        with open(chrome_path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, ensure_ascii=False)
+        return chrome_path
+
+    def reset(self):
+        """計測を停止して記録済みスパンを破棄（常駐プロセスでジョブごとに計測し直す場合）"""
+        self.close()
+        with self._lock:
+            self.enabled = False
+            self.spans = []
+            self.path = None
+            self.trace_id = uuid.uuid4().hex
+
+# プロセス全体で共有するトレーサー
+tracer = Tracer()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+URL Extractor - レスポンスから生成物URLを1パスで抽出し、操作に応じて順位付け
+"""
+
+import re
+import json
+
+# 操作ごとに期待するメディア拡張子（先頭ほど優先）
+OPERATION_MEDIA_TYPES = {
+    "generate_image": ("png", "jpg", "jpeg", "webp", "gif"),
+    "generate_video": ("mp4", "mov", "webm"),
+    "generate_music": ("mp3", "wav", "m4a", "ogg", "flac"),
+    "generate_3d_model": ("glb", "gltf", "obj", "fbx"),
+    "image_to_video": ("mp4", "mov", "webm"),
+    "image_to_3d": ("glb", "gltf", "obj", "fbx"),
+}
+
+MEDIA_EXTENSIONS = frozenset(ext for exts in OPERATION_MEDIA_TYPES.values() for ext in exts)
+
+# 拡張子がなくても生成物とみなすホスト
+MEDIA_HOSTS = ("storage.googleapis.com", "fal.media")
+MEDIA_HOST_SUFFIXES = (".googleusercontent.com", ".fal.media")
+
+URL_PATTERN = re.compile(r"""https?://[^\s<>"'`\]\[(){}|\\^]+""")
+JSON_BLOCK_PATTERN = re.compile(r"```(?:json)?\s*([\[{].*?[\]}])\s*```", re.DOTALL)
+
+TRAILING_PUNCTUATION = ".,;:!?*"
+
+# 順位: 期待する種類 < 拡張子なしの既知ホスト < 別種類のメディア
+RANK_EXPECTED = 0
+RANK_UNKNOWN = 1
+RANK_OTHER_MEDIA = 2
+
+def _split_url(url):
+    """URLをホストとパスに分割（urlparseより軽量）"""
+    rest = url.partition("://")[2]
+    end = len(rest)
+    for separator in "?#":
+        index = rest.find(separator)
+        if index != -1 and index < end:
+            end = index
+    location = rest[:end]
+    host, slash, path = location.partition("/")
+    return host.rpartition("@")[2].partition(":")[0].lower(), slash + path
+
+def _classify(url):
+    """URLのホストと拡張子（小文字、なければ空文字）"""
+    host, path = _split_url(url)
+    name = path.rpartition("/")[2]
+    dot = name.rfind(".")
+    return host, name[dot + 1:].lower() if dot != -1 else ""
+
+def url_extension(url):
+    """URLパスの拡張子（小文字、なければ空文字）"""
+    return _classify(url)[1]
+
+def _is_media(host, extension):
+    return (extension in MEDIA_EXTENSIONS or host in MEDIA_HOSTS
+            or host.endswith(MEDIA_HOST_SUFFIXES))
+
+def is_media_url(url):
+    """生成物のURLとみなせるか"""
+    return _is_media(*_classify(url))
+
+def _rank(extension, expected):
+    if expected is None:
+        return RANK_EXPECTED if extension in MEDIA_EXTENSIONS else RANK_UNKNOWN
+    if extension in expected:
+        return RANK_EXPECTED
+    if extension in MEDIA_EXTENSIONS:
+        return RANK_OTHER_MEDIA
+    return RANK_UNKNOWN
+
+def media_rank(url, operation=None):
+    """操作に対するURLの順位（小さいほど優先）"""
+    return _rank(url_extension(url), OPERATION_MEDIA_TYPES.get(operation))
+
+def _clean(url):
+    return url.rstrip(TRAILING_PUNCTUATION)
+
+def _urls_in_json(value, found):
+    """JSON値から再帰的にURL文字列を収集（出現順）"""
+    if isinstance(value, str):
+        if value.startswith(("http://", "https://")):
+            found.append(value)
+    elif isinstance(value, dict):
+        for item in value.values():
+            _urls_in_json(item, found)
+    elif isinstance(value, list):
+        for item in value:
+            _urls_in_json(item, found)
+    return found
+
+def extract_structured_result(response_text):
+    """レスポンス中の構造化JSON（全体またはコードブロック）を返す"""
+    stripped = response_text.strip()
+    if stripped[:1] in ("{", "["):
+        try:
+            return json.loads(stripped)
+        except ValueError:
+            pass
+    if "```" in response_text:
+        for match in JSON_BLOCK_PATTERN.finditer(response_text):
+            try:
+                return json.loads(match.group(1))
+            except ValueError:
+                continue
+    return None
+
+def extract_urls(response_text, operation=None):
+    """生成物URLを抽出（構造化JSON優先・出現順・メディア種類で順位付け）"""
+    candidates = []
+    structured = extract_structured_result(response_text)
+    if structured is not None:
+        candidates.extend(_urls_in_json(structured, []))
+    candidates.extend(URL_PATTERN.findall(response_text))
+    
+    expected = OPERATION_MEDIA_TYPES.get(operation)
+    ranked = []
+    for url in dict.fromkeys(candidates):
+        if url[-1] in TRAILING_PUNCTUATION:
+            url = _clean(url)
+        host, extension = _classify(url)
+        if _is_media(host, extension):
+            ranked.append((_rank(extension, expected), len(ranked), url))
+    
+    # 同順位内は出現順（構造化JSONが先）を維持
+    ranked.sort()
+    return list(dict.fromkeys(url for _, _, url in ranked))
+
+def extract_item_urls(response_text, operation=None):
+    """一括生成レスポンスの {"results": [{"id", "url"}]} から 項目ID → URL を取得"""
+    structured = extract_structured_result(response_text)
+    if isinstance(structured, dict):
+        structured = structured.get("results")
+    if not isinstance(structured, list):
+        return {}
+    
+    item_urls = {}
+    for entry in structured:
+        if not isinstance(entry, dict) or entry.get("id") is None or not isinstance(entry.get("url"), str):
+            continue
+        urls = extract_urls(entry["url"], operation)
+        if urls:
+            item_urls[str(entry["id"])] = urls[0]
+    return item_urls
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""
+Workflow Executor - 宣言的なDAGワークフロー（YAML/JSON）の並列実行
+"""
+
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+import contextvars
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from generation_cache import file_digest
+from mcp_safety import operation_registry
+from tracing import get_logger, tracer
+
+logger = get_logger(__name__)
+
+try:
+    import yaml
+except ImportError:  # PyYAMLがなければJSONのみ対応
+    yaml = None
+
+# ${node_id} / ${vars.name} の参照
+REFERENCE_PATTERN = re.compile(r"\$\{([A-Za-z0-9_.-]+)\}")
+
+def load_workflow(workflow_path):
+    """ワークフローファイル（YAML/JSON）を読み込み"""
+    workflow_path = Path(workflow_path)
+    if not workflow_path.exists():
+        raise Exception(f"ワークフローファイルが見つかりません: {workflow_path}")
+    
+    with open(workflow_path, "r", encoding="utf-8") as f:
+        if workflow_path.suffix.lower() in (".yml", ".yaml"):
+            if yaml is None:
+                raise Exception("YAMLワークフローにはPyYAMLが必要です（pip install PyYAML）")
+            workflow = yaml.safe_load(f)
+        else:
+            workflow = json.load(f)
+    
+    if not isinstance(workflow, dict) or not isinstance(workflow.get("nodes"), dict):
+        raise Exception(f"ワークフローにnodesがありません: {workflow_path}")
+    workflow.setdefault("name", workflow_path.stem)
+    workflow.setdefault("vars", {})
+    return workflow
+
+def _references(value):
+    """パラメータ中の参照（vars以外）を収集"""
+    found = set()
+    if isinstance(value, str):
+        for name in REFERENCE_PATTERN.findall(value):
+            if not name.startswith("vars."):
+                found.add(name)
+    elif isinstance(value, dict):
+        for item in value.values():
+            found |= _references(item)
+    elif isinstance(value, list):
+        for item in value:
+            found |= _references(item)
+    return found
+
+def _resolve(value, outputs, variables):
+    """参照を実際の値に置換（文字列全体が参照なら値をそのまま返す）"""
+    if isinstance(value, str):
+        def lookup(name):
+            if name.startswith("vars."):
+                key = name[len("vars."):]
+                if key not in variables:
+                    raise Exception(f"未定義の変数: {key}")
+                return variables[key]
+            return outputs[name]
+        
+        whole = REFERENCE_PATTERN.fullmatch(value)
+        if whole:
+            return lookup(whole.group(1))
+        return REFERENCE_PATTERN.sub(lambda m: str(lookup(m.group(1))), value)
+    if isinstance(value, dict):
+        return {key: _resolve(item, outputs, variables) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_resolve(item, outputs, variables) for item in value]
+    return value
+
+class WorkflowExecutor:
+    """依存関係が解決したノードから順に並列実行"""
+    
+    def __init__(self, workflow, operations, state_path=None, max_parallel=4, variables=None):
+        self.workflow = workflow
+        self.operations = operations
+        self.state_path = Path(state_path) if state_path else None
+        self.max_parallel = max(1, max_parallel)
+        self.variables = dict(workflow.get("vars", {}))
+        self.variables.update(variables or {})
+        self._state_lock = threading.Lock()
+        
+        self.nodes = {}
+        for node_id, spec in workflow["nodes"].items():
+            if "op" not in spec:
+                raise Exception(f"ノード {node_id}: opがありません")
+            if spec["op"] not in operations:
+                raise Exception(f"ノード {node_id}: 未対応の操作 {spec['op']}")
+            params = spec.get("params", {})
+            needs = set(spec.get("needs", [])) | _references(params)
+            for dependency in needs:
+                if dependency not in workflow["nodes"]:
+                    raise Exception(f"ノード {node_id}: 未定義のノード {dependency} を参照しています")
+            self.nodes[node_id] = {"op": spec["op"], "params": params, "needs": needs}
+        self._check_acyclic()
+    
+    def _check_acyclic(self):
+        remaining = {node_id: set(node["needs"]) for node_id, node in self.nodes.items()}
+        while remaining:
+            ready = [node_id for node_id, needs in remaining.items() if not needs]
+            if not ready:
+                raise Exception(f"ワークフローに循環依存があります: {sorted(remaining)}")
+            for node_id in ready:
+                del remaining[node_id]
+            for needs in remaining.values():
+                needs.difference_update(ready)
+    
+    def _load_state(self):
+        if self.state_path is None or not self.state_path.exists():
+            return {}
+        try:
+            with open(self.state_path, "r") as f:
+                return json.load(f)
+        except (json.JSONDecodeError, OSError):
+            return {}
+    
+    def _save_node_state(self, fingerprint, entry):
+        if self.state_path is None:
+            return
+        with self._state_lock:
+            state = self._load_state()
+            state[fingerprint] = entry
+            self.state_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.state_path.with_name(f".{self.state_path.name}.{os.getpid()}.tmp")
+            with open(tmp_path, "w") as f:
+                json.dump(state, f, indent=1, sort_keys=True)
+            os.replace(tmp_path, self.state_path)
+    
+    @staticmethod
+    def _output_digest(output):
+        """出力の内容ダイジェスト（ファイルでなければ値そのもの）"""
+        if isinstance(output, str) and os.path.isfile(output):
+            return file_digest(output)
+        return json.dumps(output, sort_keys=True, default=str)
+    
+    def _fingerprint(self, node, digests):
+        """操作・パラメータ・入力内容から決まるノードの指紋（params で参照しない needs の出力内容も含む）"""
+        params = _resolve(node["params"], digests, self.variables)
+        fields = {"op": node["op"], "params": params}
+        if node["needs"]:
+            fields["needs"] = {dependency: digests[dependency] for dependency in node["needs"]}
+        payload = json.dumps(fields, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+    
+    def _run_node(self, node_id, outputs, digests):
+        with tracer.span("workflow.node", node=node_id, operation=self.nodes[node_id]["op"]) as span:
+            result = self._execute_node(node_id, outputs, digests)
+            span.set("status", result["status"])
+            return result
+    
+    def _execute_node(self, node_id, outputs, digests):
+        node = self.nodes[node_id]
+        fingerprint = self._fingerprint(node, digests)
+        
+        cached = self._load_state().get(fingerprint)
+        if cached and self._output_digest(cached["output"]) == cached["digest"]:
+            return {"status": "cached", "output": cached["output"], "elapsed_seconds": 0.0}
+        
+        params = _resolve(node["params"], outputs, self.variables)
+        start = time.monotonic()
+        output = self.operations[node["op"]](**params)
+        elapsed = round(time.monotonic() - start, 3)
+        
+        # 生成系はファイルが実際に作られた場合のみ成功（失敗結果を再利用しない）
+        if operation_registry.kind(node["op"]) == "generation" and not (isinstance(output, str) and os.path.isfile(output)):
+            raise Exception(f"出力ファイルが作成されませんでした: {output}")
+        
+        self._save_node_state(fingerprint, {"node": node_id, "op": node["op"], "output": output,
+                                            "digest": self._output_digest(output)})
+        return {"status": "done", "output": output, "elapsed_seconds": elapsed}
+    
+    def run(self):
+        """ワークフローを実行し、ノードごとの結果を返す"""
+        results = {}
+        outputs = {}
+        digests = {}
+        pending = dict(self.nodes)
+        running = {}
+        
+        with ThreadPoolExecutor(max_workers=self.max_parallel, thread_name_prefix="workflow") as executor:
+            while pending or running:
+                # 依存が失敗したノードはスキップ
+                for node_id in [n for n, node in pending.items()
+                                if any(results.get(dep, {}).get("status") in ("failed", "skipped") for dep in node["needs"])]:
+                    del pending[node_id]
+                    results[node_id] = {"status": "skipped", "output": None, "elapsed_seconds": 0.0}
+                    logger.warning(f"⏭️ {node_id}: skipped (dependency failed)")
+                
+                for node_id in [n for n, node in pending.items() if node["needs"] <= outputs.keys()]:
+                    del pending[node_id]
+                    logger.info(f"▶️ {node_id}: {self.nodes[node_id]['op']}")
+                    running[executor.submit(contextvars.copy_context().run, self._run_node, node_id,
+                                            dict(outputs), dict(digests))] = node_id
+                
+                if not running:
+                    break
+                
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    node_id = running.pop(future)
+                    try:
+                        result = future.result()
+                        outputs[node_id] = result["output"]
+                        digests[node_id] = self._output_digest(result["output"])
+                        icon = "♻️" if result["status"] == "cached" else "✅"
+                        logger.info(f"{icon} {node_id}: {result['output']}")
+                    except Exception as e:
+                        result = {"status": "failed", "output": None, "error": str(e), "elapsed_seconds": 0.0}
+                        logger.error(f"❌ {node_id}: {e}")
+                    results[node_id] = result
+        
+        return {node_id: results[node_id] for node_id in self.nodes}
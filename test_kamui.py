@@ -3,7 +3,12 @@
 Kamui MCP テストスクリプト
 """
 
+import io
+import json
 import sys
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from pathlib import Path
 
 # srcディレクトリをパスに追加
@@ -73,13 +78,2000 @@ def test_safety_controls():
         print(f"❌ Safety test failed: {e}")
         return False
 
+def test_parallel_generation():
+    """--type all 並列実行のテスト（生成はスタブ）"""
+    print("\n⚡ Testing parallel generation...")
+    
+    import time
+    import generate
+    
+    def fake_generator(asset_type, delay):
+        def _generate(prompt):
+            time.sleep(delay)
+            return f"{asset_type}:{prompt}"
+        return _generate
+    
+    scene_inputs = []
+    def fake_scene(assets, scene_config):
+        scene_inputs.extend(assets)
+        return "scene"
+    
+    originals = {name: getattr(generate, name) for name in
+                 ["generate_image", "generate_video", "generate_music", "generate_3d_model", "create_3d_scene"]}
+    try:
+        generate.generate_image = fake_generator("image", 0.2)
+        generate.generate_video = fake_generator("video", 0.3)
+        generate.generate_music = fake_generator("music", 0.1)
+        generate.generate_3d_model = fake_generator("3d", 0.2)
+        generate.create_3d_scene = fake_scene
+        
+        start = time.monotonic()
+        results = generate.run_generation("all", "p", max_parallel=4)
+        elapsed = time.monotonic() - start
+    finally:
+        for name, func in originals.items():
+            setattr(generate, name, func)
+    
+    assert results == ["image:p", "video:p", "music:p", "3d:p", "scene"], results
+    assert scene_inputs == ["image:p", "3d:p"], scene_inputs
+    assert elapsed < 0.6, f"generations did not overlap ({elapsed:.2f}s)"
+    print(f"✅ Parallel generation finished in {elapsed:.2f}s")
+    return True
+
+def _write_temp_kamui_config(directory):
+    """テスト用のKamui MCP設定を作成し、safety_controllerに設定"""
+    config_path = Path(directory) / "mcp-kamuicode.json"
+    source = Path(__file__).parent / "workflows" / "mcp-kamuicode.json"
+    config_path.write_text(source.read_text())
+    safety_controller.kamui_config_path = str(config_path)
+    return config_path
+
+def test_batch_mode():
+    """バッチモードのテスト（Claude呼び出しはスタブ）"""
+    print("\n📦 Testing batch mode...")
+    
+    from batch import load_batch_items, run_batch
+    
+    original_config = safety_controller.kamui_config_path
+    with tempfile.TemporaryDirectory() as tmp:
+        try:
+            config_path = _write_temp_kamui_config(tmp)
+            
+            jsonl_path = Path(tmp) / "items.jsonl"
+            jsonl_path.write_text(
+                '{"prompt": "red circle", "style": "minimal"}\n'
+                '\n'
+                '{"type": "music", "prompt": "FAIL", "duration": 10}\n'
+            )
+            csv_path = Path(tmp) / "items.csv"
+            csv_path.write_text("type,prompt,style,duration,aspect_ratio,output_name\n"
+                                "video,ocean waves,,8,,waves.mp4\n")
+            
+            items = load_batch_items(jsonl_path) + load_batch_items(csv_path)
+            assert [item["type"] for item in items] == ["image", "music", "video"]
+            assert items[2]["duration"] == 8 and items[2]["output_name"] == "waves.mp4"
+            
+            client = KamuiMCPClient(config_path=str(config_path), outputs_dir=Path(tmp) / "outputs",
+                                    transport="claude")
+            def fake_call(kamui_prompt, working_dir=None, **kwargs):
+                if "FAIL" in kamui_prompt:
+                    raise Exception("simulated failure")
+                return "done: https://fal.media/files/result.png"
+            client.call_claude_with_kamui = fake_call
+            client.download_file = lambda url, output_path: str(output_path)
+            
+            output = io.StringIO()
+            summary = run_batch(client, items, max_workers=2, output=output)
+        finally:
+            safety_controller.kamui_config_path = original_config
+    
+    records = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert summary == {"total": 3, "ok": 2, "failed": 1}, summary
+    assert len(records) == 3
+    failed = [r for r in records if r["status"] == "failed"]
+    assert len(failed) == 1 and "simulated failure" in failed[0]["error"]
+    video = [r for r in records if r["type"] == "video"][0]
+    assert video["path"].endswith("waves.mp4") and video["url"] == "https://fal.media/files/result.png"
+    print(f"✅ Batch mode: {summary}")
+    return True
+
+def test_generation_cache():
+    """生成キャッシュのテスト（ヒット時はClaudeを呼ばない）"""
+    print("\n♻️ Testing generation cache...")
+    
+    from generation_cache import GenerationCache, cache_key
+    
+    key = cache_key("generate_image", {"prompt": "a", "style": "minimal"})
+    assert key == cache_key("generate_image", {"style": "minimal", "prompt": "a"})
+    assert key != cache_key("generate_image", {"prompt": "a", "style": "minimal"}, server="t2i-google-imagen3")
+    
+    original_config = safety_controller.kamui_config_path
+    with tempfile.TemporaryDirectory() as tmp:
+        try:
+            config_path = _write_temp_kamui_config(tmp)
+            client = KamuiMCPClient(config_path=str(config_path), outputs_dir=Path(tmp) / "outputs",
+                                    transport="claude")
+            
+            calls = []
+            def fake_call(kamui_prompt, working_dir=None, **kwargs):
+                calls.append(kamui_prompt)
+                return "https://fal.media/files/result.png"
+            def fake_download(url, output_path):
+                Path(output_path).write_bytes(b"png-bytes")
+                return str(output_path)
+            client.call_claude_with_kamui = fake_call
+            client.download_file = fake_download
+            
+            first = client.generate_image("red circle", style="minimal")
+            second = client.generate_image("red circle", style="minimal")
+            assert first == second and len(calls) == 1, calls
+            
+            # 出力が消えてもキャッシュから復元される
+            Path(first).unlink()
+            assert client.generate_image("red circle", style="minimal") == first
+            assert Path(first).read_bytes() == b"png-bytes" and len(calls) == 1
+            
+            client.cache_mode = "refresh"
+            client.generate_image("red circle", style="minimal")
+            assert len(calls) == 2
+            
+            client.cache_mode = "off"
+            client.generate_image("blue square", style="minimal")
+            client.cache_mode = "use"
+            client.generate_image("blue square", style="minimal")
+            assert len(calls) == 4
+            
+            # キャッシュは生成したサーバーごと（指定なしの生成物は同じサーバーの指定でも使い、別サーバーの指定では使わない）
+            servers = ["t2i-google-imagen3", "t2i-google-imagen3-fast"]
+            result = client.generate_asset("image", "green star", style="minimal")
+            assert result["server"] in servers and not result["cached"]
+            other = [name for name in servers if name != result["server"]][0]
+            again = client.generate_asset("image", "green star", style="minimal", server=result["server"])
+            assert again["cached"] and again["server"] == result["server"] and len(calls) == 5
+            assert not client.generate_asset("image", "green star", style="minimal", server=other)["cached"]
+            assert len(calls) == 6
+            assert client.generate_asset("image", "green star", style="minimal")["cached"]
+            
+            # サイズ上限を超えたら古いものから削除
+            cache = GenerationCache(Path(tmp) / "small-cache", max_bytes=10)
+            for name in ["a", "b"]:
+                artifact = Path(tmp) / f"{name}.bin"
+                artifact.write_bytes(b"12345678")
+                cache.store(name, artifact)
+            assert cache.lookup("a") is None and cache.lookup("b") is not None
+        finally:
+            safety_controller.kamui_config_path = original_config
+    
+    print("✅ Generation cache works")
+    return True
+
+class _StandInMCPHandler(BaseHTTPRequestHandler):
+    """ローカルのMCPサーバー代替（/t2i: 同期ツール, /t2v: submit/status/result + SSE）"""
+    
+    media = b"fake-media-bytes"
+    
+    def log_message(self, format, *args):
+        pass
+    
+    def _send(self, status, body=b"", content_type="application/json", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def do_GET(self):
+        if self.path.startswith("/media/"):
+            self._send(200, self.media, content_type="application/octet-stream")
+        else:
+            self._send(404)
+    
+    def do_POST(self):
+        message = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if "id" not in message:
+            self._send(202)
+            return
+        
+        server = self.server
+        server.calls.append((self.path, message["method"], message.get("params", {})))
+        base_url = f"http://127.0.0.1:{server.server_port}"
+        async_mode = self.path == "/t2v"
+        
+        if message["method"] == "initialize":
+            result = {"protocolVersion": "2025-03-26", "capabilities": {"tools": {}},
+                      "serverInfo": {"name": "stand-in", "version": "0"}}
+        elif message["method"] == "tools/list":
+            schema = {"type": "object", "properties": {"prompt": {"type": "string"},
+                                                      "aspect_ratio": {"type": "string"},
+                                                      "duration": {"type": "string"}}}
+            if async_mode:
+                names = ["veo3_submit", "veo3_status", "veo3_result"]
+            else:
+                names = ["imagen_generate"]
+            result = {"tools": [{"name": name, "inputSchema": schema} for name in names]}
+        elif message["method"] == "tools/call":
+            name = message["params"]["name"]
+            if name == "veo3_submit":
+                text = json.dumps({"request_id": "req-0000-1111-2222"})
+            elif name == "veo3_status":
+                text = "COMPLETED"
+            elif name == "veo3_result":
+                text = f"Video ready: {base_url}/media/video.mp4"
+            else:
+                text = f"Image ready: {base_url}/media/image.png"
+            result = {"content": [{"type": "text", "text": text}]}
+        else:
+            self._send(200, json.dumps({"jsonrpc": "2.0", "id": message["id"],
+                                        "error": {"code": -32601, "message": "not found"}}).encode())
+            return
+        
+        body = json.dumps({"jsonrpc": "2.0", "id": message["id"], "result": result})
+        headers = {"Mcp-Session-Id": "session-1"}
+        if async_mode:
+            self._send(200, f"event: message\ndata: {body}\n\n".encode(),
+                       content_type="text/event-stream", headers=headers)
+        else:
+            self._send(200, body.encode(), headers=headers)
+
+def _start_stand_in_server(handler=_StandInMCPHandler):
+    """スタンドインHTTPサーバーをバックグラウンドで起動"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.calls = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def test_mcp_http_transport():
+    """MCP HTTP直接通信のテスト（ローカルのスタンドインサーバー使用）"""
+    print("\n🔌 Testing MCP HTTP transport...")
+    
+    from mcp_http import job_status, COMPLETED_STATES
+    
+    # 状態は完全一致で判定（「not completed」等の文中の語では完了としない）
+    assert job_status("COMPLETED") == "completed"
+    assert job_status('{"status": "IN_PROGRESS", "message": "not completed yet"}') == "in_progress"
+    assert job_status("Status: IN_QUEUE (will be completed soon)") == "in_queue"
+    assert job_status("Generation not completed yet") not in COMPLETED_STATES
+    
+    server = _start_stand_in_server()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    original_config = safety_controller.kamui_config_path
+    with tempfile.TemporaryDirectory() as tmp:
+        try:
+            config_path = Path(tmp) / "mcp-kamuicode.json"
+            config_path.write_text(json.dumps({"mcpServers": {
+                "t2i-local": {"type": "http", "url": f"{base_url}/t2i"},
+                "t2v-local": {"type": "http", "url": f"{base_url}/t2v"},
+                "t2m-offline": {"type": "http", "url": "http://127.0.0.1:9/t2m"},
+            }}))
+            safety_controller.kamui_config_path = str(config_path)
+            
+            client = KamuiMCPClient(config_path=str(config_path), outputs_dir=Path(tmp) / "outputs",
+                                    cache_mode="off", transport="http")
+            def no_subprocess(kamui_prompt, working_dir=None, **kwargs):
+                raise AssertionError("claude subprocess must not be used")
+            client.call_claude_with_kamui = no_subprocess
+            
+            image = client.generate_image("red circle", aspect_ratio="16:9")
+            assert Path(image).read_bytes() == _StandInMCPHandler.media
+            video = client.generate_video("waves", duration=5)
+            assert Path(video).read_bytes() == _StandInMCPHandler.media
+            
+            methods = [(path, method) for path, method, _ in server.calls]
+            assert methods.count(("/t2i", "initialize")) == 1
+            image_call = [params for path, method, params in server.calls
+                          if path == "/t2i" and method == "tools/call"][0]
+            assert image_call["arguments"]["aspect_ratio"] == "16:9"
+            assert image_call["arguments"]["prompt"].startswith("red circle")
+            assert ("/t2v", "tools/call") in methods
+            
+            # 接続できない場合はclaudeサブプロセスへフォールバック
+            client.transport = "auto"
+            fallback_calls = []
+            def fake_call(kamui_prompt, working_dir=None, **kwargs):
+                fallback_calls.append(kamui_prompt)
+                return f"{base_url}/media/music.mp3"
+            client.call_claude_with_kamui = fake_call
+            music = client.generate_music("calm piano")
+            assert len(fallback_calls) == 1 and Path(music).exists()
+            
+            # HTTPの待ち時間は現在の期限の残りで打ち切り、キャンセル後はポーリングせずに止まる
+            from mcp_http import MCPHttpTransport
+            from deadline import Deadline, Cancelled, deadline_scope
+            transport = MCPHttpTransport({"t2v-local": f"{base_url}/t2v"}, poll_interval=0.01)
+            timeouts = []
+            post = transport.http.post
+            def recording_post(*args, **kwargs):
+                timeouts.append(kwargs["timeout"])
+                return post(*args, **kwargs)
+            transport.http.post = recording_post
+            with deadline_scope(Deadline(5.0)):
+                assert "video.mp4" in transport.generate("t2v-local", {"prompt": "waves"})
+            assert timeouts and all(timeout <= 5.0 for timeout in timeouts), timeouts
+            job = Deadline()
+            job.cancel("SIGINT received")
+            calls_before = len(server.calls)
+            try:
+                with deadline_scope(job):
+                    transport.generate("t2v-local", {"prompt": "waves"})
+                raise AssertionError("cancelled job must not reach the server")
+            except Cancelled:
+                pass
+            assert len(server.calls) == calls_before
+            
+            # status/result だけのサーバーは StopIteration ではなく MCPHttpError
+            from mcp_http import MCPHttpError
+            session = transport.session("t2v-local")
+            session._tools = [{"name": "veo3_status"}, {"name": "veo3_result"}]
+            try:
+                transport.generate("t2v-local", {"prompt": "waves"})
+                raise AssertionError("a server without a generation tool must be rejected")
+            except MCPHttpError as e:
+                assert "生成ツールがありません" in str(e)
+            transport.close()
+        finally:
+            safety_controller.kamui_config_path = original_config
+            server.shutdown()
+    
+    print("✅ MCP HTTP transport works")
+    return True
+
+STUB_CLAUDE = """#!{python}
+import json, os, sys
+for line in sys.stdin:
+    message = json.loads(line)
+    text = message["message"]["content"][0]["text"]
+    if "CRASH" in text:
+        sys.exit(3)
+    print(json.dumps({{"type": "system", "subtype": "init"}}), flush=True)
+    print(json.dumps({{"type": "result", "subtype": "success", "is_error": False,
+                      "result": f"pid={{os.getpid()}} https://fal.media/files/out.png"}}), flush=True)
+"""
+
+def test_claude_worker_pool():
+    """常駐claudeワーカープールのテスト（claudeの代わりにスタブを使用）"""
+    print("\n♨️ Testing claude worker pool...")
+    
+    import os
+    from claude_pool import ClaudeWorkerPool, ClaudeWorkerError
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        stub = Path(tmp) / "claude"
+        stub.write_text(STUB_CLAUDE.format(python=sys.executable))
+        stub.chmod(0o755)
+        
+        pool = ClaudeWorkerPool([str(stub)], size=1, max_jobs_per_worker=2)
+        try:
+            pids = [pool.run("hello", timeout=10).split()[0] for _ in range(3)]
+            # 2ジョブまでは同じワーカーを再利用し、その後は再起動
+            assert pids[0] == pids[1] and pids[1] != pids[2], pids
+            
+            try:
+                pool.run("CRASH", timeout=10)
+                raise AssertionError("crash was not reported")
+            except ClaudeWorkerError:
+                pass
+            assert "fal.media" in pool.run("after crash", timeout=10)
+        finally:
+            pool.close()
+        
+        # KamuiMCPClient経由（KAMUI_CLAUDE_BINでスタブを指定）
+        original_config = safety_controller.kamui_config_path
+        os.environ["KAMUI_CLAUDE_BIN"] = str(stub)
+        try:
+            config_path = _write_temp_kamui_config(tmp)
+            client = KamuiMCPClient(config_path=str(config_path), outputs_dir=Path(tmp) / "outputs",
+                                    transport="claude", pool_size=2)
+            responses = [client.call_claude_with_kamui(f"prompt {i}") for i in range(3)]
+            assert all("fal.media" in response for response in responses)
+            assert len({response.split()[0] for response in responses}) == 1
+            client.close()
+        finally:
+            del os.environ["KAMUI_CLAUDE_BIN"]
+            safety_controller.kamui_config_path = original_config
+    
+    print("✅ Claude worker pool works")
+    return True
+
+def test_config_index():
+    """MCP設定キャッシュと機能別インデックスのテスト"""
+    print("\n🗂️ Testing MCP config index...")
+    
+    import os
+    from mcp_safety import MCPSafetyController
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        config_path = Path(tmp) / "mcp-kamuicode.json"
+        config_path.write_text(json.dumps({"mcpServers": {
+            "t2i-google-imagen3": {"type": "http", "url": "http://a"},
+            "t2i-google-imagen3-fast": {"type": "http", "url": "http://b"},
+            "i2i3d-fal-hunyuan3d-v21": {"type": "http", "url": "http://c"},
+        }}))
+        controller = MCPSafetyController(config_path=str(config_path))
+        
+        assert controller.verify_kamui_mcp_available("generate_image")
+        assert controller.servers_for_operation("generate_image") == ("t2i-google-imagen3", "t2i-google-imagen3-fast")
+        assert controller.servers_for_operation("image_to_3d") == ("i2i3d-fal-hunyuan3d-v21",)
+        # テキスト→3Dを画像→3Dのサーバーへ送らない
+        assert controller.servers_for_operation("generate_3d_model") == ()
+        try:
+            controller.verify_kamui_mcp_available("generate_music")
+            raise AssertionError("missing t2m- capability was not detected")
+        except Exception as e:
+            assert "t2m-" in str(e)
+        
+        # 変更がなければ再読み込みしない
+        index = controller._config_index
+        servers = index.servers
+        controller.verify_kamui_mcp_available()
+        assert index.servers is servers
+        
+        # mtimeが変われば再読み込み
+        config_path.write_text(json.dumps({"mcpServers": {
+            "t2m-google-lyria": {"type": "http", "url": "http://d"},
+        }}))
+        stat = config_path.stat()
+        os.utime(config_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+        assert controller.verify_kamui_mcp_available("generate_music")
+        assert controller.servers_for_operation("generate_image") == ()
+    
+    print("✅ MCP config index works")
+    return True
+
+def test_mcp_router():
+    """レイテンシ・エラー率に基づくルーティングのテスト"""
+    print("\n🧭 Testing MCP router...")
+    
+    from mcp_router import MCPRouter
+    
+    candidates = ["t2i-google-imagen3", "t2i-google-imagen3-fast"]
+    with tempfile.TemporaryDirectory() as tmp:
+        stats_path = Path(tmp) / "router_stats.json"
+        router = MCPRouter(stats_path, policy="fastest")
+        
+        # 未計測のサーバーから順に試す
+        first = router.choose("generate_image", candidates)
+        router.record(first, 2.0)
+        second = router.choose("generate_image", candidates)
+        assert second != first
+        router.record(second, 1.0)
+        assert router.choose("generate_image", candidates) == second
+        
+        # エラーが続くサーバーは避ける
+        for _ in range(3):
+            router.record(second, 1.0, ok=False)
+        assert router.choose("generate_image", candidates) == first
+        
+        # 統計は永続化され次回の実行でも使われる
+        reloaded = MCPRouter(stats_path, policy="fastest")
+        assert reloaded.stats[first]["latency_ewma"] == 2.0
+        assert reloaded.choose("generate_image", candidates) == first
+        
+        cheapest = MCPRouter(stats_path, policy="cheapest")
+        assert cheapest.choose("generate_image", candidates) == "t2i-google-imagen3-fast"
+        
+        # 失敗しか記録がないサーバーは避けるが、時間が経てば再度試す
+        flaky = ["t2i-a", "t2i-b"]
+        router = MCPRouter(None, policy="fastest")
+        router.record("t2i-a", 1.0)
+        router.record("t2i-b", 1.0, ok=False)
+        assert router.choose("generate_image", flaky) == "t2i-a"
+        router.stats["t2i-b"]["updated_at"] -= 3600
+        assert router.choose("generate_image", flaky) == "t2i-b"
+        router.record("t2i-b", 1.0, ok=False)
+        assert router.choose("generate_image", flaky) == "t2i-a"
+        
+        round_robin = MCPRouter(None, policy="round_robin")
+        picks = [round_robin.choose("generate_image", candidates) for _ in range(4)]
+        assert picks == candidates * 2
+    
+    print("✅ MCP router works")
+    return True
+
+STUB_CLAUDE_PRINT = """#!{python}
+import os, sys, time
+sys.stdin.read()
+print("Generating...", flush=True)
+print("Result: " + os.environ["STUB_URL"], flush=True)
+time.sleep(float(os.environ.get("STUB_SLEEP", "0")))
+print("Done.", flush=True)
+"""
+
+def test_streaming_response():
+    """逐次読み込み・早期ダウンロード・タイムアウトのテスト"""
+    print("\n⚡ Testing streaming response handling...")
+    
+    import os
+    import time
+    
+    server = _start_stand_in_server()
+    original_config = safety_controller.kamui_config_path
+    saved_env = {key: os.environ.get(key) for key in ["KAMUI_CLAUDE_BIN", "STUB_URL", "STUB_SLEEP"]}
+    with tempfile.TemporaryDirectory() as tmp:
+        try:
+            stub = Path(tmp) / "claude"
+            stub.write_text(STUB_CLAUDE_PRINT.format(python=sys.executable))
+            stub.chmod(0o755)
+            os.environ["KAMUI_CLAUDE_BIN"] = str(stub)
+            os.environ["STUB_URL"] = f"http://127.0.0.1:{server.server_port}/media/video.mp4"
+            os.environ["STUB_SLEEP"] = "1.0"
+            
+            config_path = _write_temp_kamui_config(tmp)
+            client = KamuiMCPClient(config_path=str(config_path), outputs_dir=Path(tmp) / "outputs",
+                                    cache_mode="off", transport="claude")
+            
+            download_times = []
+            original_download = client.download_file
+            def timed_download(url, output_path):
+                download_times.append(time.monotonic())
+                return original_download(url, output_path)
+            client.download_file = timed_download
+            
+            video = client.generate_video("waves")
+            finished = time.monotonic()
+            assert Path(video).read_bytes() == _StandInMCPHandler.media
+            # ダウンロードはプロセス終了（約1秒後）より前に開始されている
+            assert len(download_times) == 1 and finished - download_times[0] >= 0.8, download_times
+            
+            # 先に流れたURLが最上位でない・早期ダウンロードが失敗した場合は最上位のURLを取り直す
+            base = "https://fal.media/files"
+            for streamed, fails in ((f"{base}/preview.mp4", False), (f"{base}/final.mp4", True)):
+                fetched = []
+                def fake_attempt(request, on_url):
+                    on_url(streamed)
+                    return "t2v-fal-kling", [f"{base}/final.mp4", f"{base}/preview.mp4"]
+                def fake_download(url, output_path):
+                    fetched.append(url)
+                    if fails and len(fetched) == 1:
+                        return None
+                    Path(output_path).write_text(url)
+                    return str(output_path)
+                client._attempt_generation = fake_attempt
+                client.download_file = fake_download
+                video = client.generate_video("waves", output_name=f"early_{fails}")
+                assert fetched == [streamed, f"{base}/final.mp4"], fetched
+                assert Path(video).read_text() == f"{base}/final.mp4"
+            del client._attempt_generation
+            client.download_file = timed_download
+            
+            start = time.monotonic()
+            try:
+                client.call_claude_with_kamui("slow", timeout=0.3)
+                raise AssertionError("timeout was not enforced")
+            except Exception as e:
+                assert "timeout" in str(e)
+            assert time.monotonic() - start < 0.9
+            client.close()
+        finally:
+            for key, value in saved_env.items():
+                if value is None:
+                    os.environ.pop(key, None)
+                else:
+                    os.environ[key] = value
+            safety_controller.kamui_config_path = original_config
+            server.shutdown()
+    
+    print("✅ Streaming response handling works")
+    return True
+
+def test_url_extractor():
+    """URL抽出（出現順・メディア種類の順位付け・構造化JSON優先）のテスト"""
+    print("\n🔎 Testing URL extractor...")
+    
+    from url_extractor import extract_urls
+    
+    response = (
+        "Input image: https://storage.googleapis.com/bucket/input.png\n"
+        "See https://docs.example.com/guide for details.\n"
+        "Video: https://fal.media/files/a/output.mp4.\n"
+        "Alt: https://fal.media/files/b/output2.mp4?token=1\n"
+        "Again: https://fal.media/files/a/output.mp4\n"
+    )
+    for _ in range(5):
+        assert extract_urls(response, "generate_video") == [
+            "https://fal.media/files/a/output.mp4",
+            "https://fal.media/files/b/output2.mp4?token=1",
+            "https://storage.googleapis.com/bucket/input.png",
+        ]
+    assert extract_urls(response, "generate_image")[0] == "https://storage.googleapis.com/bucket/input.png"
+    
+    structured = response + '```json\n{"result": {"url": "https://fal.media/files/c/final.mp4"}}\n```'
+    assert extract_urls(structured, "generate_video")[0] == "https://fal.media/files/c/final.mp4"
+    
+    assert extract_urls('{"images": [{"url": "https://v3.fal.media/files/x/y"}]}') == ["https://v3.fal.media/files/x/y"]
+    assert extract_urls("no urls here") == []
+    
+    print("✅ URL extractor works")
+    return True
+
+class _RangeMediaHandler(BaseHTTPRequestHandler):
+    """Range対応のメディアサーバー（truncate_next: 次のレスポンスを途中で切断、short_next: 次のレスポンスを短く返す）"""
+    
+    payload = bytes(range(256)) * 4096
+    truncate_next = 0
+    short_next = 0
+    
+    def log_message(self, format, *args):
+        pass
+    
+    def do_GET(self):
+        start, end = 0, len(self.payload) - 1
+        status = 200
+        range_header = self.headers.get("Range")
+        if range_header:
+            first, _, last = range_header.split("=")[1].partition("-")
+            start, end = int(first), int(last) if last else len(self.payload) - 1
+            status = 206
+        body = self.payload[start:end + 1]
+        if self.server.short_next and len(body) > 1:
+            # Content-Length も短い本文に合わせる（接続エラーにならない不完全なレスポンス）
+            self.server.short_next -= 1
+            body = body[:len(body) // 2]
+        
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Accept-Ranges", "bytes")
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(self.payload)}")
+        self.end_headers()
+        
+        if self.server.truncate_next and len(body) > 1:
+            self.server.truncate_next -= 1
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+def test_download_manager():
+    """Range並列取得・再開・アトミック配置のテスト"""
+    print("\n📥 Testing download manager...")
+    
+    from download_manager import DownloadManager, DownloadError
+    
+    server = _start_stand_in_server(_RangeMediaHandler)
+    server.truncate_next = 0
+    server.short_next = 0
+    url = f"http://127.0.0.1:{server.server_port}/media/big.mp4"
+    payload = _RangeMediaHandler.payload
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        try:
+            # 大きなファイルはRangeセグメントで並列取得
+            manager = DownloadManager(chunk_size=64 * 1024, max_segments=4, min_segmented_size=256 * 1024,
+                                      read_timeout=5)
+            output = Path(tmp) / "segmented.mp4"
+            assert manager.download(url, output) == str(output)
+            assert output.read_bytes() == payload
+            
+            # 途中で切断された場合は最終パスに何も置かず、.partから再開
+            output = Path(tmp) / "resumed.mp4"
+            server.truncate_next = 2
+            try:
+                manager.download(url, output)
+                raise AssertionError("truncated download was not detected")
+            except DownloadError:
+                pass
+            assert not output.exists()
+            assert Path(str(output) + ".part").exists()
+            assert manager.download(url, output) == str(output)
+            assert output.read_bytes() == payload
+            assert not Path(str(output) + ".part").exists()
+            
+            # 短いセグメント（ゼロ埋めの穴が残る）は受け入れず、不足分だけ取り直す
+            output = Path(tmp) / "short.mp4"
+            server.short_next = 1
+            try:
+                manager.download(url, output)
+                raise AssertionError("short segment was not detected")
+            except DownloadError as e:
+                assert "不完全" in str(e)
+            assert not output.exists()
+            assert manager.download(url, output) == str(output)
+            assert output.read_bytes() == payload
+            
+            # 小さなファイルは単一ストリーム（切断後も途中から再開）
+            small = DownloadManager(chunk_size=64 * 1024, min_segmented_size=len(payload) + 1, read_timeout=5)
+            output = Path(tmp) / "stream.mp4"
+            server.truncate_next = 1
+            try:
+                small.download(url, output)
+                raise AssertionError("truncated download was not detected")
+            except DownloadError:
+                pass
+            assert 0 < Path(str(output) + ".part").stat().st_size < len(payload)
+            small.download(url, output)
+            assert output.read_bytes() == payload
+            manager.close()
+            small.close()
+        finally:
+            server.shutdown()
+    
+    print("✅ Download manager works")
+    return True
+
+def test_workflow_executor():
+    """DAGワークフロー実行のテスト（操作はスタブ）"""
+    print("\n🧩 Testing workflow executor...")
+    
+    import time
+    from workflow_executor import load_workflow, WorkflowExecutor
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        calls = []
+        events = []
+        
+        def make_generator(kind, delay):
+            def _generate(prompt=None, image_path=None, **params):
+                calls.append(kind)
+                events.append((kind, "start", time.monotonic()))
+                time.sleep(delay)
+                if prompt == "FAIL":
+                    raise Exception("simulated failure")
+                path = Path(tmp) / f"{kind}_{len(calls)}.bin"
+                path.write_text(f"{kind}:{prompt}:{image_path}")
+                events.append((kind, "end", time.monotonic()))
+                return str(path)
+            return _generate
+        
+        operations = {
+            "generate_image": make_generator("image", 0.1),
+            "generate_music": make_generator("music", 0.6),
+            "image_to_video": make_generator("video", 0.1),
+            "create_3d_scene": lambda assets, scene_config: f"scene:{len(assets)}",
+        }
+        workflow_path = Path(tmp) / "pipeline.json"
+        workflow_path.write_text(json.dumps({"name": "test", "nodes": {
+            "image": {"op": "generate_image", "params": {"prompt": "${vars.prompt}"}},
+            "music": {"op": "generate_music", "params": {"prompt": "${vars.prompt} music"}},
+            "video": {"op": "image_to_video", "params": {"image_path": "${image}"}},
+            "scene": {"op": "create_3d_scene", "params": {"assets": ["${image}", "${video}"],
+                                                          "scene_config": {}}},
+        }}))
+        state_path = Path(tmp) / "state.json"
+        workflow = load_workflow(workflow_path)
+        
+        results = WorkflowExecutor(workflow, operations, state_path=state_path,
+                                   variables={"prompt": "island"}).run()
+        assert all(result["status"] == "done" for result in results.values()), results
+        assert results["scene"]["output"] == "scene:2"
+        # 下流ノードは無関係なブランチ（music）の完了を待たずに開始
+        video_start = [t for kind, phase, t in events if kind == "video" and phase == "start"][0]
+        music_end = [t for kind, phase, t in events if kind == "music" and phase == "end"][0]
+        assert video_start < music_end
+        
+        # 再実行時は出力が変わっていなければ再利用
+        calls.clear()
+        results = WorkflowExecutor(workflow, operations, state_path=state_path,
+                                   variables={"prompt": "island"}).run()
+        assert calls == [] and {r["status"] for r in results.values()} == {"cached"}
+        
+        # params で参照せず needs だけで依存するノードも、上流の出力が変われば作り直す
+        ordered_path = Path(tmp) / "ordered.json"
+        ordered_path.write_text(json.dumps({"name": "ordered", "nodes": {
+            "image": {"op": "generate_image", "params": {"prompt": "${vars.prompt}"}},
+            "music": {"op": "generate_music", "params": {"prompt": "fixed"}, "needs": ["image"]},
+        }}))
+        ordered = load_workflow(ordered_path)
+        ordered_state = Path(tmp) / "ordered_state.json"
+        WorkflowExecutor(ordered, operations, state_path=ordered_state, variables={"prompt": "a"}).run()
+        results = WorkflowExecutor(ordered, operations, state_path=ordered_state, variables={"prompt": "a"}).run()
+        assert results["music"]["status"] == "cached"
+        results = WorkflowExecutor(ordered, operations, state_path=ordered_state, variables={"prompt": "b"}).run()
+        assert results["image"]["status"] == "done" and results["music"]["status"] == "done", results
+        
+        # 失敗したノードの下流はスキップ、独立したブランチは継続
+        results = WorkflowExecutor(workflow, operations, state_path=state_path,
+                                   variables={"prompt": "FAIL"}).run()
+        assert results["image"]["status"] == "failed"
+        assert results["video"]["status"] == "skipped" and results["scene"]["status"] == "skipped"
+        
+        # 循環依存はエラー
+        try:
+            WorkflowExecutor({"nodes": {"a": {"op": "generate_image", "needs": ["b"]},
+                                        "b": {"op": "generate_image", "needs": ["a"]}}}, operations)
+            raise AssertionError("cycle was not detected")
+        except Exception as e:
+            assert "循環" in str(e)
+    
+    # 同梱のサンプルワークフローが検証を通ること
+    import generate
+    example = load_workflow(Path(__file__).parent / "workflows" / "pipelines" / "image-to-scene.yml")
+    executor = WorkflowExecutor(example, generate.workflow_operations())
+    assert executor.nodes["scene"]["needs"] == {"hero_image", "hero_model"}
+    
+    print("✅ Workflow executor works")
+    return True
+
+STUB_JOB_WORKER = """
+import sys, time
+sys.path.insert(0, sys.argv[1])
+from job_store import JobStore
+store = JobStore(sys.argv[2])
+while True:
+    job = store.claim()
+    if job is None:
+        break
+    time.sleep(0.01)
+    store.complete(job["id"], {"status": "ok", "path": job["item"]["prompt"]})
+    print(job["id"], flush=True)
+"""
+
+def test_job_store():
+    """永続ジョブキューのテスト（複数プロセスでの取得・クラッシュ後の再開）"""
+    print("\n🗃️ Testing job store...")
+    
+    import subprocess
+    from job_store import JobStore
+    from batch import run_jobs
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = Path(tmp) / "jobs.db"
+        store = JobStore(db_path)
+        items = [{"id": str(i), "index": i, "type": "image", "prompt": f"p{i}"} for i in range(30)]
+        store.enqueue("multi", items)
+        
+        # 3プロセスで同時に取得しても、各ジョブはちょうど1回だけ実行される
+        src_dir = str(Path(__file__).parent / "src")
+        workers = [subprocess.Popen([sys.executable, "-c", STUB_JOB_WORKER, src_dir, str(db_path)],
+                                    stdout=subprocess.PIPE, text=True) for _ in range(3)]
+        claimed = []
+        for process in workers:
+            out, _ = process.communicate(timeout=60)
+            assert process.returncode == 0
+            claimed.extend(out.split())
+        assert sorted(claimed) == sorted(f"multi#{i}" for i in range(30)), claimed
+        assert store.counts("multi")["done"] == 30
+        
+        # クラッシュしたプロセスが持っていたジョブは --resume で回収される
+        store.enqueue("crash", items[:4])
+        dead = subprocess.run([sys.executable, "-c", "import os; print(os.getpid())"],
+                              capture_output=True, text=True).stdout.strip()
+        running = store.claim("crash")
+        with store._connect() as conn:
+            conn.execute("UPDATE jobs SET worker = ? WHERE id = ?",
+                         (f"{store.worker.rpartition(':')[0]}:{dead}", running["id"]))
+        store.complete("crash#1", {"status": "ok", "path": "done.png"})
+        store.complete("crash#2", {"status": "failed", "error": "boom"})
+        assert store.recover_stale("crash") == 1
+        
+        class FakeClient:
+            def __init__(self):
+                self.prompts = []
+            def generate_asset(self, asset_type, prompt, **params):
+                self.prompts.append(prompt)
+                return {"path": f"{prompt}.png", "url": "https://example.com/x.png", "downloaded": True,
+                        "call_seconds": 0.0, "download_seconds": 0.0}
+        
+        client = FakeClient()
+        output = io.StringIO()
+        summary = run_jobs(client, store, batch="crash", max_workers=2, output=output, retry_failed=True)
+        # 完了済み(crash#1)は再実行せず、中断(crash#0)・失敗(crash#2)・未着手(crash#3)のみ実行
+        assert sorted(client.prompts) == ["p0", "p2", "p3"], client.prompts
+        assert summary == {"total": 3, "ok": 3, "failed": 0}
+        jobs = {job["id"]: job for job in store.jobs("crash")}
+        assert all(job["state"] == "done" for job in jobs.values())
+        assert jobs["crash#0"]["attempts"] == 2 and jobs["crash#1"]["result_path"] == "done.png"
+        
+        # 同じセッションにまとめられるジョブは一括で取得される
+        mixed = [{"id": str(i), "index": i, "type": kind, "prompt": f"m{i}"}
+                 for i, kind in enumerate(["image", "video", "image", "image"])]
+        store.enqueue("group", mixed)
+        group_key = lambda item: item["type"] if item["type"] == "image" else None
+        claimed = store.claim_many("group", limit=3, group_key=group_key)
+        assert [job["id"] for job in claimed] == ["group#0", "group#2", "group#3"]
+        assert [job["id"] for job in store.claim_many("group", limit=3, group_key=group_key)] == ["group#1"]
+        
+        # 再登録（--resume なし）は全ジョブを queued に戻す
+        store.enqueue("crash", items[:4], reset=True)
+        assert store.counts("crash")["queued"] == 4
+        
+        # ただし生存中の別プロセスが実行中のジョブはそのまま（二重実行しない）
+        running = store.claim("crash")
+        store.enqueue("crash", items[:4], reset=True)
+        jobs = {job["id"]: job for job in store.jobs("crash")}
+        assert jobs[running["id"]]["state"] == "running" and jobs[running["id"]]["attempts"] == 1
+        assert store.counts("crash")["queued"] == 3
+        store.close()
+    
+    print("✅ Job store works")
+    return True
+
+def test_rate_limiter():
+    """レート制限・AIMD同時実行制御・利用量台帳のテスト"""
+    print("\n🚦 Testing rate limiter...")
+    
+    from mcp_http import MCPHttpError
+    from rate_limiter import (TokenBucket, AIMDLimiter, UsageLedger, RateLimiter, QuotaExceededError,
+                              load_rate_limits, is_throttle_error)
+    
+    # トークンバケット: 容量ぶんは即時、以降は補充速度で待機
+    now = [0.0]
+    def sleep(seconds):
+        now[0] += seconds
+    bucket = TokenBucket(rate_per_second=2.0, capacity=2, clock=lambda: now[0], sleep=sleep)
+    waits = [bucket.acquire() for _ in range(4)]
+    assert waits[:2] == [0.0, 0.0] and abs(waits[2] - 0.5) < 1e-9 and abs(now[0] - 1.0) < 1e-9, waits
+    
+    # AIMD: 成功で加算増加、スロットリングで半減
+    aimd = AIMDLimiter(max_limit=8, initial=4)
+    for _ in range(8):
+        aimd.acquire()
+        aimd.release("ok")
+    assert 5.0 < aimd.limit < 7.0, aimd.limit
+    aimd.acquire()
+    aimd.release("throttled")
+    assert 2.5 < aimd.limit < 3.5, aimd.limit
+    
+    assert is_throttle_error(MCPHttpError("busy", status_code=429))
+    assert not is_throttle_error(Exception("connection reset"))
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        # 台帳: 予算を超える予約は拒否、失敗したリクエストは計上しない
+        limits = load_rate_limits(Path(tmp) / "missing.json")
+        limits["budget"]["monthly_units"] = 12
+        limits["capabilities"]["t2i"].update({"requests_per_minute": 6000, "burst": 10})
+        limiter = RateLimiter(Path(tmp) / "ledger.json", limits=limits)
+        
+        with limiter.acquire("t2i-google-imagen3", "t2i-"):
+            pass
+        try:
+            with limiter.acquire("t2i-google-imagen3", "t2i-"):
+                raise MCPHttpError("Too Many Requests", status_code=429)
+        except MCPHttpError:
+            pass
+        with limiter.acquire(None, "t2v-"):
+            pass
+        usage = limiter.ledger.usage()
+        assert usage["units"] == 11 and usage["requests"] == 2, usage
+        assert usage["by_capability"]["t2v"] == {"units": 10, "requests": 1}
+        assert usage["reserved"] == {}
+        
+        try:
+            limiter.acquire(None, "t2m-")
+            assert False, "budget should be exceeded"
+        except QuotaExceededError:
+            pass
+        
+        # 予算がなければ、失敗したリクエストだけでは台帳（とロック）を作らない
+        unbudgeted = RateLimiter(Path(tmp) / "unbudgeted.json", limits=load_rate_limits(Path(tmp) / "missing.json"))
+        try:
+            with unbudgeted.acquire(None, "t2i-"):
+                raise MCPHttpError("boom", status_code=500)
+        except MCPHttpError:
+            pass
+        assert not list(Path(tmp).glob("unbudgeted.json*"))
+        with unbudgeted.acquire(None, "t2i-"):
+            pass
+        assert unbudgeted.ledger.usage()["requests"] == 1
+        
+        # 異常終了したプロセスの予約は自動で解放される
+        ledger_path = Path(tmp) / "ledger.json"
+        data = json.loads(ledger_path.read_text())
+        data[UsageLedger.month()]["reserved"] = {"999999999": 50}
+        ledger_path.write_text(json.dumps(data))
+        with limiter.acquire(None, "t2i-"):
+            pass
+        assert limiter.ledger.usage()["units"] == 12
+    
+    print("✅ Rate limiter works")
+    return True
+
+def test_retry_and_hedging():
+    """再試行（バックオフ）とヘッジのテスト（Claude呼び出しはスタブ）"""
+    print("\n🔁 Testing retries and hedging...")
+    
+    import queue
+    import time
+    from retry_policy import RetryPolicy, GenerationError, hedged_call, is_transient
+    
+    # 一時的なエラーは上限まで再試行し、待機はフルジッターの指数バックオフ
+    delays = []
+    policy = RetryPolicy(max_attempts=4, base_delay=1.0, sleep=delays.append, rng=lambda: 1.0)
+    attempts = []
+    def flaky():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise Exception("Connection reset by peer")
+        return "ok"
+    assert policy.call(flaky) == "ok" and delays == [1.0, 2.0], delays
+    
+    attempts.clear()
+    def broken():
+        attempts.append(1)
+        raise Exception("Claude Code not found. Make sure it's installed and in PATH")
+    try:
+        policy.call(broken)
+        assert False, "permanent errors should not be retried"
+    except Exception as e:
+        assert "not found" in str(e) and len(attempts) == 1
+    assert is_transient(Exception("Claude Code error (exit 1): overloaded"))
+    
+    # 不完全なダウンロードは取り直す（キャンセル起因のものは除く）
+    from download_manager import DownloadError
+    from deadline import Cancelled
+    assert is_transient(DownloadError("サイズ不一致: 10 / 20 bytes (https://example.com/a.mp4)"))
+    assert is_transient(DownloadError("Rangeリクエストが拒否されました (HTTP 200)"))
+    try:
+        try:
+            raise Cancelled("job: SIGINT received")
+        except Cancelled as e:
+            raise DownloadError("ダウンロードエラー") from e
+    except DownloadError as e:
+        assert not is_transient(e)
+    
+    # ヘッジ: 主リクエストがp95を超えたら同等サーバーへ複製し、先に終わった方を採用
+    def call(name):
+        time.sleep(1.0 if name == "slow" else 0.05)
+        return f"result from {name}"
+    start = time.monotonic()
+    assert hedged_call(call, "slow", "fast", hedge_after=0.1) == ("fast", "result from fast")
+    assert time.monotonic() - start < 0.5
+    assert hedged_call(call, "fast", "slow", hedge_after=0.5) == ("fast", "result from fast")
+    
+    # 負けた方は子の期限がキャンセルされ、待機中の呼び出しがすぐに止まる
+    from deadline import current_deadline
+    outcomes = queue.Queue()
+    def cancellable(name):
+        try:
+            current_deadline().sleep(5.0 if name == "slow" else 0.05)
+        except Cancelled as e:
+            outcomes.put((name, str(e)))
+            raise
+        return f"result from {name}"
+    assert hedged_call(cancellable, "slow", "fast", hedge_after=0.1) == ("fast", "result from fast")
+    name, reason = outcomes.get(timeout=1.0)
+    assert name == "slow" and "fast" in reason, reason
+    
+    original_config = safety_controller.kamui_config_path
+    with tempfile.TemporaryDirectory() as tmp:
+        try:
+            config_path = _write_temp_kamui_config(tmp)
+            client = KamuiMCPClient(config_path=str(config_path), outputs_dir=Path(tmp) / "outputs",
+                                    transport="claude")
+            client.retry_policy = RetryPolicy(max_attempts=3, base_delay=0.0)
+            
+            # URLのないレスポンスは再試行され、2回目の結果がダウンロードされる
+            responses = iter(["I could not generate the image.", "done: https://fal.media/files/ok.png"])
+            client.call_claude_with_kamui = lambda prompt, **kwargs: next(responses)
+            client.download_file = lambda url, output_path: str(output_path)
+            assert client.generate_image("red circle", output_name="retry.jpg").endswith("retry.jpg")
+            
+            # ダウンロードに失敗したら存在しないパスを返さず GenerationError
+            client.call_claude_with_kamui = lambda prompt, **kwargs: "done: https://fal.media/files/gone.png"
+            client.download_file = lambda url, output_path: None
+            try:
+                client.generate_image("blue square", output_name="missing.jpg")
+                assert False, "a failed download should raise"
+            except GenerationError as e:
+                assert "Download failed" in str(e)
+            
+            # ヘッジ: 計測済みp95を超えた主サーバーの代わりに同等サーバーの結果を採用
+            for _ in range(5):
+                client.router.record("t2i-google-imagen3", 0.05)
+                client.router.record("t2i-google-imagen3-fast", 0.08)
+            def hedged_claude(prompt, **kwargs):
+                if "t2i-google-imagen3（" in prompt:
+                    time.sleep(1.0)
+                    return "slow: https://fal.media/files/slow.png"
+                return "fast: https://fal.media/files/fast.png"
+            client.call_claude_with_kamui = hedged_claude
+            client.download_file = lambda url, output_path: str(output_path)
+            client.hedge = True
+            result = client.generate_asset("image", "green triangle", output_name="hedged.jpg")
+            assert result["server"] == "t2i-google-imagen3-fast", result
+            assert result["url"] == "https://fal.media/files/fast.png" and result["call_seconds"] < 0.8
+        finally:
+            safety_controller.kamui_config_path = original_config
+    
+    print("✅ Retries and hedging work")
+    return True
+
+def test_session_generation():
+    """複数アセットの1セッション生成のテスト（Claude呼び出しはスタブ）"""
+    print("\n📚 Testing multi-asset session generation...")
+    
+    from batch import plan_batch_units, run_batch
+    from prompt_templates import render_prompt, render_session_prompt
+    
+    prompt = render_prompt("generate_music", {"prompt": "rain", "duration": 30, "genre": "ambient"}, "/tmp/audio")
+    assert "rainをテーマにした音楽" in prompt and "- ジャンル: ambient" in prompt and "（/tmp/audio）" in prompt
+    session_prompt = render_session_prompt("generate_image", [("1", "cat"), ("2", "dog")],
+                                           {"style": "minimal", "aspect_ratio": "1:1"})
+    assert "- [1] cat" in session_prompt and "- スタイル: minimal" in session_prompt and '"results"' in session_prompt
+    
+    original_config = safety_controller.kamui_config_path
+    with tempfile.TemporaryDirectory() as tmp:
+        try:
+            config_path = _write_temp_kamui_config(tmp)
+            client = KamuiMCPClient(config_path=str(config_path), outputs_dir=Path(tmp) / "outputs",
+                                    transport="claude")
+            client.session_batch_size = 4
+            
+            calls = []
+            def fake_call(kamui_prompt, **kwargs):
+                calls.append(kamui_prompt)
+                if "生成する項目" in kamui_prompt:
+                    # 4件中3件のみURLを返す（4件目は個別生成にフォールバック）
+                    results = [{"id": str(n), "url": f"https://fal.media/files/session{n}.png"} for n in (1, 2, 3)]
+                    results.append({"id": "4", "url": None})
+                    return "done\n```json\n" + json.dumps({"results": results}) + "\n```"
+                return "done: https://fal.media/files/single.png"
+            client.call_claude_with_kamui = fake_call
+            client.download_file = lambda url, output_path: str(output_path)
+            
+            items = [{"id": str(i), "index": i, "type": "image", "prompt": f"p{i}", "style": "minimal"}
+                     for i in range(5)]
+            items.append({"id": "v", "index": 5, "type": "video", "prompt": "waves"})
+            items.append({"id": "o", "index": 6, "type": "image", "prompt": "other", "style": "oil"})
+            units = plan_batch_units(client, items)
+            assert [len(unit) for unit in units] == [4, 1, 1, 1], [len(unit) for unit in units]
+            
+            output = io.StringIO()
+            summary = run_batch(client, items, max_workers=1, output=output)
+        finally:
+            safety_controller.kamui_config_path = original_config
+    
+    assert summary == {"total": 7, "ok": 7, "failed": 0}, summary
+    session_calls = [c for c in calls if "生成する項目" in c]
+    assert len(session_calls) == 1 and "- [4] p3" in session_calls[0]
+    # セッション1回 + 個別4回（URL欠落1件・グループ外の画像2件・動画1件）
+    assert len(calls) == 5, len(calls)
+    records = {r["id"]: r for r in map(json.loads, output.getvalue().splitlines())}
+    assert records["1"]["url"] == "https://fal.media/files/session2.png"
+    assert records["1"]["timings"]["session_size"] == 4
+    assert records["3"]["url"] == "https://fal.media/files/single.png"
+    print(f"✅ Session generation: {len(calls)} calls for {summary['total']} assets")
+    return True
+
+def test_tracing():
+    """スパン計測・トレース出力・ログレベル制御のテスト"""
+    print("\n⏱️ Testing tracing and logging...")
+    
+    import time
+    import logging
+    from tracing import Tracer, configure_logging, get_logger, percentile
+    
+    assert percentile([5, 1, 3, 2, 4], 0.5) == 3 and percentile([], 0.95) is None
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        tracer = Tracer()
+        with tracer.span("disabled") as span:
+            span.set("ignored", True)
+        assert tracer.spans == []
+        
+        trace_path = Path(tmp) / "trace.jsonl"
+        tracer.start(trace_path)
+        with tracer.span("generate", operation="generate_image") as root:
+            for delay in (0.01, 0.02):
+                with tracer.span("download", server="t2i-a"):
+                    time.sleep(delay)
+            root.set("server", "t2i-a")
+        try:
+            with tracer.span("mcp.call", operation="generate_music"):
+                raise ValueError("boom")
+        except ValueError:
+            pass
+        chrome_path = tracer.close()
+        
+        events = [json.loads(line) for line in trace_path.read_text().splitlines()]
+        assert [event["name"] for event in events] == ["download", "download", "generate", "mcp.call"]
+        assert all(event["ph"] == "X" and event["dur"] >= 0 for event in events)
+        root_event = events[2]
+        assert events[0]["args"]["parent_span_id"] == root_event["args"]["span_id"]
+        assert root_event["args"]["server"] == "t2i-a" and root_event["args"]["parent_span_id"] is None
+        assert "boom" in events[3]["args"]["error"]
+        assert len(json.loads(chrome_path.read_text())["traceEvents"]) == 4
+        
+        rows = {(row["stage"], row["group"]): row for row in tracer.summary()}
+        assert rows[("download", "")]["count"] == 2
+        assert rows[("download", "server=t2i-a")]["p95"] >= 0.02
+        assert rows[("generate", "operation=generate_image")]["count"] == 1
+        assert "mcp.call" in tracer.format_summary()
+    
+    # ログはレベルで制御される（warning ではinfoを出さない）
+    stream = io.StringIO()
+    root = configure_logging("warning", stream=stream)
+    try:
+        logger = get_logger("test_module")
+        logger.info("hidden message")
+        logger.warning("visible message")
+    finally:
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.setLevel(logging.NOTSET)
+        root.propagate = True
+    assert stream.getvalue() == "visible message\n", stream.getvalue()
+    
+    print("✅ Tracing works")
+    return True
+
+def test_generation_benchmark():
+    """オフラインベンチマーク（偽claude + ローカルメディアサーバー）とベースライン比較のテスト"""
+    print("\n🏁 Testing offline generation benchmark...")
+    
+    import subprocess
+    bench_path = Path(__file__).parent / "benchmarks" / "bench_generation.py"
+    sys.path.insert(0, str(bench_path.parent))
+    from bench_generation import compare_with_baseline
+    
+    baseline = {"s": {"assets_per_sec": 10.0, "p95_seconds": 1.0, "peak_rss_mb": 40.0}}
+    assert compare_with_baseline({"s": {"assets_per_sec": 8.0, "p95_seconds": 1.2, "peak_rss_mb": 41.0}},
+                                 baseline, 0.25) == []
+    regressions = compare_with_baseline({"s": {"assets_per_sec": 5.0, "p95_seconds": 2.0, "peak_rss_mb": 40.0}},
+                                        baseline, 0.25)
+    assert len(regressions) == 2 and "assets_per_sec" in regressions[0], regressions
+    assert compare_with_baseline({"new": {"assets_per_sec": 1.0}}, baseline, 0.25) == []
+    
+    # 一括生成シナリオを実際に偽claude経由で実行（劣化判定は環境依存なので行わない）
+    with tempfile.TemporaryDirectory() as tmp:
+        baseline_path = Path(tmp) / "baseline.json"
+        completed = subprocess.run(
+            [sys.executable, str(bench_path), "--quick", "--delay", "0.05", "--no-baseline",
+             "--scenario", "client-image-c4-session4", "--scenario", "cli-image-c4"],
+            capture_output=True, text=True, timeout=120)
+        assert completed.returncode == 0, completed.stdout + completed.stderr
+        rows = [line.split() for line in completed.stdout.splitlines()
+                if line.startswith(("client-image-c4-session4", "cli-image-c4"))]
+        assert len(rows) == 2 and all(row[1] == "6" and row[2] == "0" for row in rows), completed.stdout
+        
+        completed = subprocess.run([sys.executable, str(bench_path), "--quick", "--update-baseline",
+                                    "--baseline", str(baseline_path), "--scenario", "cli-image-c4"],
+                                   capture_output=True, text=True, timeout=120)
+        assert completed.returncode == 1 and not baseline_path.exists()
+    
+    print("✅ Generation benchmark works")
+    return True
+
+def test_daemon():
+    """常駐デーモン（ソケット経由のジョブ実行・進捗中継・停止）のテスト"""
+    print("\n🛰️ Testing generation daemon...")
+    
+    import time
+    import generate
+    from tracing import get_logger
+    import socket
+    from deadline import Cancelled
+    from daemon import KamuiDaemon, submit_job, daemon_running, stop_daemon
+    
+    job_logger = get_logger("daemon_test_job")
+    
+    cancelled = {}
+    
+    def run_job(args, job):
+        job_logger.debug("hidden detail")
+        job_logger.info(f"working on {args['prompt']}")
+        job.stdout.write(json.dumps({"prompt": args["prompt"]}) + "\n")
+        try:
+            job.deadline.sleep(args.get("sleep", 0))
+        except Cancelled:
+            cancelled[args["prompt"]] = job.deadline.reason
+            return 130
+        return 2 if args["prompt"] == "boom" else 0
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        socket_path = Path(tmp) / "kamui.sock"
+        assert not daemon_running(socket_path)
+        assert submit_job(socket_path, {"prompt": "x"}, io.StringIO(), io.StringIO()) is None
+        
+        daemon = KamuiDaemon(socket_path, run_job)
+        thread = threading.Thread(target=daemon.serve_forever, daemon=True)
+        thread.start()
+        for _ in range(100):
+            if daemon_running(socket_path):
+                break
+            time.sleep(0.02)
+        assert daemon_running(socket_path)
+        
+        stdout, logs = io.StringIO(), io.StringIO()
+        assert submit_job(socket_path, {"prompt": "cat"}, stdout, logs, log_level="info") == 0
+        assert json.loads(stdout.getvalue()) == {"prompt": "cat"}
+        assert logs.getvalue() == "working on cat\n", logs.getvalue()
+        assert submit_job(socket_path, {"prompt": "boom"}, io.StringIO(), io.StringIO()) == 2
+        
+        # 実行中のジョブがあれば後続ジョブは待機を通知してから順に実行
+        results = {}
+        def submit(name, sleep):
+            results[name] = io.StringIO()
+            submit_job(socket_path, {"prompt": name, "sleep": sleep}, io.StringIO(), results[name])
+        first = threading.Thread(target=submit, args=("slow", 0.3))
+        first.start()
+        time.sleep(0.1)
+        submit("fast", 0)
+        first.join()
+        assert "Waiting for the running job" in results["fast"].getvalue()
+        assert daemon.jobs_run == 4
+        
+        # 接続元の切断でジョブの期限がキャンセルされる（claudeプロセス等を止めるため）
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(str(socket_path))
+        sock.sendall(b'{"command": "run", "args": {"prompt": "gone", "sleep": 10}}\n')
+        sock.makefile("rb").readline()
+        sock.close()
+        
+        # Ctrl-C は cancel として転送され、ジョブの終了を待ってから送出し直される
+        class InterruptOnce(io.StringIO):
+            interrupted = False
+            def write(self, data):
+                if not self.interrupted:
+                    self.interrupted = True
+                    raise KeyboardInterrupt
+                return super().write(data)
+        start = time.monotonic()
+        try:
+            submit_job(socket_path, {"prompt": "ctrl-c", "sleep": 10}, InterruptOnce(), io.StringIO())
+            raise AssertionError("KeyboardInterrupt must be re-raised")
+        except KeyboardInterrupt:
+            pass
+        assert time.monotonic() - start < 5
+        assert cancelled == {"gone": "client disconnected", "ctrl-c": "cancelled by client"}, cancelled
+        
+        assert stop_daemon(socket_path)
+        thread.join(timeout=5)
+        assert not thread.is_alive() and not socket_path.exists()
+        assert not stop_daemon(socket_path)
+    
+    # パス引数は呼び出し元のカレントディレクトリ基準で絶対パス化
+    args = generate.argparse.Namespace(batch="prompts.jsonl", batch_output="-", workflow=None, trace=None)
+    request_args = generate.daemon_request_args(args)
+    assert request_args["batch"] == str(Path("prompts.jsonl").resolve()) and request_args["batch_output"] == "-"
+    
+    print("✅ Daemon works")
+    return True
+
+def test_postprocess():
+    """生成物の後処理（派生ファイル作成・mipサイズ・変更のない入力のスキップ）のテスト"""
+    print("\n🖼️ Testing post-processing...")
+    
+    from postprocess import PostProcessor, mip_sizes, Image
+    
+    assert mip_sizes(1500, 900) == [(1024, 512), (512, 256), (256, 128), (128, 64), (64, 32), (32, 16),
+                                     (16, 8), (8, 4), (4, 2), (2, 1), (1, 1)]
+    assert mip_sizes(4096, 4096)[0] == (2048, 2048) and mip_sizes(1, 1) == [(1, 1)]
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        outputs_dir = Path(tmp)
+        image_path = outputs_dir / "images" / "image_test.jpg"
+        image_path.parent.mkdir(parents=True)
+        (outputs_dir / "images" / "notes.txt").write_text("not media")
+        
+        def write_image(color):
+            if Image is not None:
+                Image.new("RGB", (300, 200), color).save(image_path, "PNG")
+            else:
+                image_path.write_bytes(bytes(color))
+        
+        write_image((200, 30, 30))
+        processor = PostProcessor(outputs_dir, max_workers=2)
+        try:
+            paths = sorted((outputs_dir / "images").iterdir())
+            first = processor.process_all(paths)
+            second = processor.process_all(paths)
+            write_image((30, 200, 30))
+            changed = processor.process_all(paths)
+        finally:
+            processor.close()
+        
+        if Image is not None:
+            assert first == {"processed": 1, "unsupported": 0, "failed": 0, "skipped": 1}, first
+            assert second["processed"] == 0 and second["skipped"] == 2, second
+            assert changed["processed"] == 1, changed
+            derived = outputs_dir / "derived" / "images" / "image_test_jpg"
+            assert (derived / "mips" / "mip_0_256x128.png").exists()
+            assert any(derived.glob("thumb.*")) and (derived / "mips" / "mip_8_1x1.png").exists()
+            with Image.open(next(derived.glob("thumb.*"))) as thumbnail:
+                assert max(thumbnail.size) <= 256
+        else:
+            # Pillowがなければ何も記録せず、導入後に作り直せるよう毎回対象になる
+            assert first["unsupported"] == 1 and second["unsupported"] == 1, (first, second)
+    
+    print("✅ Post-processing works")
+    return True
+
+def test_asset_manifest():
+    """生成物索引（記録・プロンプト/タイプ/日付での検索・同一パスの上書き）のテスト"""
+    print("\n🗂️ Testing asset manifest...")
+    
+    import time
+    from asset_manifest import AssetManifest, parse_date
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        manifest = AssetManifest(tmp / ".assets.db")
+        # 最初の記録まではファイルを作らない（クライアントを作っただけで outputs/ に状態を残さない）
+        assert manifest.query() == [] and manifest.get(tmp / "none.png") is None
+        assert not (tmp / ".assets.db").exists()
+        
+        def record(name, operation, params, server="t2i-a", content=b"data"):
+            path = tmp / name
+            path.write_bytes(content)
+            request = {"operation": operation, "params": params, "cache_key": "k-" + name}
+            result = {"path": str(path), "server": server, "url": f"https://example.com/{name}",
+                      "cached": False, "call_seconds": 1.5, "download_seconds": 0.2}
+            return manifest.record(request, result)
+        
+        row = record("sunset.png", "generate_image", {"prompt": "美しい夕焼けの海", "style": "anime"})
+        assert row["type"] == "image" and row["bytes"] == 4 and len(row["digest"]) == 64
+        record("ocean.mp3", "generate_music", {"prompt": "calm ocean waves", "duration": 30}, server="t2m-a")
+        record("clip.mp4", "image_to_video", {"image": "abc", "motion_prompt": "slow ocean pan"}, server="i2v-a")
+        
+        assert [r["path"] for r in manifest.query("夕焼け")] == [str((tmp / "sunset.png").resolve())]
+        assert {r["type"] for r in manifest.query("ocean")} == {"music", "video"}
+        assert [r["type"] for r in manifest.query("OCEAN", asset_type="video")] == ["video"]
+        assert len(manifest.query("海")) == 1 and manifest.query("夕焼け ocean") == []
+        assert manifest.query("50%_off") == []
+        
+        # 開き直した直後の検索でも全文索引を使う（generate.py query は毎回新しく開く）
+        if manifest.full_text:
+            import sqlite3
+            reopened = AssetManifest(tmp / ".assets.db")
+            statements = []
+            conn = sqlite3.connect(str(tmp / ".assets.db"), isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.set_trace_callback(statements.append)
+            reopened._local.conn = conn
+            assert {r["type"] for r in reopened.query("ocean")} == {"music", "video"}
+            assert any("assets_fts MATCH" in statement for statement in statements), statements
+            reopened.close()
+        
+        found = manifest.query(asset_type="music")[0]
+        assert found["params"] == {"prompt": "calm ocean waves", "duration": 30} and found["cached"] is False
+        assert found["server"] == "t2m-a" and found["call_seconds"] == 1.5
+        
+        assert len(manifest.query(since=time.time() - 60)) == 3
+        assert manifest.query(until=parse_date("2020-01-01")) == []
+        assert len(manifest.query(limit=2)) == 2
+        
+        # 同じパスへの再生成は行を上書き（全文検索の索引も更新）
+        record("sunset.png", "generate_image", {"prompt": "foggy mountain"}, content=b"new content")
+        assert manifest.query("夕焼け") == [] and manifest.query("foggy")[0]["bytes"] == 11
+        assert len(manifest.query()) == 3
+        manifest.close()
+    
+    try:
+        parse_date("yesterday")
+        raise AssertionError("invalid date must be rejected")
+    except Exception as e:
+        assert "日付" in str(e)
+    
+    print("✅ Asset manifest works")
+    return True
+
+def test_blob_store():
+    """ブロブストア（受信中のハッシュ・ハードリンクによる重複排除・未参照ブロブのGC）のテスト"""
+    print("\n🧱 Testing blob store...")
+    
+    import os
+    import hashlib
+    from blob_store import BlobStore
+    from download_manager import DownloadManager, DownloadError
+    
+    server = _start_stand_in_server(_RangeMediaHandler)
+    server.truncate_next = 0
+    server.short_next = 0
+    url = f"http://127.0.0.1:{server.server_port}/media/big.mp4"
+    payload = _RangeMediaHandler.payload
+    digest = hashlib.sha256(payload).hexdigest()
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        store = BlobStore(tmp / ".blobs")
+        try:
+            # 途中から再開した単一ストリームでも、取得済み部分を含めた内容のダイジェストになる
+            stream = DownloadManager(chunk_size=64 * 1024, min_segmented_size=len(payload) + 1, read_timeout=5)
+            first = tmp / "videos" / "first.mp4"
+            server.truncate_next = 1
+            try:
+                stream.download(url, first, store)
+                raise AssertionError("truncated download was not detected")
+            except DownloadError:
+                pass
+            assert stream.download(url, first, store) == str(first)
+            
+            # セグメント並列取得した同じ内容は同じブロブへのリンクになる
+            segmented = DownloadManager(chunk_size=64 * 1024, max_segments=4, min_segmented_size=256 * 1024,
+                                        read_timeout=5)
+            second = tmp / "videos" / "second.mp4"
+            segmented.download(url, second, store)
+            stream.close()
+            segmented.close()
+        finally:
+            server.shutdown()
+        
+        blob = store.blob_path(digest)
+        assert [path.name for path in store.blobs()] == [digest]
+        assert first.read_bytes() == payload and os.path.samefile(first, blob) and os.path.samefile(second, blob)
+        assert not list((tmp / "videos").glob("*.part*"))
+        
+        # 既存の重複ファイルはリンクに置き換え、新しい内容はブロブとして取り込む
+        copy = tmp / "videos" / "copy.mp4"
+        copy.write_bytes(payload)
+        unique = tmp / "images" / "unique.png"
+        unique.parent.mkdir()
+        unique.write_bytes(b"unique image")
+        assert store.adopt(copy) == len(payload) and os.path.samefile(copy, blob)
+        assert store.adopt(unique) == 0 and store.adopt(unique) == 0
+        assert os.path.samefile(unique, store.blob_path(hashlib.sha256(b"unique image").hexdigest()))
+        
+        # シンボリックリンクで参照されているブロブ、猶予期間内のブロブは残す
+        for path in (first, second, copy):
+            path.unlink()
+        os.symlink(blob, tmp / "videos" / "linked.mp4")
+        roots = [tmp / "videos", tmp / "images"]
+        assert store.gc(roots, grace_seconds=0)["removed"] == 0
+        (tmp / "videos" / "linked.mp4").unlink()
+        assert store.gc(roots, grace_seconds=3600)["removed"] == 0
+        assert store.gc(roots, grace_seconds=0, dry_run=True) == {"blobs": 2, "removed": 1, "freed_bytes": len(payload)}
+        assert blob.exists()
+        assert store.gc(roots, grace_seconds=0)["removed"] == 1
+        assert not blob.exists() and unique.read_bytes() == b"unique image"
+    
+    print("✅ Blob store works")
+    return True
+
+def test_origin_url_reuse():
+    """生成物の元URL（有効期限付き）の記録と、画像入力の操作での再利用のテスト"""
+    print("\n🔗 Testing origin URL reuse...")
+    
+    import time
+    from datetime import datetime, timezone
+    from asset_manifest import url_expires_at, ORIGIN_URL_TTL_SECONDS
+    
+    def signed_url(name, signed_at, expires):
+        stamp = datetime.fromtimestamp(signed_at, timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+        return (f"https://storage.googleapis.com/bucket/{name}?X-Goog-Algorithm=GOOG4-RSA-SHA256"
+                f"&X-Goog-Date={stamp}&X-Goog-Expires={expires}&X-Goog-Signature=abc")
+    
+    now = int(time.time())
+    assert url_expires_at(signed_url("a.png", now, 600), 0) == now + 600
+    assert url_expires_at(f"https://storage.googleapis.com/b/a.png?Expires={now + 60}&Signature=x", 0) == now + 60
+    assert url_expires_at("https://fal.media/files/a.png", now) == now + ORIGIN_URL_TTL_SECONDS
+    assert url_expires_at("https://example.com/a.png?X-Goog-Date=bad&X-Goog-Expires=1", now) == \
+        now + ORIGIN_URL_TTL_SECONDS
+    
+    original_config = safety_controller.kamui_config_path
+    with tempfile.TemporaryDirectory() as tmp:
+        try:
+            config_path = _write_temp_kamui_config(tmp)
+            client = KamuiMCPClient(config_path=str(config_path), outputs_dir=Path(tmp) / "outputs",
+                                    cache_mode="off", transport="claude")
+            
+            client.limiter.limits["capabilities"]["i2v"].update({"requests_per_minute": 6000, "burst": 10})
+            image_urls = {"fresh": signed_url("fresh.png", now, 3600), "stale": signed_url("stale.png", now - 3600, 3660)}
+            prompts = []
+            def fake_call(kamui_prompt, working_dir=None, **kwargs):
+                prompts.append(kamui_prompt)
+                for name, url in image_urls.items():
+                    if name in kamui_prompt:
+                        return url
+                return "https://fal.media/files/clip.mp4"
+            def fake_download(url, output_path):
+                Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+                Path(output_path).write_bytes(url.encode())
+                return str(output_path)
+            client.call_claude_with_kamui = fake_call
+            client.download_file = fake_download
+            
+            # 有効な元URLはローカルパスの代わりにそのまま入力に渡す
+            fresh = client.generate_image("fresh")
+            client.image_to_video(fresh)
+            assert image_urls["fresh"] in prompts[-1] and str(Path(fresh).resolve()) not in prompts[-1]
+            request = client._build_image_to_3d_request(fresh)
+            assert request["params"]["image_url"] == image_urls["fresh"]
+            
+            # コピーしたファイルも内容が同じなら同じ元URLを使う
+            copy = Path(tmp) / "copy.png"
+            copy.write_bytes(Path(fresh).read_bytes())
+            assert client._build_image_to_video_request(copy)["params"]["image_url"] == image_urls["fresh"]
+            
+            # 失効間近のURL・記録のないファイルはローカルパス（claude経由でアップロード）
+            stale = client.generate_image("stale")
+            client.image_to_video(stale)
+            assert image_urls["stale"] not in prompts[-1] and str(Path(stale).resolve()) in prompts[-1]
+            local = Path(tmp) / "local.png"
+            local.write_bytes(b"never downloaded")
+            request = client._build_image_to_video_request(local)
+            assert "image_url" not in request["params"] and str(local.resolve()) in request["kamui_prompt"]
+            
+            # 元URLはキャッシュキーに含めない
+            assert request["cache_key"] == client._build_image_to_video_request(local)["cache_key"]
+            assert client._build_image_to_video_request(copy)["cache_key"] == \
+                client._build_image_to_video_request(fresh)["cache_key"]
+            
+            # 元URLが受け付けられなければローカルの画像でやり直し、そのURLは以降再利用しない
+            image_urls["rejected"] = "https://fal.media/files/rejected.png"
+            rejected = client.generate_image("rejected")
+            def rejecting_call(kamui_prompt, **kwargs):
+                prompts.append(kamui_prompt)
+                if image_urls["rejected"] in kamui_prompt:
+                    raise Exception("image_url is invalid (HTTP 400)")
+                return "https://fal.media/files/clip.mp4"
+            client.call_claude_with_kamui = rejecting_call
+            video = client.image_to_video(rejected)
+            assert image_urls["rejected"] in prompts[-2] and str(Path(rejected).resolve()) in prompts[-1]
+            assert "image_url" not in client.manifest.get(video)["params"]
+            assert "image_url" not in client._build_image_to_video_request(rejected)["params"]
+            client.close()
+        finally:
+            safety_controller.kamui_config_path = original_config
+    
+    print("✅ Origin URL reuse works")
+    return True
+
+def test_quality_tiers():
+    """draft ティア（高速サーバー・短尺・シード記録）と promote による final での作り直しのテスト"""
+    print("\n✏️ Testing draft / final tiers...")
+    
+    from prompt_templates import render_prompt
+    
+    final_prompt = render_prompt("generate_image", {"prompt": "cat", "style": "minimal", "aspect_ratio": "1:1"}, "/tmp")
+    assert "- 高品質で生成してください\n\n" in final_prompt and "シード" not in final_prompt
+    
+    original_config = safety_controller.kamui_config_path
+    with tempfile.TemporaryDirectory() as tmp:
+        try:
+            config_path = _write_temp_kamui_config(tmp)
+            client = KamuiMCPClient(config_path=str(config_path), outputs_dir=Path(tmp) / "outputs",
+                                    transport="claude")
+            
+            calls = []
+            def fake_call(kamui_prompt, **kwargs):
+                calls.append(kamui_prompt)
+                return f"https://fal.media/files/out{len(calls)}.{'mp4' if '動画' in kamui_prompt else 'png'}"
+            def fake_download(url, output_path):
+                Path(output_path).write_bytes(url.encode())
+                return str(output_path)
+            client.call_claude_with_kamui = fake_call
+            client.download_file = fake_download
+            
+            # draft は高速版サーバー・低解像度・固定シード（同じ下書きはキャッシュから）
+            draft = client.generate_image("red fox", style="minimal", tier="draft")
+            assert "使用するMCPサーバー: t2i-google-imagen3-fast" in calls[-1]
+            assert "下書き" in calls[-1] and "- 解像度: 512px" in calls[-1] and "高品質" not in calls[-1]
+            params = client.manifest.get(draft)["params"]
+            seed = params["seed"]
+            assert params["tier"] == "draft" and isinstance(seed, int) and f"- シード: {seed}" in calls[-1]
+            assert client.generate_image("red fox", style="minimal", tier="draft") == draft and len(calls) == 1
+            
+            client.tier = "draft"
+            draft_video = client.generate_video("waves", duration=8, fps=30)
+            video_params = client.manifest.get(draft_video)["params"]
+            assert video_params["duration"] == 2 and video_params["fps"] == 12
+            assert video_params["requested"] == {"duration": 8, "fps": 30}
+            client.tier = "final"
+            
+            # promote は同じプロンプト・シードで final として作り直す
+            final = client.promote(draft)
+            assert final["path"] != draft and "高品質" in calls[-1] and f"- シード: {seed}" in calls[-1]
+            assert "下書き" not in calls[-1] and "解像度" not in calls[-1]
+            final_params = client.manifest.get(final["path"])["params"]
+            assert final_params == {"prompt": "red fox", "style": "minimal", "aspect_ratio": "1:1", "seed": seed}
+            
+            final_video = client.promote(draft_video)
+            assert client.manifest.get(final_video["path"])["params"]["duration"] == 8
+            assert "- FPS: 30" in calls[-1]
+            
+            for bad in (final["path"], Path(tmp) / "unknown.png"):
+                try:
+                    client.promote(bad)
+                    raise AssertionError("only recorded drafts can be promoted")
+                except Exception as e:
+                    assert "draft" in str(e) or "索引" in str(e), e
+            try:
+                client.generate_image("x", tier="preview")
+                raise AssertionError("unknown tier must be rejected")
+            except Exception as e:
+                assert "ティア" in str(e)
+            
+            # 1セッションにまとめた draft でも、各項目のシードをそれぞれの行で渡す
+            def fake_session(kamui_prompt, **kwargs):
+                calls.append(kamui_prompt)
+                results = [{"id": str(n), "url": f"https://fal.media/files/s{n}.png"} for n in (1, 2)]
+                return "```json\n" + json.dumps({"results": results}) + "\n```"
+            client.call_claude_with_kamui = fake_session
+            client.session_batch_size = 4
+            group = client.generate_asset_group("image", [{"prompt": "owl"}, {"prompt": "bat"}],
+                                                style="minimal", tier="draft")
+            assert "生成する項目" in calls[-1]
+            for number, (prompt, result) in enumerate(zip(("owl", "bat"), group), 1):
+                item_seed = client.manifest.get(result["path"])["params"]["seed"]
+                assert f"- [{number}] {prompt} (シード: {item_seed})" in calls[-1], calls[-1]
+            client.close()
+        finally:
+            safety_controller.kamui_config_path = original_config
+    
+    print("✅ Draft / final tiers work")
+    return True
+
+STUB_SLOW_CLAUDE = """#!{python}
+import subprocess, sys, time
+sys.stdin.read()
+# MCPサーバー相当の子プロセスを起動して応答しないまま待つ
+child = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"])
+with open({pid_file!r}, "w") as f:
+    f.write(str(child.pid))
+time.sleep(60)
+"""
+
+def test_deadline_cancellation():
+    """期限・キャンセルの伝搬（claudeのプロセスグループ停止・途中ファイル削除・他の枝の早期終了）のテスト"""
+    print("\n⏰ Testing deadline propagation and cancellation...")
+    
+    import os
+    import time
+    import threading
+    import generate
+    from deadline import Deadline, Cancelled, DeadlineExceeded, deadline_scope, stage, stage_budget
+    from download_manager import DownloadManager
+    from retry_policy import RetryPolicy
+    
+    # 子の期限は親を超えず、親のキャンセルは子へ伝わる
+    job = Deadline(0.5)
+    child = job.child(60, name="generate_video")
+    assert child.remaining() <= 0.5
+    threading.Timer(0.1, job.cancel, args=("stop",)).start()
+    start = time.monotonic()
+    try:
+        child.sleep(5)
+        raise AssertionError("sleep must be interrupted by cancellation")
+    except Cancelled as e:
+        assert "stop" in str(e) and time.monotonic() - start < 1.0
+    try:
+        Deadline(0.01).sleep(5)
+        raise AssertionError("deadline must expire")
+    except DeadlineExceeded:
+        pass
+    
+    os.environ["KAMUI_BUDGET_DOWNLOAD"] = "0.05"
+    try:
+        assert stage_budget("download") == 0.05 and stage_budget("generate_video") == 600
+        with deadline_scope(Deadline(30)), stage("download") as download_stage:
+            assert download_stage.remaining() <= 0.05
+    finally:
+        del os.environ["KAMUI_BUDGET_DOWNLOAD"]
+    
+    # キャンセルは再試行しない
+    attempts = []
+    def cancelled_call():
+        attempts.append(1)
+        raise Cancelled("job: stop")
+    try:
+        RetryPolicy(max_attempts=3, sleep=lambda seconds: None).call(cancelled_call)
+    except Cancelled:
+        pass
+    assert len(attempts) == 1
+    
+    original_config = safety_controller.kamui_config_path
+    with tempfile.TemporaryDirectory() as tmp:
+        try:
+            config_path = _write_temp_kamui_config(tmp)
+            client = KamuiMCPClient(config_path=str(config_path), outputs_dir=Path(tmp) / "outputs",
+                                    transport="claude")
+            
+            # キャンセルでclaudeと子プロセス（MCPサーバー等）をまとめて停止
+            pid_file = Path(tmp) / "child.pid"
+            stub = Path(tmp) / "slow-claude"
+            stub.write_text(STUB_SLOW_CLAUDE.format(python=sys.executable, pid_file=str(pid_file)))
+            stub.chmod(0o755)
+            client.claude_executable = str(stub)
+            job = Deadline(30)
+            def cancel_when_started():
+                while not pid_file.exists() or not pid_file.read_text():
+                    time.sleep(0.02)
+                job.cancel("SIGINT received")
+            threading.Thread(target=cancel_when_started, daemon=True).start()
+            start = time.monotonic()
+            try:
+                with deadline_scope(job):
+                    client.call_claude_with_kamui("prompt")
+                raise AssertionError("cancelled call must raise")
+            except Cancelled as e:
+                assert "SIGINT" in str(e) and time.monotonic() - start < 10
+            child_pid = int(pid_file.read_text())
+            for _ in range(50):
+                try:
+                    os.kill(child_pid, 0)
+                except ProcessLookupError:
+                    break
+                time.sleep(0.05)
+            else:
+                raise AssertionError("child process of claude survived cancellation")
+            
+            # 期限切れはステージの持ち時間で打ち切り
+            pid_file.unlink()
+            start = time.monotonic()
+            try:
+                with deadline_scope(Deadline(0.5)):
+                    client.call_claude_with_kamui("prompt")
+                raise AssertionError("expired call must raise")
+            except DeadlineExceeded:
+                assert time.monotonic() - start < 5
+            client.close()
+        finally:
+            safety_controller.kamui_config_path = original_config
+        
+        # キャンセルされたダウンロードは再開用の途中ファイルも削除
+        output = Path(tmp) / "videos" / "clip.mp4"
+        output.parent.mkdir()
+        part = output.with_name("clip.mp4.part")
+        state = output.with_name("clip.mp4.part.json")
+        part.write_bytes(b"partial")
+        state.write_text("{}")
+        cancelled = Deadline()
+        cancelled.cancel("SIGTERM received")
+        downloader = DownloadManager()
+        try:
+            with deadline_scope(cancelled):
+                downloader.download("http://127.0.0.1:9/clip.mp4", output)
+            raise AssertionError("cancelled download must raise")
+        except Cancelled:
+            pass
+        downloader.close()
+        assert not part.exists() and not state.exists() and not output.exists()
+    
+    # 複数アセットの1つが失敗したら残りの枝も中断し、元のエラーを送出
+    interrupted = []
+    def failing_image(prompt):
+        time.sleep(0.1)
+        raise Exception("image server rejected the prompt")
+    def slow_generator(asset_type):
+        def _generate(prompt):
+            try:
+                generate.current_deadline().sleep(10)
+            except Cancelled:
+                interrupted.append(asset_type)
+                raise
+        return _generate
+    originals = {name: getattr(generate, name) for name in
+                 ["generate_image", "generate_video", "generate_music", "generate_3d_model"]}
+    try:
+        generate.generate_image = failing_image
+        generate.generate_video = slow_generator("video")
+        generate.generate_music = slow_generator("music")
+        generate.generate_3d_model = slow_generator("3d")
+        start = time.monotonic()
+        try:
+            generate.run_generation("all", "p", max_parallel=4)
+            raise AssertionError("failed branch must fail the job")
+        except Exception as e:
+            assert "rejected" in str(e), e
+        assert sorted(interrupted) == ["3d", "music", "video"] and time.monotonic() - start < 2
+    finally:
+        for name, func in originals.items():
+            setattr(generate, name, func)
+    
+    print("✅ Deadlines and cancellation propagate")
+    return True
+
+def test_operation_registry():
+    """操作の登録簿（不変スナップショット・デコレート時の分類解決・同期/非同期関数）のテスト"""
+    print("\n📇 Testing operation registry...")
+    
+    import asyncio
+    import mcp_safety
+    from deadline import Deadline, Cancelled, current_deadline
+    from mcp_safety import OperationRegistry, operation_registry, require_kamui_mcp, allow_other_mcp
+    
+    # 並行登録: 読み取り側はロックなしで常に一貫したスナップショットを見る
+    registry = OperationRegistry({"generate_image"}, {"generate_image", "render_scene"})
+    assert registry.kind("generate_image") == "generation" and registry.kind("render_scene") == "processing"
+    assert registry.kind("missing") == "unknown"
+    snapshot = registry.processing
+    stop = threading.Event()
+    inconsistent = []
+    
+    def reader():
+        while not stop.is_set():
+            processing = registry.processing
+            if not isinstance(processing, frozenset) or "render_scene" not in processing:
+                inconsistent.append(processing)
+    
+    readers = [threading.Thread(target=reader) for _ in range(2)]
+    writers = [threading.Thread(target=lambda n=n: [registry.register(f"op_{n}_{i}", "processing") for i in range(200)])
+               for n in range(8)]
+    for thread in readers + writers:
+        thread.start()
+    for thread in writers:
+        thread.join()
+    stop.set()
+    for thread in readers:
+        thread.join()
+    assert not inconsistent
+    assert len(registry.processing) == 2 + 8 * 200 and len(snapshot) == 2
+    assert not registry.register("op_0_0", "processing")
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        config_path = Path(tmp) / "mcp-kamuicode.json"
+        config_path.write_text(json.dumps({"mcpServers": {"t2i-google-imagen3": {"type": "http", "url": "http://a"},
+                                                          "i2v-fal-kling": {"type": "http", "url": "http://b"}}}))
+        original_path = mcp_safety.safety_controller.kamui_config_path
+        mcp_safety.safety_controller.kamui_config_path = str(config_path)
+        try:
+            # 加工系はデコレート時に登録され、関数はそのまま返る
+            def compose_preview_sheet(assets):
+                return len(assets)
+            assert operation_registry.kind("compose_preview_sheet") == "unknown"
+            assert allow_other_mcp(compose_preview_sheet) is compose_preview_sheet
+            assert operation_registry.kind("compose_preview_sheet") == "processing"
+            
+            @require_kamui_mcp
+            def generate_image(prompt):
+                """画像生成"""
+                return (prompt, current_deadline().name)
+            
+            @require_kamui_mcp
+            async def image_to_video(image_path):
+                """画像から動画"""
+                await asyncio.sleep(0)
+                return (image_path, current_deadline().name)
+            
+            assert generate_image.__name__ == "generate_image" and generate_image.__doc__ == "画像生成"
+            assert generate_image.operation_kind == "generation" and image_to_video.operation_kind == "generation"
+            assert asyncio.iscoroutinefunction(image_to_video) and image_to_video.__wrapped__.__name__ == "image_to_video"
+            
+            job = Deadline(60, name="job")
+            assert generate_image("cat", deadline=job) == ("cat", "job")
+            assert asyncio.run(image_to_video("a.png", deadline=job)) == ("a.png", "job")
+            job.cancel("stop")
+            for call in (lambda: generate_image("cat", deadline=job),
+                         lambda: asyncio.run(image_to_video("a.png", deadline=job))):
+                try:
+                    call()
+                    raise AssertionError("cancelled deadline must stop the call")
+                except Cancelled:
+                    pass
+            
+            # 未定義の操作は strict_mode で呼び出し時に拒否
+            @require_kamui_mcp
+            def generate_hologram(prompt):
+                return prompt
+            assert generate_hologram.operation_kind == "unknown"
+            try:
+                generate_hologram("x")
+                raise AssertionError("unknown operation must be rejected in strict mode")
+            except Exception as e:
+                assert "未定義の操作" in str(e)
+        finally:
+            mcp_safety.safety_controller.kamui_config_path = original_path
+    
+    print("✅ Operation registry works")
+    return True
+
 def main():
+    from tracing import configure_logging
+    configure_logging()
+    
     print("🧪 Creative Factory - Kamui MCP Test Suite")
     print("=" * 50)
     
     tests = [
         ("Connection Test", test_kamui_connection),
         ("Safety Controls Test", test_safety_controls),
+        ("Parallel Generation Test", test_parallel_generation),
+        ("Batch Mode Test", test_batch_mode),
+        ("Generation Cache Test", test_generation_cache),
+        ("MCP HTTP Transport Test", test_mcp_http_transport),
+        ("Claude Worker Pool Test", test_claude_worker_pool),
+        ("Config Index Test", test_config_index),
+        ("MCP Router Test", test_mcp_router),
+        ("Streaming Response Test", test_streaming_response),
+        ("URL Extractor Test", test_url_extractor),
+        ("Download Manager Test", test_download_manager),
+        ("Workflow Executor Test", test_workflow_executor),
+        ("Job Store Test", test_job_store),
+        ("Rate Limiter Test", test_rate_limiter),
+        ("Retry and Hedging Test", test_retry_and_hedging),
+        ("Session Generation Test", test_session_generation),
+        ("Tracing Test", test_tracing),
+        ("Generation Benchmark Test", test_generation_benchmark),
+        ("Daemon Test", test_daemon),
+        ("Post-processing Test", test_postprocess),
+        ("Asset Manifest Test", test_asset_manifest),
+        ("Blob Store Test", test_blob_store),
+        ("Origin URL Reuse Test", test_origin_url_reuse),
+        ("Quality Tier Test", test_quality_tiers),
+        ("Deadline Cancellation Test", test_deadline_cancellation),
+        ("Operation Registry Test", test_operation_registry),
         ("Simple Generation Test", test_simple_generation),
     ]
     